@@ -27,6 +27,9 @@ build_image()
 {
   DIR=$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )
   setup_jocker_env
+  # the elasticsearch image runs the schema creator, which is outside of
+  # the build context.
+  cp $PACKAGER_DOCKER_PATH/../package-configuration/elasticsearch/init/es_schema_creator.py $PACKAGER_DOCKER_PATH/elasticsearch/
   jocker -t $PACKAGER_DOCKER_PATH/Dockerfile.template -o $PACKAGER_DOCKER_PATH/Dockerfile -f $PACKAGER_DOCKER_PATH/vars.py
   echo Building cloudify OSS stack image.
   build_cloudify_image cloudify:latest
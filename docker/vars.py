@@ -60,6 +60,8 @@ VARS = {
         "reqs": [
             "curl",
             "openjdk-7-jdk",
+            "python",
+            "python-pip",
         ],
         "elasticsearch_tar_url": "https://download.elasticsearch.org/elasticsearch/elasticsearch/elasticsearch-1.0.1.tar.gz",
         "ports": ["9200"],
@@ -14,14 +14,595 @@
 #    * See the License for the specific language governing permissions and
 #    * limitations under the License.
 
+import os
+import re
+import sys
+import json
+import time
+import Queue
+import fcntl
+import shutil
+import hashlib
+import tarfile
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from contextlib import contextmanager, closing
+
+import yaml
+import requests
 from packman import logger
-from packman.packman import get_package_config as get_conf
+from packman import packman
 from packman import utils
 from packman import python
-from packman import retrieve
+
+# package configs are read from this file (see `get_conf`).
+PACKAGES_FILE = os.environ.get('PACKAGER_PACKAGES_FILE', 'packages.yaml')
+# bump when `_compile_packages` changes to invalidate compiled configs.
+PACKAGES_CACHE_VERSION = 1
+# type of each package config key, and whether the key is required.
+# other keys are passed through as they are.
+PACKAGE_SCHEMA = {
+    'name': (basestring, True),
+    'version': (basestring, True),
+    'sources_path': (basestring, True),
+    'package_path': (basestring, False),
+    'depends': (list, False),
+    'source_urls': (list, False),
+    'modules': (list, False),
+    'source_package_type': (basestring, False),
+    'destination_package_types': (list, False),
+    'bootstrap_script': (basestring, False),
+    'bootstrap_template': (basestring, False),
+    'bootstrap_params': (dict, False),
+    'bootstrap_log': (basestring, False),
+    'config_templates': (dict, False),
+}
+# agent flavours built by `build_agents` when no explicit list is given.
+AGENT_PACKAGES = [
+    'Ubuntu-precise-agent',
+    'Ubuntu-trusty-agent',
+    'centos-Final-agent',
+    'debian-jessie-agent',
+]
+# downloaded files are kept here across builds (see `DownloadCache`).
+DOWNLOAD_CACHE_PATH = os.environ.get(
+    'PACKAGER_DOWNLOAD_CACHE', '/var/cache/cloudify-packager/downloads')
+DOWNLOAD_CACHE_MAX_SIZE = 2 * 1024 ** 3
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = 60
+# golden virtualenvs, which agent virtualenvs are cloned from.
+GOLDEN_VENVS_PATH = os.environ.get(
+    'PACKAGER_GOLDEN_VENVS', '/var/cache/cloudify-packager/venvs')
+# packages built by the last `build_packages` run, for resuming it.
+BUILD_STATE_FILE = os.environ.get('PACKAGER_BUILD_STATE', '.build-state.json')
+# a timeline and a trace of every build are written to here.
+BUILD_REPORTS_PATH = os.environ.get('PACKAGER_BUILD_REPORTS', 'build-reports')
+# wheels built by the wheelhouse stage, shared by all packages.
+WHEELHOUSE_PATH = os.environ.get(
+    'PACKAGER_WHEELHOUSE', '/var/cache/cloudify-packager/wheelhouse')
+PIP_TIMEOUT = '45'
+# pip lines marking the start of work on a requirement.
+PIP_PROGRESS = re.compile(r'^\s*(?:Collecting|Processing|Obtaining) (\S+)')
+# maximum number of build processes allowed to use a resource at once.
+RESOURCE_LIMITS = {
+    'network': 2,
+    'disk': 2,
+}
 
 lgr = logger.init()
 
+# set in each build process by `_init_worker`.
+_resource_locks = {}
+# spans recorded by `_timed` during the build in progress.
+_spans = []
+# compiled packages files loaded by `_load_packages`, by path.
+_packages = {}
+
+
+def _validate_package(key, package):
+    if not isinstance(package, dict):
+        return ['{0}: not a mapping'.format(key)]
+    errors = []
+    for field, (kind, required) in sorted(PACKAGE_SCHEMA.items()):
+        if field not in package:
+            if required:
+                errors.append('{0}: missing {1}'.format(key, field))
+        elif not isinstance(package[field], kind):
+            errors.append('{0}: {1} must be a {2}'.format(
+                key, field, 'string' if kind is basestring else kind.__name__))
+    for url in package.get('source_urls') or []:
+        if not isinstance(url, (basestring, dict)) or \
+                isinstance(url, dict) and 'url' not in url:
+            errors.append('{0}: bad source url {1!r}'.format(key, url))
+    return errors
+
+
+def _compile_packages(path):
+    """parses, validates and normalizes the packages file at `path`
+
+    fragments shared by several packages are declared once, as YAML
+    anchors under `defaults`, and merged into the packages with `<<`.
+    `python_modules` is exposed as `modules`.
+    """
+    lgr.debug('Compiling {0}'.format(path))
+    with open(path) as f:
+        packages = (yaml.safe_load(f) or {}).get('packages') or {}
+    errors = []
+    for key, package in sorted(packages.items()):
+        if isinstance(package, dict) and 'python_modules' in package:
+            package.setdefault('modules', package['python_modules'])
+        errors.extend(_validate_package(key, package))
+    for error in errors:
+        lgr.error('Invalid package config in {0}: {1}'.format(path, error))
+    if errors:
+        sys.exit(1)
+    # a round trip through json unshares merged fragments, so packages
+    # compiled now and packages read from the cache look the same.
+    return json.loads(json.dumps(packages))
+
+
+def _load_packages(path=None):
+    """returns the compiled packages file, indexed by package key
+
+    compiled packages are cached in memory and in a json file next to the
+    packages file, keyed by its mtime and size or, when those changed, by
+    its sha256. the packages file is only parsed when its content changed.
+    """
+    path = os.path.abspath(path or PACKAGES_FILE)
+    stat = os.stat(path)
+    stamp = [stat.st_mtime, stat.st_size]
+    loaded = _packages.get(path)
+    if loaded and loaded['stamp'] == stamp:
+        return loaded['packages']
+
+    cache_file = os.path.join(os.path.dirname(path), '.{0}.cache.json'.format(
+        os.path.basename(path)))
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+    except (IOError, ValueError):
+        cached = {}
+    if cached.get('version') != PACKAGES_CACHE_VERSION:
+        cached = {}
+    if cached.get('stamp') != stamp:
+        sha256 = _file_fingerprint(path)
+        if cached.get('sha256') != sha256:
+            cached = {'version': PACKAGES_CACHE_VERSION, 'sha256': sha256,
+                      'packages': _compile_packages(path)}
+        cached['stamp'] = stamp
+        try:
+            with tempfile.NamedTemporaryFile(
+                    dir=os.path.dirname(path), delete=False) as f:
+                json.dump(cached, f)
+            os.rename(f.name, cache_file)
+        except (IOError, OSError) as ex:
+            lgr.debug('Could not cache compiled packages: {0}'.format(ex))
+    _packages[path] = cached
+    return cached['packages']
+
+
+def get_conf(name):
+    """returns the config of the package keyed `name` in `PACKAGES_FILE`"""
+    packages = _load_packages()
+    if name not in packages:
+        lgr.error('Package {0} not found in {1}'.format(name, PACKAGES_FILE))
+        sys.exit(1)
+    return packages[name]
+
+
+def _init_worker(resource_locks):
+    global _resource_locks
+    _resource_locks = resource_locks
+
+
+@contextmanager
+def _use(resource):
+    """holds a slot of `resource` for the duration of the block
+
+    outside of a `build_agents` process pool, this is a no-op.
+    """
+    lock = _resource_locks.get(resource)
+    if lock is None:
+        yield
+    else:
+        with lock:
+            yield
+
+
+def _add_span(name, category, started, ended, **args):
+    _spans.append({
+        'name': name,
+        'category': category,
+        'started': started,
+        'duration': ended - started,
+        'pid': os.getpid(),
+        'tid': threading.current_thread().ident,
+        'args': args,
+    })
+
+
+@contextmanager
+def _timed(name, category, **args):
+    """records how long the block took as a span of the current build
+    """
+    started = time.time()
+    try:
+        yield
+    finally:
+        _add_span(name, category, started, time.time(), **args)
+
+
+def _write_build_report(name, status, spans):
+    """writes a build's spans as a JSON timeline and as a trace file
+
+    the trace file uses the Trace Event format, and can be loaded into
+    chrome://tracing or any other flame chart viewer.
+    """
+    utils.Handler().mkdir(BUILD_REPORTS_PATH)
+    started = min(span['started'] for span in spans)
+    report = os.path.join(BUILD_REPORTS_PATH, '{0}-{1}-{2}'.format(
+        name, time.strftime('%Y%m%d-%H%M%S', time.localtime(started)),
+        os.getpid()))
+    with open('{0}.json'.format(report), 'w') as f:
+        json.dump({
+            'name': name,
+            'status': status,
+            'started': started,
+            'duration': max(s['started'] + s['duration'] for s in spans) -
+            started,
+            'stages': [dict(span, started=span['started'] - started)
+                       for span in sorted(spans, key=lambda s: s['started'])],
+        }, f, indent=2)
+    with open('{0}.trace.json'.format(report), 'w') as f:
+        json.dump({'traceEvents': [{
+            'name': span['name'],
+            'cat': span['category'],
+            'ph': 'X',
+            'ts': int(span['started'] * 1e6),
+            'dur': int(span['duration'] * 1e6),
+            'pid': span['pid'],
+            'tid': span['tid'],
+            'args': span['args'],
+        } for span in spans]}, f)
+    totals = {}
+    for span in spans:
+        if span['category'] != 'build':
+            totals[span['category']] = \
+                totals.get(span['category'], 0) + span['duration']
+    lgr.info('Build of {0} {1}. Time per stage: {2}. Report: {3}.json'.format(
+        name, status, ', '.join('{0} {1:.2f}s'.format(c, t) for c, t in
+                                sorted(totals.items(), key=lambda t: -t[1])),
+        report))
+
+
+@contextmanager
+def _build_report(name):
+    """writes a report of the spans recorded while building `name`
+    """
+    global _spans
+    previous, _spans = _spans, []
+    status = 'failed'
+    try:
+        with _timed(name, 'build'):
+            yield
+        status = 'succeeded'
+    finally:
+        spans, _spans = _spans, previous
+        _write_build_report(name, status, spans)
+
+
+def _link_or_copy(src, dst):
+    if os.path.isfile(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        utils.Handler().cp(src, dst)
+
+
+class DownloadCache():
+    """a persistent, size bounded, content addressed download cache
+
+    files are stored once under their sha256 digest. an index maps each url
+    to the digest and validators (ETag / Last-Modified) of its last download
+    so that a cached url is revalidated with a conditional GET instead of
+    being downloaded again. when the cache grows beyond `max_size`, the
+    least recently used files are evicted.
+
+    the index is guarded by a file lock so that the cache can be shared by
+    concurrent build processes.
+    """
+    def __init__(self, path=DOWNLOAD_CACHE_PATH,
+                 max_size=DOWNLOAD_CACHE_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.blobs_path = os.path.join(path, 'blobs')
+        self.index_file = os.path.join(path, 'index.json')
+        utils.Handler().mkdir(self.blobs_path)
+
+    @contextmanager
+    def _index(self):
+        """yields the index, locked, and writes it back on exit
+        """
+        with open(os.path.join(self.path, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                index = {'urls': {}, 'blobs': {}}
+                if os.path.isfile(self.index_file):
+                    with open(self.index_file) as f:
+                        index = json.load(f)
+                yield index
+                tmp_file = '{0}.tmp'.format(self.index_file)
+                with open(tmp_file, 'w') as f:
+                    json.dump(index, f, indent=2)
+                os.rename(tmp_file, self.index_file)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _blob(self, digest):
+        return os.path.join(self.blobs_path, digest)
+
+    def lookup(self, url):
+        """returns the index entry for `url` if its file is still cached
+        """
+        with self._index() as index:
+            entry = index['urls'].get(url)
+            if entry and os.path.isfile(self._blob(entry['sha256'])):
+                return entry
+        return None
+
+    def fetch(self, url, destination=None, sha256=None, extract_to=None,
+              extracted=None):
+        """returns the path of the cached file for `url`
+
+        if `sha256` is given and a file with that digest is cached, no
+        request is made at all. otherwise, a cached url is revalidated
+        and only downloaded if it changed. a downloaded file whose digest
+        doesn't match `sha256` is rejected with a `ChecksumError`.
+        if `destination` is given, the cached file is also linked to it.
+
+        if `extract_to` is given, the file is extracted there as a tar.gz
+        archive. a download is extracted while it is streamed, in the same
+        pass. `extracted` is the digest of the archive last extracted to
+        `extract_to`. if that is what's cached, it isn't extracted again.
+        """
+        if sha256 and os.path.isfile(self._blob(sha256)):
+            lgr.debug('Cache hit for {0} (pinned sha256)'.format(url))
+            # the url's validators still hold if it last had that digest.
+            entry = self.lookup(url) or {}
+            blob = self._store(url, sha256, entry
+                               if entry.get('sha256') == sha256 else {})
+        else:
+            blob, downloaded = self._fetch(
+                url, self.lookup(url), sha256, extract_to)
+            if downloaded:
+                # it has already been extracted while streaming.
+                extracted = os.path.basename(blob)
+        if extract_to and os.path.basename(blob) != extracted:
+            with open(blob, 'rb') as f:
+                _extract_verified(
+                    _StreamReader(iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE),
+                                       b'')),
+                    extract_to, os.path.basename(blob), url)
+        if destination:
+            _link_or_copy(blob, destination)
+        return blob
+
+    def _fetch(self, url, entry, sha256=None, extract_to=None):
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            response = requests.get(url, headers=headers, stream=True,
+                                    timeout=DOWNLOAD_TIMEOUT)
+        except requests.RequestException as ex:
+            if not entry:
+                raise
+            lgr.warning('Could not revalidate {0} ({1}), using cached '
+                        'copy.'.format(url, ex))
+            return self._store(url, entry['sha256'], entry), False
+        with closing(response):
+            if response.status_code == 304:
+                lgr.debug('Cache hit for {0}'.format(url))
+                return self._store(url, entry['sha256'], entry), False
+            response.raise_for_status()
+            lgr.debug('Cache miss for {0}, downloading...'.format(url))
+            fd, tmp_file = tempfile.mkstemp(dir=self.path)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    reader = _StreamReader(
+                        response.iter_content(DOWNLOAD_CHUNK_SIZE), sink=f)
+                    if extract_to:
+                        digest = _extract_verified(
+                            reader, extract_to, sha256, url)
+                    else:
+                        digest = reader.drain()
+                        _verify(digest, sha256, url)
+                # identical content downloaded from another url is only
+                # kept once.
+                os.chmod(tmp_file, 0o644)
+                os.rename(tmp_file, self._blob(digest))
+            finally:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+        return self._store(url, digest, {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }), True
+
+    def _store(self, url, digest, validators):
+        blob = self._blob(digest)
+        with self._index() as index:
+            index['urls'][url] = {
+                'sha256': digest,
+                'etag': validators.get('etag'),
+                'last_modified': validators.get('last_modified'),
+            }
+            index['blobs'][digest] = {
+                'size': os.path.getsize(blob),
+                'last_used': time.time(),
+            }
+            self._evict(index, keep=digest)
+        return blob
+
+    def _evict(self, index, keep):
+        blobs = index['blobs']
+        total = sum(b['size'] for b in blobs.values())
+        for digest in sorted(blobs, key=lambda d: blobs[d]['last_used']):
+            if total <= self.max_size:
+                break
+            if digest == keep:
+                continue
+            lgr.debug('Evicting {0} from the download cache'.format(digest))
+            total -= blobs.pop(digest)['size']
+            if os.path.isfile(self._blob(digest)):
+                os.remove(self._blob(digest))
+            for url, entry in index['urls'].items():
+                if entry['sha256'] == digest:
+                    del index['urls'][url]
+
+
+class _StreamReader():
+    """a file-like reader over an iterable of chunks
+
+    every chunk read is hashed and, if `sink` is given, written to it.
+    """
+    def __init__(self, chunks, sink=None):
+        self.chunks = iter(chunks)
+        self.sink = sink
+        self.digest = hashlib.sha256()
+        self.buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.digest.update(chunk)
+            if self.sink:
+                self.sink.write(chunk)
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def drain(self):
+        """reads whatever is left and returns the digest of everything read
+        """
+        while self.read(DOWNLOAD_CHUNK_SIZE):
+            pass
+        return self.digest.hexdigest()
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def _verify(digest, sha256, url):
+    if sha256 and digest != sha256:
+        raise ChecksumError('Checksum mismatch for {0}: expected sha256 {1}, '
+                            'got {2}.'.format(url, sha256, digest))
+
+
+def _extract_verified(reader, destination, sha256, url):
+    """extracts a tar.gz stream to `destination`, in a single pass
+
+    the archive is extracted to a staging directory first, and only moved
+    into `destination` once its digest was verified against `sha256`,
+    raising a `ChecksumError` if it doesn't match.
+    top level entries already in `destination` are replaced.
+    returns the archive's digest.
+    """
+    staging = tempfile.mkdtemp(dir=destination)
+    try:
+        with _timed('untar', 'untar', url=url):
+            with closing(tarfile.open(fileobj=reader, mode='r|gz')) as tar:
+                tar.extractall(staging)
+            digest = reader.drain()
+        _verify(digest, sha256, url)
+        for name in os.listdir(staging):
+            target = os.path.join(destination, name)
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            elif os.path.lexists(target):
+                os.remove(target)
+            os.rename(os.path.join(staging, name), target)
+    finally:
+        shutil.rmtree(staging)
+    return digest
+
+
+def _source_urls(package):
+    """returns a (url, sha256) tuple for each of `package`'s source urls
+
+    an entry of `source_urls` is either a url, or a dict with a `url` and
+    the `sha256` of the archive it points to.
+    """
+    return [(entry['url'], entry.get('sha256')) if isinstance(entry, dict)
+            else (entry, None) for entry in package.get('source_urls', [])]
+
+
+def _fetch_shared_sources(packages):
+    """fetches every distinct source url of `packages` exactly once
+
+    returns a dict mapping each url to its file in the download cache.
+    exits if an archive doesn't match its pinned sha256.
+    """
+    urls = sorted(set(source for package in packages
+                      for source in _source_urls(package)))
+    if not urls:
+        return {}
+    cache = DownloadCache()
+
+    def fetch(source):
+        url, sha256 = source
+        with _timed('download', 'download', url=url):
+            return url, cache.fetch(url, sha256=sha256)
+
+    pool = ThreadPool(min(len(urls), RESOURCE_LIMITS['network']))
+    try:
+        return dict(pool.map(fetch, urls))
+    except ChecksumError as ex:
+        lgr.error(str(ex))
+        sys.exit(1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _fetch_sources(package, tar_file, manifest, shared_sources=None):
+    """fetches and extracts `package`'s sources into its sources path
+
+    each archive is only extracted if it differs from the one extracted by
+    the previous build, as recorded in `manifest`.
+    """
+    shared_sources = shared_sources or {}
+    cache = DownloadCache()
+    for url, sha256 in _source_urls(package):
+        stage = 'untar:' + url
+        if url in shared_sources:
+            lgr.debug('Using shared archive {0} for {1}'.format(
+                shared_sources[url], url))
+            sha256 = os.path.basename(shared_sources[url])
+        with _use('disk' if url in shared_sources else 'network'), \
+                _timed('download', 'download', url=url):
+            blob = cache.fetch(
+                url, tar_file, sha256=sha256,
+                extract_to=package['sources_path'],
+                extracted=manifest.stages.get(stage))
+        if manifest.changed(stage, os.path.basename(blob)):
+            manifest.record(stage, os.path.basename(blob))
+        else:
+            lgr.info('Sources from {0} are up to date'.format(url))
+
 
 def _prepare(package):
 
@@ -31,84 +612,881 @@ def _prepare(package):
     common.mkdir(package['package_path'])
 
 
-def create_agent(package, download=False):
-    dl_handler = retrieve.Handler()
-    common = utils.Handler()
-    py_handler = python.Handler()
-    _prepare(package)
-    py_handler.make_venv(package['sources_path'])
-    if download:
-        tar_file = '{0}/{1}.tar.gz'.format(
-            package['sources_path'], package['name'])
-        for url in package['source_urls']:
-            dl_handler.download(url, file=tar_file)
-        common.untar(package['sources_path'], tar_file)
-        for module in package['modules']:
-            py_handler.pip(module, package['sources_path'])
-
-
-def get_ubuntu_precise_agent(download=False):
+def _fingerprint(*inputs):
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+
+def _file_fingerprint(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _tree_fingerprint(path):
+    """fingerprints a directory by the names, sizes and mtimes of its files
+
+    artifacts of building or installing a module out of the directory are
+    ignored.
+    """
+    files = []
+    for root, dirs, names in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if d not in ('build', 'dist', '.eggs')
+                         and not d.endswith('.egg-info'))
+        for name in sorted(n for n in names if not n.endswith('.pyc')):
+            stat = os.stat(os.path.join(root, name))
+            files.append((os.path.relpath(os.path.join(root, name), path),
+                          stat.st_size, int(stat.st_mtime)))
+    return _fingerprint(files)
+
+
+class BuildManifest():
+    """the input fingerprints of each build stage of a package
+
+    the manifest is stored next to the package's virtualenv and is updated
+    after every stage, so that an interrupted build resumes from the first
+    stage that did not complete.
+    """
+    def __init__(self, sources_path):
+        self.file = '{0}.manifest.json'.format(sources_path.rstrip('/'))
+        self.stages = {}
+        if os.path.isfile(self.file):
+            with open(self.file) as f:
+                self.stages = json.load(f)
+
+    def changed(self, stage, fingerprint):
+        return self.stages.get(stage) != fingerprint
+
+    def record(self, stage, fingerprint):
+        self.stages[stage] = fingerprint
+        with open(self.file, 'w') as f:
+            json.dump(self.stages, f, indent=2, sort_keys=True)
+
+    def reset(self):
+        self.stages = {}
+        if os.path.isfile(self.file):
+            os.remove(self.file)
+
+    def modules(self):
+        return [s[len('pip:'):] for s in self.stages if s.startswith('pip:')]
+
+
+def _resolve_module(module, archives_path):
+    """returns what to pip install for `module`, and its fingerprint
+
+    remote archives are fetched through the download cache, and linked
+    into `archives_path`, so that a module is only reinstalled when its
+    content actually changed.
+    """
+    if module.startswith(('http://', 'https://')):
+        with _timed('download', 'download', url=module):
+            blob = DownloadCache().fetch(module)
+        digest = os.path.basename(blob)
+        archive = os.path.join(archives_path, '{0}-{1}'.format(
+            digest[:12], module.split('/')[-1]))
+        _link_or_copy(blob, archive)
+        return archive, digest
+    if os.path.isdir(module):
+        return module, _tree_fingerprint(module)
+    return module, module
+
+
+def _install_pending(venv, pending, wheelhouse=False):
+    """installs (module, source, fingerprint) tuples into `venv`
+    """
+    if wheelhouse:
+        wheels, links = _build_wheels(pending)
+        _install_modules(venv, wheels, ['--no-index'] + [
+            arg for link in links for arg in ('--find-links', link)])
+    else:
+        _install_modules(venv, [p[1] for p in pending])
+
+
+def _golden_venv(modules, wheelhouse=False):
+    """returns a golden virtualenv with `modules` installed in it
+
+    a golden virtualenv is built once for each set of module fingerprints,
+    and is then cloned for every package needing those modules (see
+    `_clone_venv`). it is never modified after it was built.
+    also returns the fingerprint of each of the modules.
+    """
+    archives_path = os.path.join(GOLDEN_VENVS_PATH, '.archives')
+    utils.Handler().mkdir(archives_path)
+    resolved = [(m,) + _resolve_module(m, archives_path) for m in modules]
+    golden = os.path.join(
+        GOLDEN_VENVS_PATH, _fingerprint([r[2] for r in resolved]))
+    if not os.path.isfile(os.path.join(golden, '.origin')):
+        lgr.info('Building golden virtualenv {0}'.format(golden))
+        with _timed('golden venv', 'venv', modules=modules):
+            build_path = tempfile.mkdtemp(dir=GOLDEN_VENVS_PATH)
+            python.Handler().make_venv(build_path)
+            utils.Handler().mkdir(os.path.join(build_path, 'archives'))
+            _install_pending(build_path, resolved, wheelhouse)
+            # scripts in the virtualenv refer to the path it was built in.
+            with open(os.path.join(build_path, '.origin'), 'w') as f:
+                f.write(build_path)
+            try:
+                os.rename(build_path, golden)
+            except OSError:
+                # built concurrently by another process.
+                utils.Handler().rmdir(build_path)
+    return golden, dict((r[0], r[2]) for r in resolved)
+
+
+def _clone_venv(golden, destination):
+    """clones a golden virtualenv into `destination`
+
+    files are hardlinked, except for scripts, .pth, .egg-link and
+    pyvenv.cfg files which refer to the path the golden virtualenv was
+    built in. these are copied and rewritten, as are absolute symlinks
+    into that path.
+    pip replaces files rather than modifying them, so installing into the
+    clone leaves the golden virtualenv intact.
+    """
+    with open(os.path.join(golden, '.origin')) as f:
+        origin = f.read().strip()
+
+    def relocate(path):
+        return destination + path[len(origin):] \
+            if _is_within(path, origin) else path
+
+    for root, dirs, files in os.walk(golden):
+        relative = os.path.relpath(root, golden)
+        if relative == '.':
+            # archives are per package, and are not cloned.
+            dirs.remove('archives')
+            files = [n for n in files if n != '.origin']
+        target_root = os.path.normpath(os.path.join(destination, relative))
+        utils.Handler().mkdir(target_root)
+        for name in dirs + files:
+            source = os.path.join(root, name)
+            target = os.path.join(target_root, name)
+            if os.path.islink(source):
+                os.symlink(relocate(os.readlink(source)), target)
+            elif name in dirs:
+                continue
+            elif relative.split(os.sep)[0] == 'bin' or name.endswith(
+                    ('.pth', '.egg-link', 'pyvenv.cfg')):
+                with open(source, 'rb') as f:
+                    content = f.read()
+                if origin in content:
+                    with open(target, 'wb') as f:
+                        f.write(content.replace(origin, destination))
+                    shutil.copymode(source, target)
+                else:
+                    _link_or_copy(source, target)
+            else:
+                _link_or_copy(source, target)
+
+
+def _make_venv(package, modules, manifest, golden=False, wheelhouse=False):
+    """creates `package`'s virtualenv
+
+    with `golden`, the virtualenv is cloned from a golden virtualenv that
+    has the package's modules which are not local paths installed in it.
+    `golden` may also be a list of modules, in which case only those of
+    them which the package needs are installed in the golden virtualenv.
+    modules installed from the golden virtualenv are recorded in the
+    `manifest` so they're not installed again.
+    """
+    sources_path = package['sources_path']
+    if golden is True:
+        golden = [m for m in modules if not m.startswith('/')]
+    golden = [m for m in modules if m in (golden or [])]
+    if not golden:
+        python.Handler().make_venv(sources_path)
+        return
+    golden_path, fingerprints = _golden_venv(golden, wheelhouse)
+    lgr.info('Cloning golden virtualenv {0} to {1}'.format(
+        golden_path, sources_path))
+    _clone_venv(golden_path, sources_path)
+    for module in golden:
+        manifest.record('pip:' + module, fingerprints[module])
+
+
+def _build_venv(package, fetch=True, install=True, shared_sources=None,
+                incremental=False, wheelhouse=False, golden=False):
+    """builds a package's virtualenv
+
+    the virtualenv is created, `fetch` downloads and extracts the package's
+    sources into it and `install` pip installs the package's modules.
+
+    with `incremental`, the virtualenv is kept and only the stages whose
+    inputs (package config, source archives, modules) changed since the
+    last build are repeated. the virtualenv itself is only rebuilt if the
+    package config changed or a module was removed from it.
+
+    with `wheelhouse`, modules are installed from wheels built once into
+    the shared wheelhouse (see `_build_wheels`).
+
+    with `golden`, the virtualenv is cloned from a golden virtualenv (see
+    `_make_venv`).
+    """
+    sources_path = package['sources_path']
+    manifest = BuildManifest(sources_path)
+    modules = package['modules'] if install else []
+
+    config = dict((k, v) for k, v in package.items()
+                  if k not in ('modules', 'python_modules', 'source_urls'))
+    venv_fingerprint = _fingerprint(config)
+    removed = set(manifest.modules()) - set(modules)
+    if not incremental or removed or \
+            manifest.changed('venv', venv_fingerprint) or \
+            not os.path.isdir(sources_path):
+        manifest.reset()
+        with _timed('prepare', 'prepare'):
+            _prepare(package)
+        with _timed('make_venv', 'venv'):
+            _make_venv(package, modules, manifest, golden, wheelhouse)
+        manifest.record('venv', venv_fingerprint)
+    else:
+        lgr.info('Reusing virtualenv {0}'.format(sources_path))
+
+    if fetch:
+        tar_file = '{0}/{1}.tar.gz'.format(sources_path, package['name'])
+        _fetch_sources(package, tar_file, manifest, shared_sources)
+
+    pending = []
+    with _use('network'):
+        for module in modules:
+            source, fingerprint = _resolve_module(
+                module, os.path.join(sources_path, 'archives'))
+            if manifest.changed('pip:' + module, fingerprint):
+                pending.append((module, source, fingerprint))
+            else:
+                lgr.info('{0} is up to date'.format(module))
+        if pending:
+            _install_pending(sources_path, pending, wheelhouse)
+    for module, _, fingerprint in pending:
+        manifest.record('pip:' + module, fingerprint)
+
+
+def _pip(venv, args):
+    """runs pip out of `venv`
+
+    returns pip's exit code, its output and the time spent on each
+    requirement pip worked on, as reported by its progress lines.
+    the time spent actually installing is reported as `installing`.
+    each of these is also recorded as a span of the current build.
+    """
+    cmd = [os.path.join(venv, 'bin', 'pip')] + args + [
+        '--default-timeout', PIP_TIMEOUT]
+    lgr.debug('Running {0}'.format(' '.join(cmd)))
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    output = []
+    timings = {}
+    current, started = None, time.time()
+    for line in iter(proc.stdout.readline, b''):
+        line = line.rstrip()
+        output.append(line)
+        lgr.debug(line)
+        progress = PIP_PROGRESS.match(line)
+        if progress or line.startswith('Installing collected packages'):
+            now = time.time()
+            if current:
+                timings[current] = timings.get(current, 0) + now - started
+                _add_span(current, 'pip', started, now)
+            current = progress.group(1) if progress else 'installing'
+            started = now
+    proc.wait()
+    if current:
+        timings[current] = timings.get(current, 0) + time.time() - started
+        _add_span(current, 'pip', started, time.time())
+    return proc.returncode, output, timings
+
+
+def _failed_requirements(output, requirements):
+    """returns the requirements pip's `output` blames for its failure
+    """
+    failed = set()
+    for line in output:
+        # errors about entries of a requirements file carry their line.
+        for number in re.findall(r'\(line (\d+)\)', line):
+            if int(number) <= len(requirements):
+                failed.add(requirements[int(number) - 1])
+        # build errors carry the directory the requirement was built in.
+        build_dir = re.search(r'error code \d+ in (\S+)', line)
+        if build_dir:
+            build_dir = build_dir.group(1).rstrip('/')
+            name = os.path.basename(build_dir).lower().replace('_', '-')
+            failed.update(r for r in requirements if _is_within(
+                r, build_dir) or re.split(
+                    r'[<>=!\[ ]', r)[0].lower().replace('_', '-') == name)
+    return [r for r in requirements if r in failed]
+
+
+def _install_modules(venv, modules, pip_args=None):
+    """pip installs `modules` into `venv` in a single pip run
+
+    all modules are written into one requirements file so that pip starts
+    and resolves only once. if that fails, the modules pip blames are
+    removed from the batch, which is retried, and are then installed one
+    by one. if pip's output doesn't say which modules failed, all of them
+    are installed one by one.
+    `pip_args` are passed to every pip run.
+    """
+    pip_args = pip_args or []
+    requirements_file = os.path.join(venv, 'archives', 'requirements.txt')
+    batch = list(modules)
+    failed = []
+    timings = {}
+    while batch:
+        with open(requirements_file, 'w') as f:
+            f.write('\n'.join(batch) + '\n')
+        returncode, output, batch_timings = _pip(
+            venv, ['install', '-r', requirements_file] + pip_args)
+        timings.update(batch_timings)
+        if returncode == 0:
+            break
+        culprits = _failed_requirements(output, batch) or batch
+        lgr.warning('Batch install failed, installing {0} separately.'.format(
+            ', '.join(culprits)))
+        failed.extend(culprits)
+        batch = [m for m in batch if m not in culprits]
+
+    for module in [m for m in modules if m in failed]:
+        started = time.time()
+        returncode, output, _ = _pip(venv, ['install', module] + pip_args)
+        timings[module] = time.time() - started
+        if returncode != 0:
+            lgr.error('\n'.join(output))
+            lgr.error('Module {0} could not be installed.'.format(module))
+            sys.exit(1)
+
+    lgr.info('pip timings for {0}:'.format(venv))
+    for requirement, seconds in sorted(
+            timings.items(), key=lambda t: t[1], reverse=True):
+        lgr.info('{0:>8.2f}s {1}'.format(seconds, requirement))
+    return timings
+
+
+def _wheel_builder():
+    """returns a virtualenv able to build wheels, creating it if needed
+    """
+    builder = os.path.join(WHEELHOUSE_PATH, '.builder')
+    utils.Handler().mkdir(WHEELHOUSE_PATH)
+    if not os.path.isfile(os.path.join(builder, 'bin', 'wheel')):
+        python.Handler().make_venv(builder)
+        returncode, output, _ = _pip(builder, ['install', 'wheel'])
+        if returncode != 0:
+            lgr.error('\n'.join(output))
+            sys.exit(1)
+    return builder
+
+
+def _build_wheels(modules):
+    """builds wheels for `modules` and their dependencies
+
+    `modules` is a list of (module, source, fingerprint) tuples. the wheels
+    of each module are kept in a directory of the wheelhouse named after
+    the module's fingerprint, so identical modules used by several packages
+    are only built once. unpinned index requirements are rebuilt daily.
+
+    returns the wheel file to install for each module and the wheelhouse
+    directories holding their dependencies.
+    """
+    builder = None
+    wheels, links = [], []
+    for module, source, fingerprint in modules:
+        if not source.startswith('/') and '==' not in source:
+            fingerprint = _fingerprint(fingerprint, time.strftime('%Y%m%d'))
+        wheel_dir = os.path.join(WHEELHOUSE_PATH, _fingerprint(fingerprint))
+        index_file = os.path.join(wheel_dir, 'wheels.json')
+        if not os.path.isfile(index_file):
+            started = time.time()
+            builder = builder or _wheel_builder()
+            tmp_dir = tempfile.mkdtemp(dir=WHEELHOUSE_PATH)
+            top_dir = os.path.join(tmp_dir, 'top')
+            # the module itself is built first, on its own, so that it can
+            # be told apart from its dependencies.
+            returncode, output, _ = _pip(
+                builder, ['wheel', '--no-deps', '-w', top_dir, source])
+            top_wheels = [w for w in os.listdir(top_dir) if w.endswith(
+                '.whl')] if os.path.isdir(top_dir) else []
+            if returncode == 0 and len(top_wheels) != 1:
+                output.append('Expected a single wheel of {0}, pip built: '
+                              '{1}'.format(module, top_wheels))
+                returncode = 1
+            if returncode == 0:
+                returncode, output, _ = _pip(builder, [
+                    'wheel', '-w', tmp_dir, '--find-links', top_dir,
+                    os.path.join(top_dir, top_wheels[0])])
+            if returncode != 0:
+                lgr.error('\n'.join(output))
+                lgr.error('Could not build wheels for {0}'.format(module))
+                utils.Handler().rmdir(tmp_dir)
+                sys.exit(1)
+            with open(os.path.join(tmp_dir, 'wheels.json'), 'w') as f:
+                json.dump({
+                    'module': module,
+                    'wheel': top_wheels[0],
+                    'wheels': dict(
+                        (w, _file_fingerprint(os.path.join(tmp_dir, w)))
+                        for w in os.listdir(tmp_dir) if w.endswith('.whl')),
+                }, f, indent=2)
+            try:
+                os.rename(tmp_dir, wheel_dir)
+            except OSError:
+                # built concurrently by another process.
+                utils.Handler().rmdir(tmp_dir)
+            _add_span(module, 'wheelhouse', started, time.time())
+        else:
+            lgr.debug('Using prebuilt wheels for {0}'.format(module))
+        with open(index_file) as f:
+            wheels.append(os.path.join(wheel_dir, json.load(f)['wheel']))
+        links.append(wheel_dir)
+    return wheels, links
+
+
+def create_agent(package, download=False, shared_sources=None, **options):
+    with _build_report(package['name']):
+        _build_venv(package, fetch=download, install=download,
+                    shared_sources=shared_sources, **options)
+
+
+def _package_paths(package):
+    return [p for p in (package.get('sources_path'),
+                        package.get('package_path')) if p]
+
+
+def _local_module_paths(package):
+    return [m for m in package.get('modules', package.get(
+        'python_modules', [])) if m.startswith('/')]
+
+
+def _is_within(path, parent):
+    path = os.path.normpath(path)
+    parent = os.path.normpath(parent)
+    return path == parent or path.startswith(parent + os.sep)
+
+
+def _conflicts(package, other):
+    """returns True if two packages cannot be built concurrently
+
+    that is the case when they share a sources or package path, or when one
+    of them installs modules out of the other's sources.
+    """
+    own = _package_paths(package)
+    used = own + _local_module_paths(package)
+    other_own = _package_paths(other)
+    other_used = other_own + _local_module_paths(other)
+    return any(_is_within(p, o) or _is_within(o, p)
+               for p in used for o in other_own) or \
+        any(_is_within(p, o) for p in other_used for o in own)
+
+
+def _build_groups(names, packages):
+    """splits `names` into groups which can be built concurrently
+
+    `packages` maps each name to its package config.
+    packages within a group are built one after the other, in the order
+    in which they were given.
+    """
+    groups = []
+    for name in names:
+        clashing = [g for g in groups if any(
+            _conflicts(packages[name], packages[n]) for n in g)]
+        merged = [name]
+        for group in clashing:
+            groups.remove(group)
+            merged = group + merged
+        groups.append(merged)
+    return groups
+
+
+def _build_agent_group(args):
+    names, download, shared_sources, options = args
+    results = []
+    for name in names:
+        try:
+            create_agent(get_conf(name), download, shared_sources, **options)
+            results.append((name, None))
+        except (Exception, SystemExit) as ex:
+            # packman exits on most errors. that would kill the pool worker
+            # so the error is returned instead.
+            results.append((name, repr(ex)))
+            break
+    return results
+
+
+def build_agents(names=None, download=False, processes=None, **options):
+    """builds several agents concurrently
+
+    shared source archives are downloaded once before any agent is built.
+    agents which share paths on disk are built serially within one process
+    while independent agents are built in parallel.
+    concurrent use of the network and disk is capped by `RESOURCE_LIMITS`.
+    `options` are passed on to `create_agent`.
+    """
+    with _build_report('agents'):
+        return _build_agents(names, download, processes, **options)
+
+
+def _build_agents(names, download, processes, **options):
+    names = names or AGENT_PACKAGES
+    packages = dict((name, get_conf(name)) for name in names)
+    shared_sources = \
+        _fetch_shared_sources(packages.values()) if download else {}
+    if download and options.get('golden'):
+        # the golden virtualenv gets the modules all agents have in common
+        # and is built once, before any agent is.
+        options['golden'] = [
+            m for m in packages[names[0]]['modules'] if not m.startswith('/')
+            and all(m in packages[n]['modules'] for n in names)]
+        _golden_venv(options['golden'], options.get('wheelhouse'))
+    groups = _build_groups(names, packages)
+    lgr.info('Building agents in {0} parallel group(s): {1}'.format(
+        len(groups), groups))
+
+    resource_locks = dict(
+        (resource, multiprocessing.BoundedSemaphore(limit))
+        for resource, limit in RESOURCE_LIMITS.items())
+    pool = multiprocessing.Pool(
+        processes=min(processes or len(groups), len(groups)),
+        initializer=_init_worker, initargs=(resource_locks,))
+    try:
+        with _timed('agents', 'pool', groups=groups):
+            results = pool.map(
+                _build_agent_group, [(group, download, shared_sources, options)
+                                     for group in groups])
+    finally:
+        pool.close()
+        pool.join()
+
+    failed = [(name, error) for group in results
+              for name, error in group if error]
+    for name, error in failed:
+        lgr.error('Failed building {0}: {1}'.format(name, error))
+    built = [name for group in results for name, error in group
+             if not error]
+    lgr.info('Built agents: {0}'.format(built))
+    if failed:
+        sys.exit(1)
+    return built
+
+
+def _package_graph(names, packages):
+    """returns the packages in `names` and all those they depend on
+
+    each package is mapped to the set of packages it depends on. `depends`
+    may refer to a package by its key or by its name. dependencies which
+    are not in `packages`, such as system packages, are not built here and
+    are left out.
+    """
+    keys = {}
+    for key, package in packages.items():
+        keys.setdefault(key, set()).add(key)
+        keys.setdefault(package['name'], set()).add(key)
+    graph = {}
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name in graph:
+            continue
+        if name not in packages:
+            lgr.error('Package {0} not found in {1}'.format(
+                name, PACKAGES_FILE))
+            sys.exit(1)
+        graph[name] = set()
+        for dependency in packages[name].get('depends') or []:
+            found = keys.get(dependency, set()) - set([name])
+            if not found:
+                lgr.debug('{0} depends on {1}, which is not built here'.format(
+                    name, dependency))
+            graph[name] |= found
+            pending.extend(found)
+    return graph
+
+
+def _toposort(graph):
+    """orders the nodes of `graph` so that each follows its dependencies
+
+    exits if the graph has a cycle.
+    """
+    dependents = dict((name, set()) for name in graph)
+    for name, dependencies in graph.items():
+        for dependency in dependencies:
+            dependents[dependency].add(name)
+    waiting = dict((name, len(deps)) for name, deps in graph.items())
+    ready = sorted(name for name, count in waiting.items() if not count)
+    order = []
+    while ready:
+        name = ready.pop(0)
+        order.append(name)
+        for dependent in sorted(dependents[name]):
+            waiting[dependent] -= 1
+            if not waiting[dependent]:
+                ready.append(dependent)
+    if len(order) < len(graph):
+        lgr.error('Packages in or depending on a dependency cycle: {0}'.format(
+            sorted(name for name in graph if name not in order)))
+        sys.exit(1)
+    return order
+
+
+def _read_build_state():
+    try:
+        with open(BUILD_STATE_FILE) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_build_state(state):
+    with open(BUILD_STATE_FILE + '.tmp', 'w') as f:
+        json.dump(state, f, indent=4, sort_keys=True)
+    os.rename(BUILD_STATE_FILE + '.tmp', BUILD_STATE_FILE)
+
+
+def _build_package(args):
+    """builds a package with its function in `BUILDERS`
+
+    other packages are retrieved by packman. packages missing from
+    `PACKAGES_FILE` fail.
+    """
+    name, download, options = args
+    builder = BUILDERS.get(name)
+    try:
+        if builder:
+            builder(download, **options)
+        else:
+            with _build_report(name):
+                packman.get(get_conf(name))
+        return name, None
+    except (Exception, SystemExit) as ex:
+        # see `_build_agent_group`.
+        return name, repr(ex)
+
+
+def build_packages(names=None, download=False, processes=None, resume=False,
+                   **options):
+    """builds packages and the packages they depend on
+
+    packages are built in the order given by their `depends`, and
+    packages which neither depend on each other nor share paths on disk
+    are built in parallel. no new packages are started once one fails.
+    with `resume`, packages built by the previous run whose config hasn't
+    changed since, and none of whose dependencies is rebuilt, are skipped,
+    so the build resumes from the package which failed.
+    `options` are passed on to the packages' functions in `BUILDERS`.
+    a package whose build process dies fails, as do the packages being
+    built alongside it, whose processes are stopped.
+    """
+    with _build_report('packages'):
+        return _build_packages(names, download, processes, resume, **options)
+
+
+def _build_packages(names, download, processes, resume, **options):
+    packages = _load_packages()
+    graph = _package_graph(names or sorted(packages), packages)
+    pending = _toposort(graph)
+    lgr.info('Building packages in dependency order: {0}'.format(pending))
+    fingerprints = dict((name, _fingerprint(packages[name], download, options))
+                        for name in pending)
+    previous = _read_build_state().get('built', {}) if resume else {}
+    state = {'built': {}, 'failed': None}
+    _write_build_state(state)
+
+    resource_locks = dict(
+        (resource, multiprocessing.BoundedSemaphore(limit))
+        for resource, limit in RESOURCE_LIMITS.items())
+    pool = multiprocessing.Pool(
+        processes=processes, initializer=_init_worker,
+        initargs=(resource_locks,))
+    workers = list(pool._pool)
+    results = Queue.Queue()
+    running = set()
+    done = set()
+    rebuilt = set()
+    died = False
+    try:
+        while pending or running:
+            name = None if state['failed'] else _next_ready(
+                pending, graph, done, running, packages)
+            if name:
+                pending.remove(name)
+                if previous.get(name) == fingerprints[name] and \
+                        not graph[name] & rebuilt:
+                    lgr.info('Skipping {0}, built by the previous run'.format(
+                        name))
+                    done.add(name)
+                    state['built'][name] = fingerprints[name]
+                else:
+                    lgr.info('Building {0}'.format(name))
+                    running.add(name)
+                    pool.apply_async(_build_package,
+                                     [(name, download, options)],
+                                     callback=results.put)
+                continue
+            if not running:
+                break
+            result = _next_result(results, workers)
+            if result is None:
+                # which of the packages being built the dead process ran is
+                # unknown, so none of them is taken as built.
+                lgr.error('A build process died while building {0}'.format(
+                    sorted(running)))
+                state['failed'] = state['failed'] or sorted(running)[0]
+                pending = sorted(running) + pending
+                died = True
+                break
+            name, error = result
+            running.remove(name)
+            if error:
+                lgr.error('Failed building {0}: {1}'.format(name, error))
+                state['failed'] = state['failed'] or name
+            else:
+                done.add(name)
+                rebuilt.add(name)
+                state['built'][name] = fingerprints[name]
+            _write_build_state(state)
+    finally:
+        # the result of a dead process never comes, so closing the pool
+        # would wait for it forever.
+        if died:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+        _write_build_state(state)
+
+    if state['failed']:
+        lgr.error('Not built: {0}. Run again with --resume to continue from '
+                  '{1}.'.format(pending, state['failed']))
+        sys.exit(1)
+    lgr.info('Built packages: {0}'.format(sorted(rebuilt)))
+    return sorted(rebuilt)
+
+
+def _next_ready(pending, graph, done, running, packages):
+    """returns the first pending package which can be started now
+
+    that is one whose dependencies are done and which doesn't conflict
+    with a package being built.
+    """
+    for name in pending:
+        if graph[name] <= done and not any(
+                _conflicts(packages[name], packages[other])
+                for other in running):
+            return name
+    return None
+
+
+def _next_result(results, workers):
+    """returns the next result of a package build
+
+    returns None once one of the pool's `workers` died, e.g. killed for
+    running out of memory, as the result of the build it ran never comes.
+    workers only exit when the pool is closed.
+    """
+    # waiting with a timeout keeps the wait interruptible.
+    while True:
+        try:
+            return results.get(timeout=1)
+        except Queue.Empty:
+            if any(worker.exitcode is not None for worker in workers):
+                return None
+
+
+def get_ubuntu_precise_agent(download=False, **options):
     package = get_conf('Ubuntu-precise-agent')
-    create_agent(package, download)
+    create_agent(package, download, **options)
 
 
-def get_ubuntu_trusty_agent(download=False):
+def get_ubuntu_trusty_agent(download=False, **options):
     package = get_conf('Ubuntu-trusty-agent')
-    create_agent(package, download)
+    create_agent(package, download, **options)
 
 
-def get_centos_final_agent(download=False):
+def get_centos_final_agent(download=False, **options):
     package = get_conf('centos-Final-agent')
-    create_agent(package, download)
+    create_agent(package, download, **options)
 
 
-def get_debian_jessie_agent(download=False):
+def get_debian_jessie_agent(download=False, **options):
     package = get_conf('debian-jessie-agent')
-    create_agent(package, download)
+    create_agent(package, download, **options)
 
 
-def get_celery(download=False):
+def get_celery(download=False, **options):
     package = get_conf('celery')
+    with _build_report(package['name']):
+        _build_venv(package, install=download, **options)
 
-    dl_handler = retrieve.Handler()
-    common = utils.Handler()
-    py_handler = python.Handler()
-    _prepare(package)
-    py_handler.make_venv(package['sources_path'])
-    tar_file = '{0}/{1}.tar.gz'.format(
-        package['sources_path'], package['name'])
-    for url in package['source_urls']:
-        dl_handler.download(url, file=tar_file)
-    common.untar(package['sources_path'], tar_file)
-    if download:
-        for module in package['modules']:
-            py_handler.pip(module, package['sources_path'])
-
-
-def get_manager(download=False):
+
+def get_manager(download=False, **options):
     package = get_conf('manager')
 
-    dl_handler = retrieve.Handler()
     common = utils.Handler()
-    py_handler = python.Handler()
-    _prepare(package)
-    py_handler.make_venv(package['sources_path'])
-    tar_file = '{0}/{1}.tar.gz'.format(
-        package['sources_path'], package['name'])
-    for url in package['source_urls']:
-        dl_handler.download(url, file=tar_file)
-    common.untar(package['sources_path'], tar_file)
+    with _build_report(package['name']):
+        _build_venv(package, install=download, **options)
+        with _timed('cp resources', 'cp'):
+            common.mkdir(package['file_server_dir'])
+            common.cp(package['resources_path'], package['file_server_dir'])
 
-    common.mkdir(package['file_server_dir'])
-    common.cp(package['resources_path'], package['file_server_dir'])
-    if download:
-        for module in package['modules']:
-            py_handler.pip(module, package['sources_path'])
 
+# packages built by their own function here, by package key.
+BUILDERS = {
+    'Ubuntu-precise-agent': get_ubuntu_precise_agent,
+    'Ubuntu-trusty-agent': get_ubuntu_trusty_agent,
+    'centos-Final-agent': get_centos_final_agent,
+    'debian-jessie-agent': get_debian_jessie_agent,
+    'celery': get_celery,
+    'manager': get_manager,
+}
 
-def main():
 
-    lgr.debug('VALIDATED!')
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Builds Cloudify agents, or packages, in parallel. '
+                    'Without --build, only verifies that this file loads.')
+    parser.add_argument(
+        '-b', '--build', action='store_true',
+        help='Build the agents, or the packages with --graph, wiping their '
+             'previous builds.')
+    parser.add_argument(
+        'agents', nargs='*',
+        help='Agent packages to build (defaults to all agents), or packages '
+             'with --graph.')
+    parser.add_argument(
+        '-d', '--download', action='store_true',
+        help='Download sources and install modules into the agents.')
+    parser.add_argument(
+        '-p', '--processes', type=int,
+        help='Maximum number of agents to build at once.')
+    parser.add_argument(
+        '-i', '--incremental', action='store_true',
+        help='Only rebuild the stages whose inputs changed.')
+    parser.add_argument(
+        '-w', '--wheelhouse', action='store_true',
+        help='Install modules from wheels built once into a shared '
+             'wheelhouse.')
+    parser.add_argument(
+        '-g', '--golden', action='store_true',
+        help='Clone the agents from a golden virtualenv holding the modules '
+             'they have in common.')
+    parser.add_argument(
+        '--graph', action='store_true',
+        help='With --build, build the given packages (defaults to all '
+             'packages) and the packages they depend on, in dependency '
+             'order.')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='With --graph, skip the packages built by the previous run.')
+    args = parser.parse_args(args)
+    if not args.build:
+        lgr.debug('VALIDATED!')
+        return
+    if args.graph:
+        build_packages(args.agents, args.download, args.processes,
+                       args.resume, incremental=args.incremental,
+                       wheelhouse=args.wheelhouse, golden=args.golden)
+        return
+    build_agents(args.agents, args.download, args.processes,
+                 incremental=args.incremental, wheelhouse=args.wheelhouse,
+                 golden=args.golden)
 
 
 if __name__ == '__main__':
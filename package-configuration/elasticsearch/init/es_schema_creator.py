@@ -19,126 +19,718 @@ __author__ = 'ran'
 
 import requests
 import json
+import time
+import argparse
+import datetime
+from threading import Thread
+from contextlib import closing
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 STORAGE_INDEX_URL = "http://localhost:9200/cloudify_storage"
+EVENTS_INDEX_URL = "http://localhost:9200/cloudify_events"
+
+# requests to ES time out after REQUEST_TIMEOUT seconds. failed connections
+# and unavailable responses are retried REQUEST_RETRIES times, waiting
+# REQUEST_BACKOFF seconds before the second retry and twice as long before
+# each next one.
+REQUEST_TIMEOUT = 30
+REQUEST_RETRIES = 5
+REQUEST_BACKOFF = 0.5
+# responses retried as ES is unavailable, and the requests which may be
+# repeated once ES has received them. ES may have carried out a request it
+# answered with a 504, so creating or deleting an index again would fail.
+# other requests are only retried when passed `retry=True`.
+RETRY_STATUSES = (502, 503, 504)
+RETRY_METHODS = ('HEAD', 'GET', 'OPTIONS')
+
+# ES is polled for up to READY_TIMEOUT seconds until the cluster's health
+# is at least READY_STATUS, waiting READY_BACKOFF seconds between the first
+# polls and twice as long between each next ones, up to READY_MAX_DELAY.
+READY_TIMEOUT = 180
+READY_STATUS = 'yellow'
+READY_BACKOFF = 1
+READY_MAX_DELAY = 16
+
+# bump this whenever the schemas or the analysis below change. the version
+# applied to an index is kept in the `_meta` of its mappings.
+SCHEMA_VERSION = 3
+
+# number of documents copied by each scroll and bulk request when
+# reindexing, and how long ES keeps the scroll between them.
+REINDEX_BATCH_SIZE = 500
+REINDEX_SCROLL = '5m'
+# times an index created before versioning is deleted before giving up on
+# adding the alias replacing it (see `replace_with_alias`).
+REPLACE_ATTEMPTS = 3
+
+# index settings of each performance profile. the number of shards is only
+# set when an index is created, the rest can be switched at any time.
+INDEX_PROFILES = {
+    # a manager on a single machine: no replicas to allocate, and less
+    # frequent refreshes and flushes during bursts of workflow events.
+    'single-node': {
+        'number_of_shards': 1,
+        'number_of_replicas': 0,
+        'refresh_interval': '5s',
+        'translog.flush_threshold_size': '512mb',
+    },
+    # loading or reindexing lots of documents, searched later.
+    'bulk-ingest': {
+        'number_of_shards': 1,
+        'number_of_replicas': 0,
+        'refresh_interval': '30s',
+        'translog.flush_threshold_size': '1gb',
+    },
+    # a cluster of managers, keeping a copy of each shard on another node.
+    'ha': {
+        'number_of_shards': 3,
+        'number_of_replicas': 1,
+        'refresh_interval': '1s',
+        'translog.flush_threshold_size': '200mb',
+    },
+}
+DEFAULT_PROFILE = 'single-node'
+STATIC_SETTINGS = ('number_of_shards',)
+
+# the storage and events indices are tokenized on whitespace only.
+ANALYSIS = {'analyzer': {'default': {'tokenizer': 'whitespace'}}}
+# logstash writes the events of each day to `<index>-<day>`, which are read
+# through an `<index>` alias. ES 1.x can't roll indices over by size.
+EVENTS_INDEX_DATE_FORMAT = '%Y.%m.%d'
+# the retention of events indices, in days, by default.
+EVENTS_CLOSE_AFTER_DAYS = 30
+EVENTS_DELETE_AFTER_DAYS = 90
+
+# field types of the compact mappings passed to `build_mapping`, besides
+# ES' own types.
+FIELD_TYPES = {
+    # ids and names, only matched as a whole.
+    'keyword': {'type': 'string', 'index': 'not_analyzed'},
+    'text': {'type': 'string'},
+}
+
+
+def build_mapping(fields):
+    """Builds the mapping of an object from a compact allow-list of fields
+
+    Each field maps to a type from FIELD_TYPES or ES', to a dict of the
+    fields of an object, or to None for a subtree which isn't even parsed.
+    Fields left out are kept in the document but aren't indexed.
+    """
+    properties = {}
+    for name, field in fields.items():
+        if field is None:
+            properties[name] = {'enabled': False}
+        elif isinstance(field, dict):
+            properties[name] = build_mapping(field)
+        else:
+            properties[name] = dict(FIELD_TYPES.get(field, {'type': field}))
+    return {'dynamic': False, 'properties': properties}
+
+
+# the parts of a deployment's plan which are searched, so that nodes can be
+# looked up by type or host without loading whole plans. the subtrees
+# listed as None are large.
+DEPLOYMENT_PLAN_FIELDS = {
+    'name': 'keyword',
+    'nodes': {
+        'id': 'keyword',
+        'name': 'keyword',
+        'type': 'keyword',
+        'host_id': 'keyword',
+        'instances': {'deploy': 'long'},
+        'properties': None,
+        'operations': None,
+        'plugins': None,
+        'plugins_to_install': None,
+        'deployment_plugins_to_install': None,
+        'relationships': None,
+        'workflows': None,
+    },
+    'relationships': None,
+    'deployment_plugins_to_install': None,
+    'workflows': None,
+}
 
 BLUEPRINT_SCHEMA = {'mappings': {'blueprint': {'properties': {'plan': {'enabled': False}}}}}
 
-DEPLOYMENT_SCHEMA = {'mappings': {'deployment': {'properties': {'plan': {'enabled': False}}}}}
-
-# DEPLOYMENT_SCHEMA = {
-#     'deployment': {
-#         'properties': {
-#             'plan': {
-#                 'properties': {
-#                     'relationships': {
-#                         'enabled': False
-#                     },
-#                     'name': {
-#                         'enabled': True
-#                     },
-#                     'deployment_plugins_to_install': {
-#                         'enabled': False
-#                     },
-#                     'workflows': {
-#                         'enabled': False
-#                     },
-#                     'nodes': {
-#                         'enabled': False
-#                         # 'properties': {
-#                         #     'operations': {
-#                         #         'enabled': True
-#                         #     },
-#                         #     'plugins': {
-#                         #         'enabled': True
-#                         #     },
-#                         #     'declared_type': {
-#                         #         'enabled': True
-#                         #     },
-#                         #     'name': {
-#                         #         'enabled': True
-#                         #     },
-#                         #     'dependents': {
-#                         #         'enabled': True
-#                         #     },
-#                         #     'id': {
-#                         #         'enabled': True
-#                         #     },
-#                         #     'type': {
-#                         #         'enabled': True
-#                         #     },
-#                         #     'host_id': {
-#                         #         'enabled': True
-#                         #     },
-#                         #     'instances': {
-#                         #         'enabled': True
-#                         #     },
-#                         #     'plugins_to_install': {
-#                         #         'enabled': False
-#                         #     },
-#                         #     'deployment_plugins_to_install': {
-#                         #         'enabled': False
-#                         #     },
-#                         #     'workflows': {
-#                         #         'enabled': False
-#                         #     },
-#                         #     'properties': {
-#                         #         'enabled': False
-#                         #     },
-#                         #     'relationships': {
-#                         #         'properties': {
-#                         #             'source_operations': {
-#                         #                 'enabled': False
-#                         #             },
-#                         #             'target_operations': {
-#                         #                 'enabled': False
-#                         #             },
-#                         #             'source_interfaces': {
-#                         #                 'enabled': False
-#                         #             },
-#                         #             'target_interfaces': {
-#                         #                 'enabled': False
-#                         #             },
-#                         #             'workflows': {
-#                         #                 'enabled': False
-#                         #             },
-#                         #             'target_id': {
-#                         #                 'enabled': True
-#                         #             },
-#                         #             'type': {
-#                         #                 'enabled': True
-#                         #             }
-#                         #         }
-#                         #     }
-#                         # }
-#                     }
-#                 }
-#             }
-#         }
-#     }
-# }
-
-
-def create_schema(storage_index_url):
-    #delete index if already exist
-    response = requests.head(storage_index_url)
-    if response.status_code == 200:
-        response = requests.delete(storage_index_url)
+DEPLOYMENT_SCHEMA = {'mappings': {'deployment': {'properties': {
+    'plan': build_mapping(DEPLOYMENT_PLAN_FIELDS),
+    'workflows': {'enabled': False},
+    'inputs': {'enabled': False},
+    'outputs': {'enabled': False},
+    'groups': {'enabled': False},
+    'policy_type': {'enabled': False},
+    'policy_triggers': {'enabled': False}}}}}
+
+# nodes are looked up by id, and by any of their types.
+NODE_SCHEMA = {'mappings': {'node': {'_id': {'path': 'id'}, 'properties': {
+    'types': {'type': 'string', 'index_name': 'type'},
+    'properties': {'enabled': False},
+    'operations': {'enabled': False},
+    'relationships': {'enabled': False}}}}}
+
+NODE_INSTANCE_SCHEMA = {'mappings': {'node_instance': {'_id': {'path': 'id'}, 'properties': {
+    'runtime_properties': {'enabled': False}}}}}
+
+DEPLOYMENT_MODIFICATION_SCHEMA = {'mappings': {'deployment_modification': {'_id': {'path': 'id'}, 'properties': {
+    'modified_nodes': {'enabled': False},
+    'node_instances': {'enabled': False},
+    'context': {'enabled': False}}}}}
+
+SCHEMAS = [BLUEPRINT_SCHEMA, DEPLOYMENT_SCHEMA, NODE_SCHEMA,
+           NODE_INSTANCE_SCHEMA, DEPLOYMENT_MODIFICATION_SCHEMA]
+
+# values ES assumes for mapping parameters which are left out.
+MAPPING_DEFAULTS = {'type': 'object', 'enabled': True, 'dynamic': True,
+                    'index': 'analyzed'}
+# mapping parameters which can be changed in place.
+UPDATABLE_PARAMETERS = ('dynamic',)
+# parameters of a document type, besides its fields, which can only be
+# changed by reindexing.
+ROOT_PARAMETERS = ('_id',)
+
+
+class SchemaMigrationError(Exception):
+    pass
+
+
+class ElasticsearchSession(requests.Session):
+    """A keep-alive session to ES, timing out and retrying its requests
+
+    Only requests which can be repeated safely, or passed `retry=True`,
+    are retried once ES has received them, others only when they couldn't
+    connect. Once out of retries, the last response is returned. Sessions
+    aren't thread safe, so each thread uses its own `clone`.
+    """
+    def __init__(self, timeout=REQUEST_TIMEOUT, retries=REQUEST_RETRIES,
+                 backoff=REQUEST_BACKOFF):
+        super(ElasticsearchSession, self).__init__()
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        # the adapter only retries connecting. the urllib3 bundled with
+        # requests before 2.10 can't return the last response once out of
+        # retries, so unavailable responses are retried by `request`.
+        adapter = HTTPAdapter(max_retries=Retry(
+            total=retries, read=0, backoff_factor=backoff))
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        repeatable = kwargs.pop('retry', method.upper() in RETRY_METHODS)
+        for retry in range(self.retries + 1):
+            if retry > 1:
+                time.sleep(self.backoff * 2 ** (retry - 2))
+            response = super(ElasticsearchSession, self).request(
+                method, url, *args, **kwargs)
+            if response.status_code not in RETRY_STATUSES or not repeatable:
+                break
+        return response
+
+    def clone(self):
+        return ElasticsearchSession(self.timeout, self.retries, self.backoff)
+
+
+def wait_for_cluster(session, es_url, status=READY_STATUS,
+                     timeout=READY_TIMEOUT):
+    """Waits for the cluster's health to be at least `status`"""
+    deadline = time.time() + timeout
+    delay = READY_BACKOFF
+    while True:
+        try:
+            response = session.get(
+                '{0}/_cluster/health'.format(es_url),
+                params={'wait_for_status': status, 'timeout': '1s'})
+            if response.status_code == 200 and \
+                    not response.json().get('timed_out'):
+                return
+            reason = response.text
+        except requests.RequestException as ex:
+            reason = str(ex)
+        if time.time() + delay > deadline:
+            raise SchemaMigrationError(
+                'Elasticsearch at {0} is not {1} after {2} seconds: '
+                '{3}'.format(es_url, status, timeout, reason))
+        print 'Waiting for elasticsearch at {0}...'.format(es_url)
+        time.sleep(delay)
+        delay = min(delay * 2, READY_MAX_DELAY)
+
+
+def get_mappings():
+    """Returns the mapping of each document type, stamped with SCHEMA_VERSION
+    """
+    mappings = {}
+    for schema in SCHEMAS:
+        for doc_type, mapping in schema['mappings'].items():
+            mappings[doc_type] = dict(
+                mapping, _meta={'schema_version': SCHEMA_VERSION})
+    return mappings
+
+
+def diff_mapping(current, wanted, path=''):
+    """Compares the fields of two mappings
+
+    Returns the paths of the fields of `wanted` missing from `current`, or
+    only differing in UPDATABLE_PARAMETERS, which can be updated in place,
+    and of the fields mapped differently in both, which can only be changed
+    by reindexing.
+    """
+    added, changed = [], []
+    current_fields = current.get('properties', {})
+    for name, field in wanted.get('properties', {}).items():
+        field_path = path + name
+        existing = current_fields.get(name)
+        if existing is None:
+            added.append(field_path)
+            continue
+        differing = [key for key, value in field.items()
+                     if key != 'properties' and not _same_parameter(
+                         existing.get(key, MAPPING_DEFAULTS.get(key)), value)]
+        if any(key not in UPDATABLE_PARAMETERS for key in differing):
+            changed.append(field_path)
+            continue
+        if differing:
+            added.append(field_path)
+        if 'properties' in field:
+            if existing.get('type', 'object') != 'object' or \
+                    _same_parameter(existing.get('enabled', True), False):
+                changed.append(field_path)
+                continue
+            field_added, field_changed = diff_mapping(
+                existing, field, field_path + '.')
+            added.extend(field_added)
+            changed.extend(field_changed)
+    return added, changed
+
+
+def _same_parameter(current, wanted):
+    # ES returns some booleans, such as `dynamic`, as strings.
+    return str(current).lower() == str(wanted).lower()
+
+
+def get_settings(profile, dynamic=False):
+    """Returns the index settings of `profile`, only the dynamic ones if
+    `dynamic`
+    """
+    if profile not in INDEX_PROFILES:
+        raise SchemaMigrationError('Unknown index profile: {0}.'.format(
+            profile))
+    return dict((key, value) for key, value in INDEX_PROFILES[profile].items()
+                if not (dynamic and key in STATIC_SETTINGS))
+
+
+def apply_profile(session, index_url, profile):
+    """Switches the settings of an existing index to those of `profile`
+
+    Its number of shards is kept, until the index is next reindexed.
+    """
+    response = session.put('{0}/_settings'.format(index_url),
+                           json.dumps({'index': get_settings(profile, True)}),
+                           retry=True)
+    response.raise_for_status()
+
+
+def block_writes(session, index_url, blocked=True):
+    """Rejects writes to an existing index, or accepts them again"""
+    response = session.put('{0}/_settings'.format(index_url),
+                           json.dumps({'index': {'blocks.write': blocked}}),
+                           retry=True)
+    response.raise_for_status()
+
+
+def get_schema_version(mappings):
+    """Returns the schema version applied to all document types, 0 if none
+    """
+    return min(mappings.get(doc_type, {}).get('_meta', {}).get(
+        'schema_version', 0) for doc_type in get_mappings())
+
+
+def create_index(session, es_url, index, alias=None, settings=None):
+    response = session.put('{0}/{1}'.format(es_url, index), json.dumps({
+        'settings': {'index': dict(settings or get_settings(DEFAULT_PROFILE),
+                                   analysis=ANALYSIS)},
+        'mappings': get_mappings()}))
+    response.raise_for_status()
+    if alias:
+        update_aliases(session, es_url,
+                       [{'add': {'index': index, 'alias': alias}}])
+
+
+def update_aliases(session, es_url, actions):
+    """Applies all alias `actions` atomically"""
+    response = session.post('{0}/_aliases'.format(es_url),
+                            json.dumps({'actions': actions}))
+    response.raise_for_status()
+
+
+def reindex(session, es_url, source, target):
+    """Copies all documents of the `source` index to the `target` one
+
+    ES 1.x has no reindex API, so documents are scrolled out of `source`
+    and bulk indexed into `target`. Returns the number of documents copied.
+    """
+    response = session.post(
+        '{0}/{1}/_search?search_type=scan&scroll={2}'.format(
+            es_url, source, REINDEX_SCROLL),
+        json.dumps({'query': {'match_all': {}}, 'size': REINDEX_BATCH_SIZE}))
+    response.raise_for_status()
+    result = response.json()
+    copied = 0
+    # a scan returns no hits, only a scroll to fetch them from.
+    hits = result['hits']['hits']
+    while True:
+        if hits:
+            bulk_index(session, es_url, target, hits)
+            copied += len(hits)
+        response = session.post('{0}/_search/scroll?scroll={1}'.format(
+            es_url, REINDEX_SCROLL), result['_scroll_id'])
         response.raise_for_status()
+        result = response.json()
+        hits = result['hits']['hits']
+        if not hits:
+            return copied
+
 
-    #create index
-    response = requests.post(storage_index_url, data={})
+def bulk_index(session, es_url, index, hits):
+    lines = []
+    for hit in hits:
+        lines.append(json.dumps({'index': {
+            '_index': index, '_type': hit['_type'], '_id': hit['_id']}}))
+        lines.append(json.dumps(hit['_source']))
+    response = session.post('{0}/_bulk'.format(es_url),
+                            '\n'.join(lines) + '\n')
     response.raise_for_status()
+    if response.json().get('errors'):
+        raise SchemaMigrationError(
+            'Failed indexing documents into {0}.'.format(index))
+
+
+def put_mappings(session, es_url, index, mappings, concurrent=True):
+    """Puts the mapping of each document type, all at once if `concurrent`
+
+    Concurrent mappings are put by threads with their own clone of
+    `session`.
+    """
+    errors = []
 
-    #set mappings
-    response = requests.put("{0}/blueprint/_mapping".format(
-        storage_index_url), json.dumps(BLUEPRINT_SCHEMA))
+    def put_mapping(session, doc_type, mapping):
+        try:
+            response = session.put('{0}/{1}/{2}/_mapping'.format(
+                es_url, index, doc_type), json.dumps({doc_type: mapping}),
+                retry=True)
+            response.raise_for_status()
+        except Exception as ex:
+            errors.append(ex)
+
+    def put_mapping_concurrently(doc_type, mapping):
+        with closing(session.clone()) as thread_session:
+            put_mapping(thread_session, doc_type, mapping)
+
+    if not concurrent:
+        for doc_type, mapping in mappings.items():
+            put_mapping(session, doc_type, mapping)
+    else:
+        threads = [Thread(target=put_mapping_concurrently, args=item)
+                   for item in mappings.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+
+def create_schema(storage_index_url, session=None, concurrent=True,
+                  profile=DEFAULT_PROFILE):
+    """Brings the storage index up to date with the schemas, keeping its data
+
+    A new index is created as `<index>_v<SCHEMA_VERSION>` behind an
+    `<index>` alias. For an existing index, fields which are missing are
+    added to its mappings in place. Fields mapped differently, the `_id` of
+    a document type and the analysis can't be changed in place, so the documents are reindexed into a new versioned
+    index and the alias is then swapped over to it, leaving the old index
+    to be dropped once it's no longer needed. An index created before
+    versioning is named like the alias and is replaced with it instead,
+    see `replace_with_alias`. Writes to the old index are blocked while
+    its documents are copied, so they fail rather than being lost when
+    the alias is swapped. They are accepted again if reindexing fails.
+
+    ES is waited for first, and all requests share one keep-alive
+    `session`. Mappings are put concurrently, unless `concurrent` is False.
+    New indices get the settings of `profile`. Reindexing is done without
+    refreshes or replicas, which are only set once it's done.
+    """
+    session = session or ElasticsearchSession()
+    es_url, alias = storage_index_url.rsplit('/', 1)
+    wanted = get_mappings()
+    settings = get_settings(profile)
+
+    wait_for_cluster(session, es_url)
+    response = session.get('{0}/_mapping'.format(storage_index_url))
+    if response.status_code == 404:
+        index = '{0}_v{1}'.format(alias, SCHEMA_VERSION)
+        create_index(session, es_url, index, alias, settings)
+        print 'Created elasticsearch storage index {0}.'.format(index)
+        return
     response.raise_for_status()
-    response = requests.put("{0}/deployment/_mapping".format(
-        storage_index_url), json.dumps(DEPLOYMENT_SCHEMA))
+    (index, current), = response.json().items()
+    current = current.get('mappings', {})
+
+    version = get_schema_version(current)
+    if version > SCHEMA_VERSION:
+        raise SchemaMigrationError(
+            'Storage index {0} has schema version {1}, newer than {2}.'.format(
+                index, version, SCHEMA_VERSION))
+    added, changed = [], []
+    for doc_type, mapping in wanted.items():
+        type_added, type_changed = diff_mapping(
+            current.get(doc_type, {}), mapping, doc_type + '.')
+        added.extend(type_added)
+        changed.extend(type_changed)
+        if doc_type in current:
+            changed.extend(
+                '{0}.{1}'.format(doc_type, key) for key in ROOT_PARAMETERS
+                if current[doc_type].get(key) != mapping.get(key))
+    # an index's analysis can't be changed while it's open.
+    response = session.get('{0}/{1}/_settings'.format(es_url, index))
     response.raise_for_status()
-    print 'Done creating elasticsearch storage schema.'
+    if response.json()[index]['settings']['index'].get('analysis') != \
+            ANALYSIS:
+        changed.append('analysis')
+    if version == SCHEMA_VERSION and not (added or changed):
+        print 'Elasticsearch storage schema is up to date.'
+        return
+
+    if not changed:
+        put_mappings(session, es_url, index, wanted, concurrent)
+        print 'Updated elasticsearch storage schema of {0} from version ' \
+              '{1} to {2}.'.format(index, version, SCHEMA_VERSION)
+        return
+
+    new_index = '{0}_v{1}'.format(alias, SCHEMA_VERSION)
+    if new_index == index:
+        raise SchemaMigrationError(
+            'Fields changed without bumping the schema version: {0}.'.format(
+                ', '.join(changed)))
+    # leftovers of a migration which failed midway.
+    new_index_url = '{0}/{1}'.format(es_url, new_index)
+    if session.head(new_index_url).status_code == 200:
+        session.delete(new_index_url).raise_for_status()
+    create_index(session, es_url, new_index, settings=dict(
+        settings, refresh_interval='-1', number_of_replicas=0))
+    index_url = '{0}/{1}'.format(es_url, index)
+    block_writes(session, index_url)
+    try:
+        copied = reindex(session, es_url, index, new_index)
+        apply_profile(session, new_index_url, profile)
+        if index != alias:
+            update_aliases(session, es_url, [
+                {'remove': {'index': index, 'alias': alias}},
+                {'add': {'index': new_index, 'alias': alias}}])
+    except Exception:
+        block_writes(session, index_url, False)
+        raise
+    if index == alias:
+        copied += replace_with_alias(session, es_url, alias, new_index)
+    else:
+        print 'Index {0} is no longer used and may be deleted.'.format(index)
+    print 'Reindexed {0} documents from {1} to {2} for changed fields: ' \
+          '{3}.'.format(copied, index, new_index, ', '.join(changed))
+
+
+def replace_with_alias(session, es_url, alias, index):
+    """Deletes the `alias` index and adds an `alias` alias to `index`
+
+    ES can't alias over an index, nor delete one and add an alias in a
+    single request. A write between both auto-creates an `alias` index
+    again, which the alias can't be added over. The documents written to
+    it are then moved to `index` too, and both are tried again, up to
+    REPLACE_ATTEMPTS times. Returns the number of documents moved.
+    """
+    alias_url = '{0}/{1}'.format(es_url, alias)
+    moved = 0
+    for attempt in range(REPLACE_ATTEMPTS):
+        if attempt:
+            block_writes(session, alias_url)
+            moved += reindex(session, es_url, alias, index)
+        session.delete(alias_url).raise_for_status()
+        response = session.post('{0}/_aliases'.format(es_url), json.dumps(
+            {'actions': [{'add': {'index': index, 'alias': alias}}]}))
+        if 'InvalidAliasNameException' not in response.text:
+            response.raise_for_status()
+            return moved
+        print 'Index {0} was created again before it could be aliased ' \
+              'to {1}.'.format(alias, index)
+    raise SchemaMigrationError(
+        'Could not replace index {0} with an alias to {1}, as it kept being '
+        'created again.'.format(alias, index))
+
+
+def get_events_index(alias, day):
+    """Returns the name of the events index of `day`, as named by logstash
+    """
+    return '{0}-{1}'.format(alias, day.strftime(EVENTS_INDEX_DATE_FORMAT))
+
+
+def get_events_indices(session, es_url, alias):
+    """Returns the day, state and aliases of each daily events index"""
+    response = session.get('{0}/_cluster/state/metadata'.format(es_url))
+    response.raise_for_status()
+    indices = {}
+    for index, metadata in response.json()['metadata']['indices'].items():
+        if not index.startswith(alias + '-'):
+            continue
+        try:
+            day = datetime.datetime.strptime(
+                index[len(alias) + 1:], EVENTS_INDEX_DATE_FORMAT).date()
+        except ValueError:
+            continue
+        indices[index] = (day, metadata.get('state', 'open'),
+                          metadata.get('aliases', []))
+    return indices
+
+
+def put_events_template(session, es_url, alias, profile=DEFAULT_PROFILE):
+    """Puts the template of the daily events indices
+
+    Indices created by logstash get the settings of `profile` and are
+    added to the `alias` events are read from.
+    """
+    response = session.put('{0}/_template/{1}'.format(es_url, alias),
+                           json.dumps({
+                               'template': '{0}-*'.format(alias),
+                               'settings': {'index': dict(
+                                   get_settings(profile),
+                                   analysis=ANALYSIS)},
+                               'aliases': {alias: {}}}), retry=True)
+    response.raise_for_status()
+
+
+def create_events_template(events_index_url, session=None,
+                           profile=DEFAULT_PROFILE, today=None):
+    """Sets up daily events indices behind an `<index>` read alias
+
+    Logstash writes the events of each day to an `<index>-YYYY.MM.dd` index
+    created from the template. An events index created before is named
+    like the alias, so its events are moved to today's index first.
+    """
+    session = session or ElasticsearchSession()
+    es_url, alias = events_index_url.rsplit('/', 1)
+    today = today or datetime.datetime.utcnow().date()
+    response = session.get('{0}/_settings'.format(events_index_url))
+    if response.status_code != 404:
+        response.raise_for_status()
+    if alias in response.json():
+        index = get_events_index(alias, today)
+        index_url = '{0}/{1}'.format(es_url, index)
+        # the template would alias today's index before the old one is gone.
+        session.delete('{0}/_template/{1}'.format(es_url, alias))
+        if session.head(index_url).status_code != 200:
+            response = session.put(index_url, json.dumps({'settings': {
+                'index': dict(get_settings(profile), analysis=ANALYSIS,
+                              refresh_interval='-1', number_of_replicas=0)}}))
+            response.raise_for_status()
+        copied = reindex(session, es_url, alias, index)
+        apply_profile(session, index_url, profile)
+        session.delete(events_index_url).raise_for_status()
+        print 'Moved {0} events from {1} to {2}.'.format(copied, alias, index)
+    put_events_template(session, es_url, alias, profile)
+    expire_events(events_index_url, session, None, None, today)
+    print 'Installed elasticsearch events index template.'
+
+
+def expire_events(events_index_url, session=None,
+                  close_after=EVENTS_CLOSE_AFTER_DAYS,
+                  delete_after=EVENTS_DELETE_AFTER_DAYS, today=None):
+    """Closes and deletes the daily events indices past their retention
+
+    Indices `close_after` days old are taken out of the read alias and
+    closed, so they no longer use memory but can be reopened. Indices
+    `delete_after` days old are deleted. Either can be None to keep them.
+    Open indices missing from the alias, as the templates of ES 1.0 can't
+    add them, are added to it.
+    """
+    session = session or ElasticsearchSession()
+    es_url, alias = events_index_url.rsplit('/', 1)
+    today = today or datetime.datetime.utcnow().date()
+    actions, closed, deleted = [], [], []
+    for index, (day, state, aliases) in sorted(
+            get_events_indices(session, es_url, alias).items()):
+        age = (today - day).days
+        if delete_after is not None and age >= delete_after:
+            deleted.append(index)
+        elif close_after is not None and age >= close_after:
+            if alias in aliases:
+                actions.append({'remove': {'index': index, 'alias': alias}})
+            if state == 'open':
+                closed.append(index)
+        elif state == 'open' and alias not in aliases:
+            actions.append({'add': {'index': index, 'alias': alias}})
+    if actions:
+        update_aliases(session, es_url, actions)
+    for index in closed:
+        session.post('{0}/{1}/_close'.format(es_url, index)).raise_for_status()
+    for index in deleted:
+        session.delete('{0}/{1}'.format(es_url, index)).raise_for_status()
+    if closed or deleted:
+        print 'Closed {0} and deleted {1} events indices.'.format(
+            len(closed), len(deleted))
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description='Creates or migrates the elasticsearch indices of '
+                    'the Cloudify manager.')
+    parser.add_argument(
+        '--profile', choices=sorted(INDEX_PROFILES), default=DEFAULT_PROFILE,
+        help='Index settings profile (defaults to "{0}").'.format(
+            DEFAULT_PROFILE))
+    parser.add_argument(
+        '--switch-profile', action='store_true',
+        help='Only switch the settings of the existing indices to --profile.')
+    parser.add_argument(
+        '--expire-events', action='store_true',
+        help='Only close and delete the events indices past their '
+             'retention. Meant to run daily.')
+    parser.add_argument(
+        '--close-after', type=int, default=EVENTS_CLOSE_AFTER_DAYS,
+        metavar='DAYS',
+        help='Close events indices this many days old (defaults to '
+             '{0}).'.format(EVENTS_CLOSE_AFTER_DAYS))
+    parser.add_argument(
+        '--delete-after', type=int, default=EVENTS_DELETE_AFTER_DAYS,
+        metavar='DAYS',
+        help='Delete events indices this many days old (defaults to '
+             '{0}).'.format(EVENTS_DELETE_AFTER_DAYS))
+    parser.add_argument('--storage-index-url', default=STORAGE_INDEX_URL)
+    parser.add_argument('--events-index-url', default=EVENTS_INDEX_URL)
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    session = ElasticsearchSession()
+    es_url, events_alias = args.events_index_url.rsplit('/', 1)
+    if args.switch_profile or args.expire_events:
+        wait_for_cluster(session, es_url)
+    if args.switch_profile:
+        put_events_template(session, es_url, events_alias, args.profile)
+        for index_url in (args.storage_index_url, args.events_index_url):
+            # there are no events indices until logstash creates one.
+            if session.head(index_url).status_code == 200:
+                apply_profile(session, index_url, args.profile)
+        print 'Switched elasticsearch indices to the {0} profile.'.format(
+            args.profile)
+    elif args.expire_events:
+        expire_events(args.events_index_url, session, args.close_after,
+                      args.delete_after)
+    else:
+        create_schema(args.storage_index_url, session, profile=args.profile)
+        create_events_template(args.events_index_url, session, args.profile)
 
 
 if __name__ == '__main__':
-    create_schema(STORAGE_INDEX_URL)
+    main()
@@ -0,0 +1,771 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+import testtools
+import BaseHTTPServer
+import SocketServer
+import copy
+import datetime
+import fnmatch
+import json
+import threading
+import itertools
+
+import mock
+import requests
+
+import es_schema_creator
+
+# path segments naming a request rather than an index, type or template.
+ROUTE_WORDS = ('health', 'state', 'metadata', 'scroll')
+
+
+class ElasticsearchHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """An in-memory stand-in for the parts of Elasticsearch 1.x in use
+
+    The server's `indices` map index names to their `settings`, `mappings`,
+    `docs` and `state`, its `aliases` map alias names to lists of index
+    names, its `templates` map template names to their bodies and its
+    `calls` record the method and path of each request. Its `health` is
+    reported as the cluster's status, and its `failures` map a method and
+    path to the number of times to answer them with a 503 first.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, status, body=None):
+        content = json.dumps(body) if body is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+
+    def _missing(self, name):
+        self._respond(404, {'error': 'IndexMissingException[[{0}] '
+                                     'missing]'.format(name), 'status': 404})
+
+    def _resolve(self, name):
+        return self.server.aliases.get(name) or \
+            ([name] if name in self.server.indices else [])
+
+    def _handle(self):
+        path, _, query = self.path.partition('?')
+        parts = [part for part in path.split('/') if part]
+        length = int(self.headers.getheader('Content-Length') or 0)
+        body = self.rfile.read(length)
+        self.server.calls.append((self.command, path))
+        if self.server.failures.get((self.command, path)):
+            self.server.failures[(self.command, path)] -= 1
+            self._respond(503, {'error': 'Unavailable', 'status': 503})
+            return
+        # names are replaced by x, e.g. PUT /<index>/<type>/_mapping is
+        # handled by _put_x_x__mapping and GET /_cluster/health by
+        # _get__cluster_health.
+        handler = getattr(self, '_{0}_{1}'.format(
+            self.command.lower(), '_'.join(
+                part if part.startswith('_') or part in ROUTE_WORDS else 'x'
+                for part in parts)), None)
+        if not handler:
+            self._respond(400, {'error': 'Unsupported request', 'status': 400})
+            return
+        handler(parts, query, body)
+
+    do_HEAD = do_GET = do_PUT = do_POST = do_DELETE = _handle
+
+    def _get__cluster_health(self, parts, query, body):
+        status = self.server.health
+        self._respond(200, {'status': status,
+                            'timed_out': status not in ('yellow', 'green')})
+
+    def _get__cluster_state_metadata(self, parts, query, body):
+        indices = {}
+        for name, index in self.server.indices.items():
+            indices[name] = {
+                'state': index['state'],
+                'aliases': sorted(alias for alias, names in
+                                  self.server.aliases.items()
+                                  if name in names)}
+        self._respond(200, {'metadata': {'indices': indices}})
+
+    def _head_x(self, parts, query, body):
+        if self._resolve(parts[0]):
+            self._respond(200)
+        else:
+            self._missing(parts[0])
+
+    def _put_x(self, parts, query, body):
+        name = parts[0]
+        if self._resolve(name):
+            self._respond(400, {'error': 'IndexAlreadyExistsException',
+                                'status': 400})
+            return
+        body = json.loads(body or '{}')
+        settings = {'index': {}}
+        for template in self.server.templates.values():
+            if fnmatch.fnmatch(name, template['template']):
+                settings['index'].update(template['settings']['index'])
+                for alias in template.get('aliases', {}):
+                    self.server.aliases.setdefault(alias, []).append(name)
+        settings['index'].update(body.get('settings', {}).get('index', {}))
+        self.server.indices[name] = {
+            'settings': settings,
+            'mappings': body.get('mappings', {}),
+            'docs': {},
+            'state': 'open'}
+        self._respond(200, {'acknowledged': True})
+
+    _post_x = _put_x
+
+    def _delete_x(self, parts, query, body):
+        if parts[0] not in self.server.indices:
+            self._missing(parts[0])
+            return
+        del self.server.indices[parts[0]]
+        for alias, names in self.server.aliases.items():
+            if parts[0] in names:
+                names.remove(parts[0])
+            if not names:
+                del self.server.aliases[alias]
+        self._respond(200, {'acknowledged': True})
+
+    def _post_x__close(self, parts, query, body):
+        if parts[0] not in self.server.indices:
+            self._missing(parts[0])
+            return
+        self.server.indices[parts[0]]['state'] = 'close'
+        self._respond(200, {'acknowledged': True})
+
+    def _put__template_x(self, parts, query, body):
+        self.server.templates[parts[1]] = json.loads(body)
+        self._respond(200, {'acknowledged': True})
+
+    def _delete__template_x(self, parts, query, body):
+        if self.server.templates.pop(parts[1], None) is None:
+            self._respond(404, {'status': 404})
+        else:
+            self._respond(200, {'acknowledged': True})
+
+    def _get_x__settings(self, parts, query, body):
+        indices = self._resolve(parts[0])
+        if not indices:
+            self._missing(parts[0])
+            return
+        self._respond(200, dict(
+            (index, {'settings': self.server.indices[index]['settings']})
+            for index in indices))
+
+    def _put_x__settings(self, parts, query, body):
+        indices = self._resolve(parts[0])
+        if not indices:
+            self._missing(parts[0])
+            return
+        settings = json.loads(body)['index']
+        if 'number_of_shards' in settings:
+            self._respond(400, {'error': 'Can\'t change the number of shards',
+                                'status': 400})
+            return
+        for index in indices:
+            self.server.indices[index]['settings']['index'].update(settings)
+        self._respond(200, {'acknowledged': True})
+
+    def _get_x__mapping(self, parts, query, body):
+        indices = self._resolve(parts[0])
+        if not indices:
+            self._missing(parts[0])
+            return
+        self._respond(200, dict(
+            (index, {'mappings': self.server.indices[index]['mappings']})
+            for index in indices))
+
+    def _put_x_x__mapping(self, parts, query, body):
+        indices = self._resolve(parts[0])
+        if not indices:
+            self._missing(parts[0])
+            return
+        mappings = self.server.indices[indices[0]]['mappings']
+        mapping = json.loads(body)[parts[1]]
+        merged = copy.deepcopy(mappings.get(parts[1], {}))
+        if not merge_mapping(merged, mapping):
+            self._respond(400, {'error': 'MergeMappingException',
+                                'status': 400})
+            return
+        mappings[parts[1]] = merged
+        self._respond(200, {'acknowledged': True})
+
+    def _post__aliases(self, parts, query, body):
+        actions = json.loads(body)['actions']
+        for action in actions:
+            (kind, spec), = action.items()
+            if kind == 'add' and spec['alias'] in self.server.indices:
+                self._respond(400, {
+                    'error': 'InvalidAliasNameException[[{0}] an index exists '
+                             'with the same name as the alias]'.format(
+                                 spec['alias']), 'status': 400})
+                return
+        for action in actions:
+            (kind, spec), = action.items()
+            names = self.server.aliases.setdefault(spec['alias'], [])
+            if kind == 'add' and spec['index'] not in names:
+                names.append(spec['index'])
+            elif kind == 'remove' and spec['index'] in names:
+                names.remove(spec['index'])
+            if not names:
+                del self.server.aliases[spec['alias']]
+        self._respond(200, {'acknowledged': True})
+
+    def _post_x__search(self, parts, query, body):
+        indices = self._resolve(parts[0])
+        if not indices:
+            self._missing(parts[0])
+            return
+        hits = [{'_index': index, '_type': doc_type, '_id': doc_id,
+                 '_source': source} for index in indices
+                for (doc_type, doc_id), source in
+                sorted(self.server.indices[index]['docs'].items())]
+        size = json.loads(body).get('size', 10)
+        scroll_id = str(next(self.server.scroll_ids))
+        self.server.scrolls[scroll_id] = [
+            hits[i:i + size] for i in range(0, len(hits), size)]
+        self._respond(200, {'_scroll_id': scroll_id,
+                            'hits': {'total': len(hits), 'hits': []}})
+
+    def _post__search_scroll(self, parts, query, body):
+        batches = self.server.scrolls[body]
+        self._respond(200, {'_scroll_id': body, 'hits': {
+            'total': 0, 'hits': batches.pop(0) if batches else []}})
+
+    def _post__bulk(self, parts, query, body):
+        lines = body.splitlines()
+        for action, source in zip(lines[::2], lines[1::2]):
+            spec = json.loads(action)['index']
+            self.server.indices[spec['_index']]['docs'][
+                (spec['_type'], spec['_id'])] = json.loads(source)
+        self._respond(200, {'errors': False, 'items': []})
+
+
+class ElasticsearchServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def merge_mapping(current, mapping):
+    """Merges `mapping` into `current`, unless a field conflicts"""
+    for key, value in mapping.items():
+        if key == 'properties':
+            fields = current.setdefault('properties', {})
+            for name, field in value.items():
+                if not merge_mapping(fields.setdefault(name, {}), field):
+                    return False
+        elif key in ('_meta', 'dynamic'):
+            current[key] = value
+        elif key in current and current[key] != value:
+            return False
+        else:
+            current[key] = value
+    return True
+
+
+class EsSchemaCreatorTest(testtools.TestCase):
+
+    def setUp(self):
+        super(EsSchemaCreatorTest, self).setUp()
+        self.es = ElasticsearchServer(('127.0.0.1', 0), ElasticsearchHandler)
+        self.es.indices = {}
+        self.es.aliases = {}
+        self.es.templates = {}
+        self.es.calls = []
+        self.es.scrolls = {}
+        self.es.scroll_ids = itertools.count()
+        self.es.health = 'green'
+        self.es.failures = {}
+        self.es.connections = 0
+        thread = threading.Thread(target=self.es.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.es.server_close)
+        self.addCleanup(self.es.shutdown)
+        self.es_url = 'http://127.0.0.1:{0}'.format(self.es.server_port)
+        self.today = datetime.datetime.utcnow().date()
+        # the migrations below name their indices after this version.
+        self.schema_version = es_schema_creator.SCHEMA_VERSION
+        self._patch('SCHEMA_VERSION', 1)
+        self.storage_url = self.es_url + '/cloudify_storage'
+
+    def _patch(self, name, value):
+        self.addCleanup(setattr, es_schema_creator, name,
+                        getattr(es_schema_creator, name))
+        setattr(es_schema_creator, name, value)
+
+    def _add_index(self, name, mappings, docs=3,
+                   analysis=es_schema_creator.ANALYSIS):
+        self.es.indices[name] = {
+            'settings': {'index': {'analysis': analysis}},
+            'state': 'open',
+            'mappings': mappings,
+            'docs': dict((('blueprint', str(i)), {'id': str(i)})
+                         for i in range(docs))}
+
+    def test_diff_mapping(self):
+        current = {'properties': {
+            'id': {'type': 'string'},
+            'plan': {'properties': {'name': {'type': 'string'}}}}}
+        wanted = {'properties': {
+            'id': {'type': 'string', 'index': 'not_analyzed'},
+            'plan': {'properties': {'name': {'type': 'string'},
+                                    'nodes': {'enabled': False}}},
+            'created_at': {'type': 'date'}}}
+        added, changed = es_schema_creator.diff_mapping(current, wanted)
+        self.assertEqual(['created_at', 'plan.nodes'], sorted(added))
+        self.assertEqual(['id'], changed)
+        added, changed = es_schema_creator.diff_mapping(
+            current, {'properties': {'plan': {'enabled': False}}})
+        self.assertEqual(([], ['plan']), (added, changed))
+
+    def test_diff_mapping_updatable(self):
+        current = {'properties': {'plan': {
+            'dynamic': 'false', 'properties': {'name': {'type': 'string'}}}}}
+        wanted = {'properties': {'plan': {
+            'dynamic': False, 'properties': {'name': {'type': 'string'}}}}}
+        self.assertEqual(
+            ([], []), es_schema_creator.diff_mapping(current, wanted))
+        wanted['properties']['plan']['dynamic'] = True
+        self.assertEqual(
+            (['plan'], []), es_schema_creator.diff_mapping(current, wanted))
+
+    def test_build_mapping(self):
+        self.assertEqual(
+            {'dynamic': False, 'properties': {
+                'id': {'type': 'string', 'index': 'not_analyzed'},
+                'description': {'type': 'string'},
+                'created_at': {'type': 'date'},
+                'outputs': {'enabled': False},
+                'nodes': {'dynamic': False, 'properties': {
+                    'count': {'type': 'long'}}}}},
+            es_schema_creator.build_mapping({
+                'id': 'keyword',
+                'description': 'text',
+                'created_at': 'date',
+                'outputs': None,
+                'nodes': {'count': 'long'}}))
+
+    def test_deployment_plan_mapping(self):
+        plan = es_schema_creator.get_mappings()['deployment']['properties'][
+            'plan']
+        nodes = plan['properties']['nodes']['properties']
+        for field in ('id', 'type', 'host_id'):
+            self.assertEqual({'type': 'string', 'index': 'not_analyzed'},
+                             nodes[field])
+        self.assertEqual({'enabled': False}, nodes['properties'])
+        self.assertEqual({'enabled': False},
+                         plan['properties']['workflows'])
+        self.assertFalse(plan['dynamic'])
+
+    def test_create_schema_maps_disabled_plan(self):
+        self._add_index('cloudify_storage_v1', {
+            'blueprint': {'_meta': {'schema_version': 1},
+                          'properties': {'plan': {'enabled': False}}},
+            'deployment': {'_meta': {'schema_version': 1},
+                           'properties': {'plan': {'enabled': False}}}})
+        self.es.aliases['cloudify_storage'] = ['cloudify_storage_v1']
+        es_schema_creator.SCHEMA_VERSION = self.schema_version
+        es_schema_creator.create_schema(self.storage_url)
+        index = 'cloudify_storage_v{0}'.format(self.schema_version)
+        self.assertEqual({'cloudify_storage': [index]}, self.es.aliases)
+        self.assertEqual(es_schema_creator.get_mappings(),
+                         self.es.indices[index]['mappings'])
+        self.es.calls = []
+        es_schema_creator.create_schema(self.storage_url)
+        self.assertNotIn('PUT', [method for method, _ in self.es.calls])
+
+    def test_create_schema_new_index(self):
+        es_schema_creator.create_schema(self.storage_url)
+        self.assertEqual(['cloudify_storage_v1'], self.es.indices.keys())
+        self.assertEqual({'cloudify_storage': ['cloudify_storage_v1']},
+                         self.es.aliases)
+        self.assertEqual(
+            es_schema_creator.get_mappings(),
+            self.es.indices['cloudify_storage_v1']['mappings'])
+
+    def test_create_schema_adds_fields_in_place(self):
+        self._add_index('cloudify_storage', {'blueprint': {'properties': {
+            'plan': {'type': 'object', 'enabled': False},
+            'id': {'type': 'string'}}}})
+        es_schema_creator.create_schema(self.storage_url)
+        index = self.es.indices['cloudify_storage']
+        self.assertEqual(3, len(index['docs']))
+        self.assertEqual(
+            1, es_schema_creator.get_schema_version(index['mappings']))
+        self.assertEqual(es_schema_creator.get_mappings()['deployment'],
+                         index['mappings']['deployment'])
+        self.assertIn('id', index['mappings']['blueprint']['properties'])
+        self.assertNotIn('DELETE', [method for method, _ in self.es.calls])
+
+    def test_create_schema_is_idempotent(self):
+        es_schema_creator.create_schema(self.storage_url)
+        self.es.calls = []
+        es_schema_creator.create_schema(self.storage_url)
+        self.assertEqual([('GET', '/_cluster/health'),
+                          ('GET', '/cloudify_storage/_mapping'),
+                          ('GET', '/cloudify_storage_v1/_settings')],
+                         self.es.calls)
+
+    def test_storage_mappings(self):
+        mappings = es_schema_creator.get_mappings()
+        self.assertEqual(
+            ['blueprint', 'deployment', 'deployment_modification', 'node',
+             'node_instance'], sorted(mappings))
+        for doc_type in ('node', 'node_instance', 'deployment_modification'):
+            self.assertEqual({'path': 'id'}, mappings[doc_type]['_id'])
+        self.assertEqual({'type': 'string', 'index_name': 'type'},
+                         mappings['node']['properties']['types'])
+        self.assertEqual({'enabled': False}, mappings['node_instance'][
+            'properties']['runtime_properties'])
+        for field in ('workflows', 'inputs', 'outputs', 'groups',
+                      'policy_type', 'policy_triggers'):
+            self.assertEqual({'enabled': False},
+                             mappings['deployment']['properties'][field])
+
+    def test_create_schema_reindexes_dynamic_node_mapping(self):
+        mappings = es_schema_creator.get_mappings()
+        # as mapped by ES on the first node stored before the schema.
+        mappings['node'] = {'_meta': {'schema_version': 1}, 'properties': {
+            'id': {'type': 'string'},
+            'types': {'type': 'string'},
+            'properties': {'properties': {'port': {'type': 'long'}}}}}
+        self._add_index('cloudify_storage_v1', mappings)
+        self.es.aliases['cloudify_storage'] = ['cloudify_storage_v1']
+        self._patch('SCHEMA_VERSION', 2)
+        es_schema_creator.create_schema(self.storage_url)
+        self.assertEqual({'cloudify_storage': ['cloudify_storage_v2']},
+                         self.es.aliases)
+        self.assertEqual(
+            es_schema_creator.get_mappings(),
+            self.es.indices['cloudify_storage_v2']['mappings'])
+
+    def test_create_schema_reindexes_for_analysis(self):
+        self._add_index('cloudify_storage_v1',
+                        es_schema_creator.get_mappings(), analysis=None)
+        self.es.aliases['cloudify_storage'] = ['cloudify_storage_v1']
+        self._patch('SCHEMA_VERSION', 2)
+        es_schema_creator.create_schema(self.storage_url)
+        self.assertEqual({'cloudify_storage': ['cloudify_storage_v2']},
+                         self.es.aliases)
+        self.assertEqual(es_schema_creator.ANALYSIS, self.es.indices[
+            'cloudify_storage_v2']['settings']['index']['analysis'])
+        self.assertEqual(self.es.indices['cloudify_storage_v1']['docs'],
+                         self.es.indices['cloudify_storage_v2']['docs'])
+
+    def test_create_schema_reindexes_legacy_index(self):
+        self._patch('REINDEX_BATCH_SIZE', 2)
+        self._add_index('cloudify_storage', {'blueprint': {'properties': {
+            'plan': {'properties': {'name': {'type': 'string'}}}}}})
+        docs = self.es.indices['cloudify_storage']['docs']
+        es_schema_creator.create_schema(self.storage_url)
+        self.assertEqual(['cloudify_storage_v1'], self.es.indices.keys())
+        self.assertEqual({'cloudify_storage': ['cloudify_storage_v1']},
+                         self.es.aliases)
+        self.assertEqual(docs, self.es.indices['cloudify_storage_v1']['docs'])
+
+    def test_create_schema_replaces_rewritten_legacy_index(self):
+        self._add_index('cloudify_storage', {'blueprint': {'properties': {
+            'plan': {'properties': {}}}}})
+        es = self.es
+
+        class WritingSession(es_schema_creator.ElasticsearchSession):
+            """Writes a document between deleting an index and aliasing it
+            """
+            writes = 1
+
+            def delete(self, url, **kwargs):
+                response = super(WritingSession, self).delete(url, **kwargs)
+                if url.endswith('/cloudify_storage') and self.writes:
+                    self.writes -= 1
+                    # as ES auto-creates an index on the first write to it.
+                    es.indices['cloudify_storage'] = {
+                        'settings': {'index': {}}, 'mappings': {},
+                        'state': 'open',
+                        'docs': {('node', 'new'): {'id': 'new'}}}
+                return response
+
+        es_schema_creator.create_schema(self.storage_url, WritingSession())
+        self.assertEqual({'cloudify_storage': ['cloudify_storage_v1']},
+                         self.es.aliases)
+        self.assertEqual(['cloudify_storage_v1'], self.es.indices.keys())
+        self.assertEqual(4, len(self.es.indices['cloudify_storage_v1'][
+            'docs']))
+
+    def test_create_schema_legacy_index_keeps_being_created(self):
+        self._patch('REPLACE_ATTEMPTS', 2)
+        self._add_index('cloudify_storage', {'blueprint': {'properties': {
+            'plan': {'properties': {}}}}})
+        es = self.es
+
+        class WritingSession(es_schema_creator.ElasticsearchSession):
+            def delete(self, url, **kwargs):
+                response = super(WritingSession, self).delete(url, **kwargs)
+                if url.endswith('/cloudify_storage'):
+                    es.indices['cloudify_storage'] = {
+                        'settings': {'index': {}}, 'mappings': {},
+                        'state': 'open', 'docs': {}}
+                return response
+
+        self.assertRaises(es_schema_creator.SchemaMigrationError,
+                          es_schema_creator.create_schema, self.storage_url,
+                          WritingSession())
+        self.assertEqual(2, self.es.calls.count(
+            ('DELETE', '/cloudify_storage')))
+
+    def test_create_schema_swaps_alias(self):
+        self._add_index('cloudify_storage_v1', {'blueprint': {
+            '_meta': {'schema_version': 1},
+            'properties': {'plan': {'properties': {}}}}})
+        self.es.aliases['cloudify_storage'] = ['cloudify_storage_v1']
+        self._patch('SCHEMA_VERSION', 2)
+        es_schema_creator.create_schema(self.storage_url)
+        self.assertEqual({'cloudify_storage': ['cloudify_storage_v2']},
+                         self.es.aliases)
+        self.assertEqual(['cloudify_storage_v1', 'cloudify_storage_v2'],
+                         sorted(self.es.indices.keys()))
+        self.assertEqual(self.es.indices['cloudify_storage_v1']['docs'],
+                         self.es.indices['cloudify_storage_v2']['docs'])
+        alias_calls = [call for call in self.es.calls
+                       if call == ('POST', '/_aliases')]
+        self.assertEqual(1, len(alias_calls))
+        # writes to the old index were blocked before it was copied.
+        self.assertLess(
+            self.es.calls.index(('PUT', '/cloudify_storage_v1/_settings')),
+            self.es.calls.index(('POST', '/cloudify_storage_v1/_search')))
+        self.assertTrue(self.es.indices['cloudify_storage_v1']['settings'][
+            'index']['blocks.write'])
+
+    def test_create_schema_failed_reindex(self):
+        self._add_index('cloudify_storage_v1', {'blueprint': {
+            '_meta': {'schema_version': 1},
+            'properties': {'plan': {'properties': {}}}}})
+        self.es.aliases['cloudify_storage'] = ['cloudify_storage_v1']
+        self.es.failures[('POST', '/_bulk')] = 1
+        self._patch('SCHEMA_VERSION', 2)
+        self.assertRaises(requests.HTTPError, es_schema_creator.create_schema,
+                          self.storage_url)
+        # the old index is still in use, and accepts writes again.
+        self.assertEqual({'cloudify_storage': ['cloudify_storage_v1']},
+                         self.es.aliases)
+        self.assertFalse(self.es.indices['cloudify_storage_v1']['settings'][
+            'index']['blocks.write'])
+
+    def test_create_schema_changed_without_version(self):
+        self._add_index('cloudify_storage_v1', {'blueprint': {
+            '_meta': {'schema_version': 1},
+            'properties': {'plan': {'properties': {}}}}})
+        self.es.aliases['cloudify_storage'] = ['cloudify_storage_v1']
+        self.assertRaises(es_schema_creator.SchemaMigrationError,
+                          es_schema_creator.create_schema, self.storage_url)
+
+    def test_create_schema_newer_version(self):
+        self._patch('SCHEMA_VERSION', 2)
+        es_schema_creator.create_schema(self.storage_url)
+        es_schema_creator.SCHEMA_VERSION = 1
+        self.assertRaises(es_schema_creator.SchemaMigrationError,
+                          es_schema_creator.create_schema, self.storage_url)
+
+    def test_create_schema_reuses_connection(self):
+        self._add_index('cloudify_storage_v1', {'blueprint': {
+            '_meta': {'schema_version': 1},
+            'properties': {'plan': {'properties': {}}}}})
+        self.es.aliases['cloudify_storage'] = ['cloudify_storage_v1']
+        self._patch('SCHEMA_VERSION', 2)
+        es_schema_creator.create_schema(self.storage_url)
+        self.assertGreater(len(self.es.calls), 5)
+        self.assertEqual(1, self.es.connections)
+
+    def test_create_schema_retries_unavailable(self):
+        self._add_index('cloudify_storage', {})
+        path = '/cloudify_storage/deployment/_mapping'
+        self.es.failures[('PUT', path)] = 2
+        es_schema_creator.create_schema(
+            self.storage_url, es_schema_creator.ElasticsearchSession(
+                backoff=0))
+        self.assertEqual(3, self.es.calls.count(('PUT', path)))
+        self.assertEqual(es_schema_creator.get_mappings(),
+                         self.es.indices['cloudify_storage']['mappings'])
+
+    def test_create_schema_does_not_repeat_create_index(self):
+        # ES may have created the index it answered with a 504.
+        self.es.failures[('PUT', '/cloudify_storage_v1')] = 1
+        self.assertRaises(
+            requests.HTTPError, es_schema_creator.create_schema,
+            self.storage_url, es_schema_creator.ElasticsearchSession(
+                backoff=0))
+        self.assertEqual(1, self.es.calls.count(
+            ('PUT', '/cloudify_storage_v1')))
+
+    def test_session_out_of_retries(self):
+        self.es.failures[('GET', '/_cluster/health')] = 9
+        response = es_schema_creator.ElasticsearchSession(
+            retries=2, backoff=0).get(self.es_url + '/_cluster/health')
+        # the last response is returned rather than an error raised.
+        self.assertEqual(503, response.status_code)
+        self.assertEqual(3, self.es.calls.count(('GET', '/_cluster/health')))
+
+    def test_session_does_not_repeat_post(self):
+        self.es.failures[('POST', '/_aliases')] = 1
+        response = es_schema_creator.ElasticsearchSession(backoff=0).post(
+            self.es_url + '/_aliases', json.dumps({'actions': []}))
+        self.assertEqual(503, response.status_code)
+        self.assertEqual(1, self.es.calls.count(('POST', '/_aliases')))
+
+    def test_create_schema_puts_mappings_concurrently(self):
+        self._add_index('cloudify_storage', {})
+        session_class = es_schema_creator.ElasticsearchSession
+        with mock.patch.object(es_schema_creator, 'Thread',
+                               wraps=threading.Thread) as thread:
+            with mock.patch.object(session_class, 'clone', autospec=True,
+                                   side_effect=session_class.clone) as clone:
+                es_schema_creator.create_schema(self.storage_url)
+        self.assertEqual(len(es_schema_creator.SCHEMAS), thread.call_count)
+        # sessions aren't shared between threads.
+        self.assertEqual(len(es_schema_creator.SCHEMAS), clone.call_count)
+        self.assertEqual(es_schema_creator.get_mappings(),
+                         self.es.indices['cloudify_storage']['mappings'])
+
+    def test_create_schema_failed_mapping(self):
+        self._add_index('cloudify_storage', {})
+        self.es.failures[('PUT', '/cloudify_storage/deployment/_mapping')] = 9
+        self.assertRaises(
+            requests.HTTPError, es_schema_creator.create_schema,
+            self.storage_url, es_schema_creator.ElasticsearchSession(
+                retries=0), concurrent=False)
+
+    def test_wait_for_cluster(self):
+        self._patch('READY_BACKOFF', 0)
+        self.es.health = 'red'
+        session = es_schema_creator.ElasticsearchSession()
+        timer = threading.Timer(0.2, setattr, [self.es, 'health', 'yellow'])
+        timer.start()
+        self.addCleanup(timer.cancel)
+        es_schema_creator.wait_for_cluster(session, self.es_url)
+        self.assertGreater(self.es.calls.count(('GET', '/_cluster/health')), 1)
+
+    def test_wait_for_cluster_timeout(self):
+        self._patch('READY_BACKOFF', 0.1)
+        self.es.health = 'red'
+        self.assertRaises(
+            es_schema_creator.SchemaMigrationError,
+            es_schema_creator.wait_for_cluster,
+            es_schema_creator.ElasticsearchSession(), self.es_url, timeout=0.5)
+
+    def test_create_schema_profile(self):
+        es_schema_creator.create_schema(self.storage_url, profile='ha')
+        settings = self.es.indices['cloudify_storage_v1']['settings']['index']
+        self.assertEqual(es_schema_creator.ANALYSIS, settings.pop('analysis'))
+        self.assertEqual(es_schema_creator.INDEX_PROFILES['ha'], settings)
+
+    def test_create_schema_reindexes_before_applying_profile(self):
+        self._add_index('cloudify_storage', {'blueprint': {'properties': {
+            'plan': {'properties': {}}}}})
+        es_schema_creator.create_schema(self.storage_url)
+        settings = self.es.indices['cloudify_storage_v1']['settings']['index']
+        self.assertEqual(es_schema_creator.ANALYSIS, settings.pop('analysis'))
+        self.assertEqual(
+            es_schema_creator.INDEX_PROFILES['single-node'], settings)
+        self.assertIn(('PUT', '/cloudify_storage_v1/_settings'),
+                      self.es.calls)
+
+    def test_apply_profile(self):
+        es_schema_creator.create_schema(self.storage_url)
+        es_schema_creator.apply_profile(
+            es_schema_creator.ElasticsearchSession(), self.storage_url,
+            'bulk-ingest')
+        settings = self.es.indices['cloudify_storage_v1']['settings']['index']
+        self.assertEqual('30s', settings['refresh_interval'])
+        self.assertRaises(
+            es_schema_creator.SchemaMigrationError,
+            es_schema_creator.apply_profile,
+            es_schema_creator.ElasticsearchSession(), self.storage_url,
+            'huge')
+
+    def _events_index(self, days_ago):
+        return es_schema_creator.get_events_index(
+            'cloudify_events', self.today - datetime.timedelta(days_ago))
+
+    def test_create_events_template(self):
+        events_url = self.es_url + '/cloudify_events'
+        es_schema_creator.create_events_template(events_url)
+        es_schema_creator.create_events_template(events_url)
+        # as logstash would, on the first event of the day.
+        requests.put('{0}/{1}'.format(self.es_url, self._events_index(0)))
+        settings = self.es.indices[self._events_index(0)]['settings']['index']
+        self.assertEqual(es_schema_creator.ANALYSIS,
+                         settings.pop('analysis'))
+        self.assertEqual(
+            es_schema_creator.INDEX_PROFILES['single-node'], settings)
+        self.assertEqual({'cloudify_events': [self._events_index(0)]},
+                         self.es.aliases)
+
+    def test_create_events_template_moves_events_index(self):
+        self._add_index('cloudify_events', {})
+        docs = self.es.indices['cloudify_events']['docs']
+        es_schema_creator.create_events_template(
+            self.es_url + '/cloudify_events', today=self.today)
+        index = self._events_index(0)
+        self.assertEqual([index], self.es.indices.keys())
+        self.assertEqual(docs, self.es.indices[index]['docs'])
+        self.assertEqual({'cloudify_events': [index]}, self.es.aliases)
+        self.assertIn('cloudify_events', self.es.templates)
+        self.assertEqual(
+            '5s', self.es.indices[index]['settings']['index'][
+                'refresh_interval'])
+
+    def test_expire_events(self):
+        for days_ago in (0, 5, 30, 89, 90, 100):
+            self._add_index(self._events_index(days_ago), {}, docs=0)
+        self._add_index('cloudify_events-legacy', {}, docs=0)
+        self.es.aliases['cloudify_events'] = [
+            self._events_index(0), self._events_index(30)]
+        es_schema_creator.expire_events(
+            self.es_url + '/cloudify_events', close_after=30,
+            delete_after=90, today=self.today)
+        self.assertEqual(
+            sorted([self._events_index(days_ago) for days_ago in
+                    (0, 5, 30, 89)] + ['cloudify_events-legacy']),
+            sorted(self.es.indices.keys()))
+        self.assertEqual(
+            ['open', 'open', 'close', 'close'],
+            [self.es.indices[self._events_index(days_ago)]['state']
+             for days_ago in (0, 5, 30, 89)])
+        self.assertEqual(
+            [self._events_index(0), self._events_index(5)],
+            self.es.aliases['cloudify_events'])
+
+    def test_main_switch_profile(self):
+        args = ['--storage-index-url', self.storage_url,
+                '--events-index-url', self.es_url + '/cloudify_events']
+        es_schema_creator.main(args)
+        requests.put('{0}/{1}'.format(self.es_url, self._events_index(0)))
+        es_schema_creator.main(args + ['--profile', 'ha', '--switch-profile'])
+        for index in ('cloudify_storage_v1', self._events_index(0)):
+            settings = self.es.indices[index]['settings']['index']
+            self.assertEqual(1, settings['number_of_replicas'])
+            self.assertEqual(1, settings['number_of_shards'])
+        self.assertEqual(3, self.es.templates['cloudify_events'][
+            'settings']['index']['number_of_shards'])
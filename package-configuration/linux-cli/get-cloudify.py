@@ -43,17 +43,29 @@
 
 
 import sys
+import json
 import subprocess
 import argparse
 import platform
 import os
-import urllib
+import re
+import urllib2
+import httplib
+import errno
+import hashlib
+import select
 import struct
 import tempfile
 import logging
 import shutil
 import time
 import tarfile
+import zipfile
+import pkg_resources
+from glob import glob
+from contextlib import closing
+from distutils.spawn import find_executable
+from distutils.util import get_platform
 from threading import Thread
 
 
@@ -119,7 +131,39 @@ IS_WIN = (PLATFORM == 'win32')
 IS_DARWIN = (PLATFORM == 'darwin')
 IS_LINUX = (PLATFORM == 'linux2')
 
-PROCESS_POLLING_INTERVAL = 0.1
+# requirement files of GitHub source archives are fetched from here.
+GITHUB_ARCHIVE_URL = re.compile(
+    r'^https?://(?:www\.)?github\.com/([^/]+)/([^/]+)/archive/'
+    r'(.+?)\.(?:tar\.gz|tgz|zip)$')
+GITHUB_RAW_URL = 'https://raw.githubusercontent.com/{0}/{1}/{2}/{3}'
+# the metadata of the wheels in a wheelhouse is cached in this file in it.
+WHEEL_INDEX_FILE_NAME = '.index.json'
+WHEEL_FILENAME = re.compile(
+    r'^(?P<name>[^-]+)-(?P<version>[^-]+)(?:-\d[^-]*)?'
+    r'-(?P<python>[^-]+)-(?P<abi>[^-]+)-(?P<platform>[^-]+)\.whl$')
+# a requirement such as `requests[security] (>=2.0,<3); extra == "x"`.
+REQUIREMENT = re.compile(
+    r'^\s*(?P<name>[A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:\[[^\]]*\])?'
+    r'\s*\(?(?P<specifier>(?:[<>=!~][^;)]*)?)\)?\s*(?:;(?P<marker>.*))?$')
+
+# minimum number of bytes fetched by each range request of a `RemoteFile`.
+RANGE_BLOCK_SIZE = 64 * 1024
+
+# failed downloads are retried this many times, waiting DOWNLOAD_BACKOFF
+# seconds before the first retry and twice as long before each next one.
+DOWNLOAD_RETRIES = 4
+DOWNLOAD_BACKOFF = 1
+DOWNLOAD_TIMEOUT = 30
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# maximum number of bytes read from a process' pipe at once.
+PIPE_READ_SIZE = 4096
+# output of a process' pipe is kept in memory up to this many bytes and
+# spilled to a temporary file past it.
+OUTPUT_MEMORY_LIMIT = 1024 * 1024
+
+# version of the installation plans written by --plan.
+PLAN_VERSION = 1
 
 # defined below
 lgr = None
@@ -142,30 +186,54 @@ def init_logger(logger_name):
 
 def run(cmd, suppress_errors=False):
     """Executes a command
+
+    The command's stdout and stderr are logged as they arrive and are read
+    until the command closes them, so no output is lost.
     """
     lgr.debug('Executing: {0}...'.format(cmd))
     pipe = subprocess.PIPE
-    proc = subprocess.Popen(
+    proc = Process(
         cmd, shell=True, stdout=pipe, stderr=pipe)
 
     stderr_log_level = logging.NOTSET if suppress_errors else logging.ERROR
 
-    stdout_thread = PipeReader(proc.stdout, proc, lgr, logging.DEBUG)
-    stderr_thread = PipeReader(proc.stderr, proc, lgr, stderr_log_level)
+    stdout_reader = PipeReader(proc.stdout, lgr, logging.DEBUG)
+    stderr_reader = PipeReader(proc.stderr, lgr, stderr_log_level)
 
-    stdout_thread.start()
-    stderr_thread.start()
+    if IS_WIN:
+        # select doesn't support pipes on Windows, so each pipe is read
+        # in a thread of its own.
+        stdout_reader.start()
+        stderr_reader.start()
+        stdout_reader.join()
+        stderr_reader.join()
+    else:
+        read_pipes([stdout_reader, stderr_reader])
+    proc.wait()
 
-    while proc.poll() is None:
-        time.sleep(PROCESS_POLLING_INTERVAL)
+    proc.stdout_buffer = stdout_reader.aggr
+    proc.stderr_buffer = stderr_reader.aggr
 
-    stdout_thread.join()
-    stderr_thread.join()
+    return proc
 
-    proc.aggr_stdout = stdout_thread.aggr
-    proc.aggr_stderr = stderr_thread.aggr
 
-    return proc
+def read_pipes(readers):
+    """Reads the pipes of several `PipeReader`s in the current thread
+
+    Each pipe is read when data is available on it, until all of them
+    are closed.
+    """
+    readers = dict((reader.fd.fileno(), reader) for reader in readers)
+    while readers:
+        try:
+            ready, _, _ = select.select(list(readers), [], [])
+        except select.error as ex:
+            if ex.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd in ready:
+            if not readers[fd].read():
+                del readers[fd]
 
 
 def drop_root_privileges():
@@ -197,7 +265,8 @@ def make_virtualenv(virtualenv_dir, python_path):
 
 
 def install_module(module, version=False, pre=False, virtualenv_path=False,
-                   wheelspath=False, requirement_files=None, upgrade=False):
+                   wheelspath=False, requirement_files=None, upgrade=False,
+                   find_links=False):
     """This will install a Python module.
 
     Can specify a specific version.
@@ -205,13 +274,11 @@ def install_module(module, version=False, pre=False, virtualenv_path=False,
     Can specify a virtualenv to install in.
     Can specify a list of paths or urls to requirement txt files.
     Can specify a local wheelspath to use for offline installation.
+    Can specify a local path to look for wheels in besides PyPI.
     Can request an upgrade.
     """
     lgr.info('Installing {0}...'.format(module))
-    pip_cmd = ['pip', 'install']
-    if virtualenv_path:
-        pip_cmd[0] = os.path.join(
-            _get_env_bin_path(virtualenv_path), pip_cmd[0])
+    pip_cmd = [_get_pip_path(virtualenv_path), 'install']
     if requirement_files:
         for req_file in requirement_files:
             pip_cmd.extend(['-r', req_file])
@@ -221,6 +288,8 @@ def install_module(module, version=False, pre=False, virtualenv_path=False,
     if wheelspath:
         pip_cmd.extend(
             ['--use-wheel', '--no-index', '--find-links', wheelspath])
+    elif find_links:
+        pip_cmd.extend(['--find-links', find_links])
     if pre:
         pip_cmd.append('--pre')
     if upgrade:
@@ -234,23 +303,647 @@ def install_module(module, version=False, pre=False, virtualenv_path=False,
         sys.exit('Could not install module: {0}.'.format(module))
 
 
+def install_wheels(wheels, virtualenv_path=False):
+    """This will install wheel files, without their dependencies.
+    """
+    lgr.info('Installing {0} wheel(s)...'.format(len(wheels)))
+    result = run(' '.join(
+        [_get_pip_path(virtualenv_path), 'install', '--no-index',
+         '--no-deps'] + ['"{0}"'.format(wheel) for wheel in wheels]))
+    if not result.returncode == 0:
+        lgr.error(result.aggr_stdout)
+        sys.exit('Could not install wheels: {0}.'.format(', '.join(wheels)))
+
+
+def download_wheels(requirements, wheels_path, virtualenv_path=False,
+                    pre=False):
+    """This will save wheels of requirements, and their dependencies, to
+    `wheels_path`.
+
+    Wheels already in `wheels_path` are used rather than downloaded again.
+    Returns True if all wheels were saved.
+    """
+    lgr.info('Saving wheels of {0} to {1}...'.format(
+        ', '.join(requirements), wheels_path))
+    pip_cmd = [_get_pip_path(virtualenv_path), 'wheel',
+               '--wheel-dir', wheels_path, '--find-links', wheels_path]
+    if pre:
+        pip_cmd.append('--pre')
+    # requirements may contain characters such as `<` and `>`.
+    pip_cmd.extend('"{0}"'.format(req) for req in requirements)
+    result = run(' '.join(pip_cmd))
+    if not result.returncode == 0:
+        lgr.error(result.aggr_stdout)
+        return False
+    return True
+
+
+def _get_pip_path(virtualenv_path):
+    if virtualenv_path:
+        return os.path.join(_get_env_bin_path(virtualenv_path), 'pip')
+    return 'pip'
+
+
+def _requirement_file_name(path):
+    """Returns the name of the requirement file at `path` in an archive
+
+    Returns None if `path` isn't a requirement file in the archive's top
+    two directory levels.
+    """
+    parts = [part for part in path.split('/') if part not in ('', '.')]
+    if parts and len(parts) <= 2 and '..' not in parts and \
+            parts[-1] in REQUIREMENT_FILE_NAMES:
+        return parts[-1]
+    return None
+
+
 def untar_requirement_files(archive, destination):
     """This will extract requirement files from an archive.
+
+    `archive` is a path or a file object, such as an HTTP response, and is
+    read as a stream. Only requirement files in the top two directory
+    levels of the archive are extracted. Reading stops once all of them
+    were found. Returns the paths of the extracted files.
+    """
+    if isinstance(archive, basestring):
+        tar = tarfile.open(name=archive, mode='r|*')
+    else:
+        tar = tarfile.open(fileobj=archive, mode='r|*')
+    found = {}
+    with closing(tar):
+        for member in tar:
+            name = _requirement_file_name(member.name)
+            if not member.isfile() or not name or name in found:
+                continue
+            tar.extract(member, path=destination)
+            found[name] = os.path.join(destination, member.name)
+            if len(found) == len(REQUIREMENT_FILE_NAMES):
+                break
+    return [found[req_file] for req_file in REQUIREMENT_FILE_NAMES
+            if req_file in found]
+
+
+def fetch_github_requirement_files(url, destination):
+    """Fetches the requirement files of a GitHub source archive
+
+    The files are fetched from raw.githubusercontent.com, without
+    downloading the archive. Returns their paths.
+    """
+    owner, repo, ref = GITHUB_ARCHIVE_URL.match(url).groups()
+    req_files = []
+    for name in REQUIREMENT_FILE_NAMES:
+        path = os.path.join(destination, name)
+        try:
+            download_file(GITHUB_RAW_URL.format(owner, repo, ref, name), path)
+        except urllib2.HTTPError as ex:
+            if ex.code != 404:
+                raise
+            continue
+        req_files.append(path)
+    return req_files
+
+
+def stream_requirement_files(url, destination):
+    """Streams the requirement files out of a remote tar archive
+
+    The archive is extracted from as it's downloaded, without writing it
+    to disk, and only read up to its last requirement file. Failed
+    attempts are retried with a backoff. Returns their paths.
     """
-    with tarfile.open(name=archive) as tar:
-        req_files = [req_file for req_file in tar.getmembers()
-                     if os.path.basename(req_file.name)
-                     in REQUIREMENT_FILE_NAMES]
-        tar.extractall(path=destination, members=req_files)
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        try:
+            response = urllib2.urlopen(url, timeout=DOWNLOAD_TIMEOUT)
+            with closing(response):
+                return untar_requirement_files(response, destination)
+        except urllib2.HTTPError as ex:
+            if ex.code < 500 or attempt == DOWNLOAD_RETRIES:
+                raise
+            error = ex
+        except (IOError, httplib.HTTPException) as ex:
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            error = ex
+        delay = DOWNLOAD_BACKOFF * 2 ** attempt
+        lgr.warning('Reading {0} failed ({1}). Retrying in {2} '
+                    'seconds...'.format(url, error, delay))
+        time.sleep(delay)
+
+
+def fetch_zip_requirement_files(url, destination):
+    """Fetches the requirement files out of a remote zip archive
+
+    Only the archive's central directory and the requirement files in it
+    are fetched, using HTTP range requests. Returns their paths.
+    """
+    return unzip_requirement_files(RemoteFile(url), destination)
+
+
+def unzip_requirement_files(archive, destination):
+    """Extracts the requirement files of a zip archive
+
+    `archive` is a path or a seekable file object. Returns the paths of the
+    extracted files.
+    """
+    found = {}
+    with closing(zipfile.ZipFile(archive)) as archive:
+        for info in archive.infolist():
+            name = _requirement_file_name(info.filename)
+            if name and name not in found:
+                found[name] = archive.extract(info, destination)
+    return [found[req_file] for req_file in REQUIREMENT_FILE_NAMES
+            if req_file in found]
+
+
+class RemoteFile(object):
+    """A read only file object over HTTP range requests
+
+    Data is fetched in blocks of at least `RANGE_BLOCK_SIZE` bytes, the
+    last of which is kept.
+    """
+    def __init__(self, url):
+        self.url = url
+        response = self._open('bytes=-{0}'.format(RANGE_BLOCK_SIZE))
+        try:
+            # the url is requested as redirected from now on.
+            self.url = response.geturl()
+            content_range = response.info().getheader('Content-Range') or ''
+            size = content_range.rpartition('/')[2]
+            if not size.isdigit():
+                raise IOError('{0} sent no size in its Content-Range '
+                              '({1!r})'.format(self.url, content_range))
+            self.size = int(size)
+            self._block = response.read()
+        finally:
+            response.close()
+        self._block_start = self.size - len(self._block)
+        self._position = 0
+
+    def _open(self, byte_range):
+        request = urllib2.Request(self.url, headers={'Range': byte_range})
+        response = urllib2.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+        if response.getcode() != 206:
+            response.close()
+            raise IOError('{0} does not support range requests'.format(
+                self.url))
+        return response
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self._position = max(0, offset)
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        end = self.size if size < 0 else min(self._position + size, self.size)
+        if self._position < self._block_start or \
+                end > self._block_start + len(self._block):
+            response = self._open('bytes={0}-{1}'.format(
+                self._position,
+                min(max(end, self._position + RANGE_BLOCK_SIZE),
+                    self.size) - 1))
+            try:
+                self._block = response.read()
+            finally:
+                response.close()
+            self._block_start = self._position
+        data = self._block[self._position - self._block_start:
+                           end - self._block_start]
+        self._position += len(data)
+        return data
+
+    def close(self):
+        pass
 
 
 def download_file(url, destination):
+    """Downloads a file
+
+    The file is streamed to `<destination>.part` in chunks and renamed
+    once complete. Failed attempts are retried with a backoff and, when
+    the server supports it, resumed from where they stopped using a Range
+    request.
+    """
     lgr.info('Downloading {0} to {1}'.format(url, destination))
-    final_url = urllib.urlopen(url).geturl()
-    if final_url != url:
-        lgr.debug('Redirected to {0}'.format(final_url))
-    f = urllib.URLopener()
-    f.retrieve(final_url, destination)
+    partial = destination + '.part'
+    if os.path.exists(partial):
+        os.remove(partial)
+    started = time.time()
+    validator = {}
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        try:
+            _download(url, partial, validator)
+            break
+        except urllib2.HTTPError as ex:
+            if ex.code < 500 and ex.code != 416 or \
+                    attempt == DOWNLOAD_RETRIES:
+                raise
+            if ex.code == 416:
+                # the partial file doesn't match the file anymore.
+                os.remove(partial)
+            error = ex
+        except (IOError, httplib.HTTPException) as ex:
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            error = ex
+        delay = DOWNLOAD_BACKOFF * 2 ** attempt
+        lgr.warning('Downloading {0} failed ({1}). Retrying in {2} '
+                    'seconds...'.format(url, error, delay))
+        time.sleep(delay)
+    if IS_WIN and os.path.exists(destination):
+        os.remove(destination)
+    os.rename(partial, destination)
+    size = os.path.getsize(destination)
+    elapsed = max(time.time() - started, 0.001)
+    lgr.info('Downloaded {0} bytes in {1:.2f} seconds ({2:.0f} '
+             'bytes/sec).'.format(size, elapsed, size / elapsed))
+
+
+def _download(url, partial, validator):
+    """Downloads `url` to `partial`, resuming it if it's not empty
+
+    `validator` keeps the ETag or Last-Modified header of the url between
+    attempts, so a file which changed since is downloaded from scratch.
+    """
+    offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+    request = urllib2.Request(url)
+    if offset:
+        request.add_header('Range', 'bytes={0}-'.format(offset))
+        if validator.get('value'):
+            request.add_header('If-Range', validator['value'])
+    response = urllib2.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+    try:
+        if response.geturl() != url:
+            lgr.debug('Redirected to {0}'.format(response.geturl()))
+        headers = response.info()
+        validator['value'] = \
+            headers.getheader('ETag') or headers.getheader('Last-Modified')
+        if response.getcode() == 206:
+            lgr.info('Resuming download at byte {0}...'.format(offset))
+            mode = 'ab'
+        else:
+            mode = 'wb'
+        length = headers.getheader('Content-Length')
+        received = 0
+        with open(partial, mode) as f:
+            for chunk in iter(
+                    lambda: response.read(DOWNLOAD_CHUNK_SIZE), ''):
+                f.write(chunk)
+                received += len(chunk)
+        if length is not None and received < int(length):
+            raise IOError('received {0} of {1} bytes'.format(
+                received, length))
+    finally:
+        response.close()
+
+
+def normalize_name(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def _version_key(version):
+    return pkg_resources.parse_version(version)
+
+
+def _release(version, length=0):
+    """Returns the numbers of the release `version` is of, e.g. [1, 0] of
+    1.0rc1, padded with zeros to `length`
+    """
+    match = re.match(r'^v?(\d+(?:\.\d+)*)', version.strip())
+    release = [int(part) for part in match.group(1).split('.')] \
+        if match else []
+    return release + [0] * (length - len(release))
+
+
+def is_prerelease(version):
+    parsed = _version_key(version)
+    if hasattr(parsed, 'is_prerelease'):
+        return parsed.is_prerelease
+    # setuptools before 8 parses versions into tuples, in which the parts
+    # of pre releases sort before '*final'.
+    return any(part.startswith('*') and part < '*final' for part in parsed)
+
+
+def wheel_tags():
+    """Returns the python, abi and platform tags of the wheels which can
+    be installed here
+    """
+    major, minor = sys.version_info[:2]
+    cpython = 'cp{0}{1}'.format(major, minor)
+    platform_tag = get_platform().replace('-', '_').replace('.', '_')
+    platform_tags = ['any', platform_tag]
+    if platform_tag in ('linux_x86_64', 'linux_i686'):
+        platform_tags.append(platform_tag.replace('linux', 'manylinux1'))
+    return (['py{0}'.format(major), 'py{0}{1}'.format(major, minor), cpython],
+            ['none', cpython + ('mu' if sys.maxunicode > 0xffff else 'm')],
+            platform_tags)
+
+
+def version_matches(version, specifier):
+    """Checks `version` against a specifier such as `>=2.0,!=2.1,<3`
+    """
+    for clause in specifier.replace(' ', '').split(','):
+        match = re.match(r'^(~=|===?|!=|<=|>=|<|>)?(.+)$', clause)
+        if not clause or not match:
+            continue
+        operator, other = match.group(1) or '==', match.group(2)
+        if other.endswith('.*'):
+            prefix = _release(other[:-2])
+            equal = _release(version, len(prefix))[:len(prefix)] == prefix
+            if equal != (operator != '!='):
+                return False
+            continue
+        key, other_key = _version_key(version), _version_key(other)
+        if operator == '~=':
+            prefix = _release(other)[:-1]
+            if key < other_key or \
+                    _release(version, len(prefix))[:len(prefix)] != prefix:
+                return False
+        elif not {'==': key == other_key, '===': version == other,
+                  '!=': key != other_key, '<=': key <= other_key,
+                  '>=': key >= other_key, '<': key < other_key,
+                  '>': key > other_key}[operator]:
+            return False
+    return True
+
+
+class WheelIndex(object):
+    """An index of the wheels in a wheelhouse
+
+    The name, version and requirements of each wheel are read from its
+    filename and metadata once and cached in the wheelhouse's
+    `WHEEL_INDEX_FILE_NAME`, keyed by the wheel's size and mtime, along
+    with its sha256.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.wheels = self._load()
+        self.by_name = {}
+        for wheel in sorted(self.wheels.values(),
+                            key=lambda wheel: _version_key(wheel['version']),
+                            reverse=True):
+            self.by_name.setdefault(wheel['name'], []).append(wheel)
+
+    def _load(self):
+        index_file = os.path.join(self.path, WHEEL_INDEX_FILE_NAME)
+        try:
+            with open(index_file) as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            cached = {}
+        wheels = {}
+        for filename in sorted(os.listdir(self.path)):
+            if not WHEEL_FILENAME.match(filename):
+                continue
+            stat = os.stat(os.path.join(self.path, filename))
+            stamp = [stat.st_size, stat.st_mtime]
+            wheel = cached.get(filename)
+            if not wheel or wheel['stamp'] != stamp or \
+                    'platform' not in wheel:
+                try:
+                    wheel = self._read_wheel(filename)
+                except (IOError, zipfile.BadZipfile, KeyError) as ex:
+                    lgr.warning('Ignoring wheel {0} ({1}).'.format(
+                        filename, ex))
+                    continue
+                wheel['stamp'] = stamp
+            wheels[filename] = wheel
+        if wheels != cached:
+            try:
+                with open(index_file, 'w') as f:
+                    json.dump(wheels, f, indent=2, sort_keys=True)
+            except IOError as ex:
+                lgr.debug('Could not write {0} ({1}).'.format(index_file, ex))
+        return wheels
+
+    def _read_wheel(self, filename):
+        match = WHEEL_FILENAME.match(filename)
+        path = os.path.join(self.path, filename)
+        with closing(zipfile.ZipFile(path)) as wheel:
+            metadata = [name for name in wheel.namelist()
+                        if name.count('/') == 1 and
+                        name.endswith('.dist-info/METADATA')][0]
+            requires = [line.split(':', 1)[1].strip()
+                        for line in wheel.read(metadata).splitlines()
+                        if line.startswith('Requires-Dist:')]
+        return {'filename': filename,
+                'name': normalize_name(match.group('name')),
+                'version': match.group('version'),
+                'python': match.group('python'),
+                'abi': match.group('abi'),
+                'platform': match.group('platform'),
+                'requires': requires,
+                'sha256': file_sha256(path)}
+
+    def find(self, name, specifier='', pre=False):
+        """Returns the newest wheel of `name` matching `specifier`
+
+        Only wheels which can be installed on this python and platform are
+        considered. As with pip, pre releases are only considered with
+        `pre` or when `specifier` names one.
+        """
+        tags = wheel_tags()
+        pre = pre or any(is_prerelease(version) for version in re.findall(
+            r'[<>=!~]+\s*([^,\s]+)', specifier))
+        for wheel in self.by_name.get(normalize_name(name), []):
+            if all(any(tag in supported for tag in wheel[key].split('.'))
+                   for key, supported in zip(
+                       ('python', 'abi', 'platform'), tags)) and \
+                    (pre or not is_prerelease(wheel['version'])) and \
+                    version_matches(wheel['version'], specifier):
+                return wheel
+        return None
+
+    def resolve(self, requirements, pre=False):
+        """Resolves `requirements` and their dependencies against the index
+
+        Returns the wheels satisfying them, dependencies first, and the
+        requirements which no wheel satisfies. Requirements which aren't
+        names, such as urls, and dependencies on extras are skipped. Pre
+        releases are considered as by `find`.
+        """
+        found = {}
+        order = []
+        missing = []
+
+        def visit(requirement):
+            match = REQUIREMENT.match(requirement)
+            if not match or 'extra' in (match.group('marker') or ''):
+                return
+            name = normalize_name(match.group('name'))
+            if name in found:
+                return
+            wheel = self.find(name, match.group('specifier').strip(), pre)
+            found[name] = wheel
+            if not wheel:
+                missing.append(requirement.strip())
+                return
+            for dependency in wheel['requires']:
+                visit(dependency)
+            order.append(wheel)
+
+        for requirement in requirements:
+            visit(requirement)
+        return order, missing
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def read_requirement_files(requirement_files):
+    """Returns the requirements in local requirement files
+    """
+    requirements = []
+    for req_file in requirement_files or []:
+        if not os.path.isfile(req_file):
+            continue
+        with open(req_file) as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line and not line.startswith('-'):
+                    requirements.append(line)
+    return requirements
+
+
+def _read_version(metadata_path):
+    """Returns the version in a PKG-INFO or METADATA file, if any
+    """
+    for name in ('PKG-INFO', 'METADATA', os.path.join('EGG-INFO', 'PKG-INFO')):
+        path = os.path.join(metadata_path, name)
+        if os.path.isfile(path):
+            metadata_path = path
+            break
+    try:
+        with open(metadata_path) as f:
+            for line in f:
+                if line.startswith('Version:'):
+                    return line.split(':', 1)[1].strip()
+                if not line.strip():
+                    break
+    except IOError:
+        pass
+    return ''
+
+
+def _read_lines(path):
+    try:
+        with open(path) as f:
+            return [line.strip() for line in f if line.strip()]
+    except IOError:
+        return []
+
+
+def get_installed_version(name, site_packages, follow_pth=True):
+    """Returns the version of `name` installed in site-packages dirs
+
+    `name` is a distribution name or, if there's no such distribution, a
+    top level package listed in a distribution's top_level.txt. Eggs and
+    development installs referred to by .egg-link and .pth files are
+    looked for as well. Returns '' if `name` is installed but its version
+    is unknown, or None if it's not installed.
+    """
+    key = normalize_name(name)
+    providers = []
+    for path in site_packages:
+        try:
+            entries = sorted(os.listdir(path))
+        except OSError:
+            continue
+        for entry in entries:
+            entry_path = os.path.join(path, entry)
+            base, ext = os.path.splitext(entry)
+            if ext in ('.dist-info', '.egg-info', '.egg'):
+                dist, _, version = base.partition('-')
+                if normalize_name(dist) == key:
+                    return version.split('-')[0] or _read_version(entry_path)
+                if name in _read_lines(os.path.join(entry_path,
+                                                    'top_level.txt')):
+                    providers.append(
+                        version.split('-')[0] or _read_version(entry_path))
+            elif ext == '.egg-link' and normalize_name(base) == key:
+                version = get_installed_version(
+                    name, _read_lines(entry_path)[:1], follow_pth=False)
+                return '' if version is None else version
+            elif ext == '.pth' and follow_pth:
+                paths = [os.path.join(path, line)
+                         for line in _read_lines(entry_path)
+                         if not line.startswith(('#', 'import '))]
+                version = get_installed_version(
+                    name, [p for p in paths if os.path.isdir(p)],
+                    follow_pth=False)
+                if version is not None:
+                    return version
+        if os.path.isfile(os.path.join(path, name, '__init__.py')) or \
+                os.path.isfile(os.path.join(path, name + '.py')):
+            providers.append('')
+    return providers[0] if providers else None
+
+
+def find_site_packages(python_path=None, virtualenv_path=None):
+    """Returns the site-packages dirs of a virtualenv or an interpreter
+
+    The dirs are found without running the interpreter. Returns None if
+    that's not possible, which is the case for interpreters other than
+    the current one.
+    """
+    if virtualenv_path:
+        if IS_WIN:
+            pattern = os.path.join(virtualenv_path, 'Lib', 'site-packages')
+        else:
+            pattern = os.path.join(
+                virtualenv_path, 'lib', 'python*', 'site-packages')
+        return [path for path in glob(pattern) if os.path.isdir(path)] \
+            or None
+    executable = find_executable(python_path) if python_path else None
+    if executable is None and python_path:
+        return None
+    if executable and os.path.realpath(executable) != \
+            os.path.realpath(sys.executable):
+        return None
+    return [path for path in sys.path if path and os.path.isdir(path)]
+
+
+def _is_isolated(virtualenv_path, site_packages):
+    """Checks whether a virtualenv ignores the global site-packages
+    """
+    config = os.path.join(virtualenv_path, 'pyvenv.cfg')
+    if os.path.isfile(config):
+        return 'include-system-site-packages = true' not in [
+            line.lower() for line in _read_lines(config)]
+    return any(os.path.isfile(os.path.join(
+        os.path.dirname(path), 'no-global-site-packages.txt'))
+        for path in site_packages)
+
+
+def probe_installed(name, python_path=None, virtualenv_path=None):
+    """Returns the version of `name` installed for a virtualenv or an
+    interpreter (the current one by default)
+
+    The site-packages metadata is inspected in-process. The interpreter
+    is only run, to import `name`, when that's inconclusive. Returns ''
+    if `name` is installed but its version is unknown, or None if it's
+    not installed.
+    """
+    site_packages = find_site_packages(python_path, virtualenv_path)
+    if site_packages is not None:
+        version = get_installed_version(name, site_packages)
+        if version is not None or not virtualenv_path or \
+                _is_isolated(virtualenv_path, site_packages):
+            return version
+    if virtualenv_path:
+        python_path = os.path.join(
+            _get_env_bin_path(virtualenv_path), 'python')
+    result = run('{0} -c "import {1}"'.format(
+        python_path or sys.executable, name), suppress_errors=True)
+    return '' if result.returncode == 0 else None
 
 
 def get_os_props():
@@ -273,23 +966,150 @@ def _get_env_bin_path(env_path):
         return os.path.join(env_path, 'scripts' if IS_WIN else 'bin')
 
 
+class OutputBuffer(object):
+    """Collects output in chunks
+
+    Output is kept in memory until it grows past `memory_limit` bytes
+    (`OUTPUT_MEMORY_LIMIT` by default). All of it is then moved to a
+    temporary file, which further output is appended to.
+    """
+    def __init__(self, memory_limit=None):
+        self.memory_limit = OUTPUT_MEMORY_LIMIT if memory_limit is None \
+            else memory_limit
+        self._chunks = []
+        self._length = 0
+        self._file = None
+
+    def write(self, data):
+        if self._file:
+            self._file.write(data)
+            return
+        self._chunks.append(data)
+        self._length += len(data)
+        if self._length > self.memory_limit:
+            self._file = tempfile.TemporaryFile()
+            self._file.writelines(self._chunks)
+            self._chunks = []
+
+    @property
+    def spilled(self):
+        return self._file is not None
+
+    def getvalue(self):
+        if not self._file:
+            return ''.join(self._chunks)
+        self._file.seek(0)
+        value = self._file.read()
+        self._file.seek(0, os.SEEK_END)
+        return value
+
+
+class Process(subprocess.Popen):
+    """A process executed by `run`
+
+    Its output is read into `stdout_buffer` and `stderr_buffer` and is
+    only turned into strings when `aggr_stdout` or `aggr_stderr` are
+    accessed.
+    """
+    stdout_buffer = stderr_buffer = None
+
+    @property
+    def aggr_stdout(self):
+        return self.stdout_buffer.getvalue() if self.stdout_buffer else ''
+
+    @property
+    def aggr_stderr(self):
+        return self.stderr_buffer.getvalue() if self.stderr_buffer else ''
+
+
 class PipeReader(Thread):
-    def __init__(self, fd, proc, logger, log_level):
+    """Reads a process' pipe, logging it line by line
+
+    The output is kept in `aggr`. When run as a thread, the pipe is read
+    until it's closed. Otherwise, `read` is called whenever data is
+    available on the pipe (see `read_pipes`).
+    """
+    def __init__(self, fd, logger, log_level):
         Thread.__init__(self)
         self.fd = fd
-        self.proc = proc
         self.logger = logger
         self.log_level = log_level
-        self.aggr = ''
+        self.aggr = OutputBuffer()
+        self._line = ''
+
+    def run(self):
+        while self.read():
+            pass
+
+    def read(self):
+        """Reads what's available on the pipe
+
+        Returns False once the pipe is closed.
+        """
+        output = os.read(self.fd.fileno(), PIPE_READ_SIZE)
+        if not output:
+            if self._line:
+                self.logger.log(self.log_level, self._line)
+                self._line = ''
+            self.fd.close()
+            return False
+        self.aggr.write(output)
+        lines = (self._line + output).split('\n')
+        self._line = lines.pop()
+        for line in lines:
+            self.logger.log(self.log_level, line)
+        return True
+
+
+class Step(Thread):
+    """An installation step, run by `run_steps`
+
+    The step starts once the steps it `depends` on are done, and is
+    skipped if one of them failed. Its error, if any, is kept in `error`
+    and the time it took in `duration`.
+    """
+    def __init__(self, name, func, depends=()):
+        Thread.__init__(self, name=name)
+        self.func = func
+        self.depends = depends
+        self.error = None
+        self.duration = None
 
     def run(self):
-        while self.proc.poll() is None:
-            output = self.fd.readline()
-            if len(output) > 0:
-                self.aggr += output
-                self.logger.log(self.log_level, output)
-            else:
-                time.sleep(PROCESS_POLLING_INTERVAL)
+        for step in self.depends:
+            step.join()
+        if any(step.error or step.duration is None for step in self.depends):
+            return
+        started = time.time()
+        try:
+            self.func()
+        except BaseException:
+            # sys.exit() in a thread would only end the thread.
+            self.error = sys.exc_info()
+        self.duration = time.time() - started
+
+
+def run_steps(steps):
+    """Runs `Step`s concurrently, honoring their dependencies
+
+    Once all steps are done, their timing is logged and the error of the
+    first step which failed, if any, is raised.
+    """
+    started = time.time()
+    for step in steps:
+        step.start()
+    for step in steps:
+        step.join()
+    for step in steps:
+        if step.duration is None:
+            lgr.debug('Skipped {0}.'.format(step.name))
+        else:
+            lgr.info('{0} took {1:.2f} seconds.'.format(
+                step.name, step.duration))
+    lgr.debug('Steps took {0:.2f} seconds.'.format(time.time() - started))
+    for step in steps:
+        if step.error:
+            raise step.error[0], step.error[1], step.error[2]
 
 
 class CloudifyInstaller():
@@ -299,7 +1119,7 @@ class CloudifyInstaller():
                  pythonpath='python', installpip=False,
                  installvirtualenv=False, installpythondev=False,
                  installpycrypto=False, os_distro=None, os_release=None,
-                 **kwargs):
+                 savewheels=False, **kwargs):
         self.force = force
         self.upgrade = upgrade
         self.virtualenv = virtualenv
@@ -309,11 +1129,14 @@ class CloudifyInstaller():
         self.withrequirements = withrequirements
         self.force_online = forceonline
         self.wheels_path = wheelspath
+        self.save_wheels = savewheels
         self.python_path = pythonpath
         self.installpip = installpip
         self.installvirtualenv = installvirtualenv
         self.installpythondev = installpythondev
         self.installpycrypto = installpycrypto
+        # removed once the installation is done.
+        self.tempdirs = []
 
         # TODO: we should test all mutually exclusive arguments.
         if not IS_WIN and self.installpycrypto:
@@ -321,7 +1144,11 @@ class CloudifyInstaller():
         if not (IS_LINUX or IS_DARWIN) and self.installpythondev:
             lgr.warning('Pythondev only relevant on Linux or OSx.')
 
-        os_props = get_os_props()
+        # an installation plan provides these, so they're not detected.
+        if os_distro is not None and os_release is not None:
+            os_props = (os_distro, os_release)
+        else:
+            os_props = get_os_props()
         self.distro = os_distro or os_props[0].lower()
         self.release = os_release or os_props[1].lower()
 
@@ -334,48 +1161,183 @@ class CloudifyInstaller():
         If an offline installation fails (for instance, not all wheels were
         found), an online installation process will commence.
         """
+        try:
+            self._install()
+        finally:
+            self._remove_tempdirs()
+
+    def write_plan(self, path):
+        """Resolves the installation into a plan and writes it to `path`
+
+        Nothing is installed. The plan can then be applied, on this machine
+        or on any number of identical ones, using --apply-plan.
+        """
+        try:
+            plan = self.make_plan()
+        finally:
+            self._remove_tempdirs()
+        with open(path, 'w') as f:
+            json.dump(plan, f, indent=2, sort_keys=True)
+        lgr.info('Installation plan written to "{0}".'.format(path))
+
+    def apply_plan(self, plan):
+        """Installs Cloudify as decided by a plan made by `make_plan`
+
+        Nothing is resolved again: the prerequisites in the plan are
+        installed and, if the plan is complete, so are its wheels, in
+        order, after verifying their hashes. Otherwise, the installation
+        goes on as its mode dictates.
+        """
+        try:
+            self._apply_plan(plan)
+        finally:
+            self._remove_tempdirs()
+
+    def _remove_tempdirs(self):
+        for tempdir in self.tempdirs:
+            shutil.rmtree(tempdir, ignore_errors=True)
+        self.tempdirs = []
+
+    def _install(self):
         lgr.debug('Identified Platform: {0}'.format(PLATFORM))
         lgr.debug('Identified Distribution: {0}'.format(self.distro))
         lgr.debug('Identified Release: {0}'.format(self.release))
 
         module = self.source or 'cloudify'
 
-        if self.force or self.installpip:
-            self.install_pip()
+        self._prepare_environment()
 
-        if self.virtualenv:
-            if self.force or self.installvirtualenv:
-                self.install_virtualenv()
-            env_bin_path = _get_env_bin_path(self.virtualenv)
+        # if withrequirements is not provided, this will be False.
+        # if it's provided without a value, it will be a list.
+        if isinstance(self.withrequirements, list):
+            self.withrequirements = self.withrequirements \
+                or self._get_default_requirement_files(self.source)
+
+        mode = self.choose_install_mode(module)
+        if mode == 'hybrid' and self.save_wheels and download_wheels(
+                self.missing_wheels, self.wheels_path, self.virtualenv,
+                self.pre):
+            mode = 'offline'
+        self._install_module(
+            module, mode, self.withrequirements,
+            [os.path.join(self.wheels_path, wheel['filename'])
+             for wheel in self.local_wheels])
+        self._log_activate_command()
+
+    def make_plan(self):
+        """Resolves the installation without installing anything
+
+        The plan holds the OS properties, the prerequisites to install, the
+        requirements and the installation mode, along with the wheels to
+        install from the wheelhouse, in order and with their sha256. It is
+        complete if these are all that is needed to install Cloudify.
+        """
+        module = self.source or 'cloudify'
+        requirement_files = []
+        if isinstance(self.withrequirements, list):
+            self.withrequirements = self.withrequirements \
+                or self._get_default_requirement_files(self.source)
+            # remote requirement files are left for pip to fetch.
+            requirement_files = [path for path in self.withrequirements
+                                 if not os.path.isfile(path)]
+        mode = self.choose_install_mode(module)
+        prerequisites = self.get_prerequisites()
+        return {
+            'version': PLAN_VERSION,
+            'platform': PLATFORM,
+            'distro': self.distro,
+            'release': self.release,
+            'settings': {
+                'force': self.force,
+                'upgrade': self.upgrade,
+                'virtualenv': self.virtualenv,
+                'version': self.version,
+                'pre': self.pre,
+                'source': self.source,
+                'forceonline': self.force_online,
+                'wheelspath': self.wheels_path,
+                'pythonpath': self.python_path,
+                'installpycrypto': self.installpycrypto,
+            },
+            'prerequisites': prerequisites,
+            'pythondev_command': self.get_pythondev_command(self.distro)
+            if 'python-dev' in prerequisites else None,
+            'requirements': read_requirement_files(
+                [path for path in self.withrequirements or []
+                 if path not in requirement_files]),
+            'requirement_files': requirement_files,
+            'mode': mode,
+            'complete': mode == 'offline' and not requirement_files and
+            not (os.path.exists(module) or '://' in module),
+            'wheels': [{'filename': wheel['filename'],
+                        'sha256': wheel['sha256']}
+                       for wheel in self.local_wheels],
+            'missing': self.missing_wheels,
+        }
+
+    def _apply_plan(self, plan):
+        if plan.get('version') != PLAN_VERSION:
+            sys.exit('Unsupported installation plan version: {0}.'.format(
+                plan.get('version')))
+        if plan['platform'] != PLATFORM:
+            sys.exit('The installation plan was made for {0}, not {1}.'.format(
+                plan['platform'], PLATFORM))
+
+        module = self.source or 'cloudify'
+
+        self._prepare_environment(plan['prerequisites'],
+                                  plan['pythondev_command'])
+
+        requirement_files = plan['requirement_files'][:]
+        if plan['requirements']:
+            tempdir = tempfile.mkdtemp()
+            self.tempdirs.append(tempdir)
+            requirement_files.append(os.path.join(tempdir, 'requirements.txt'))
+            with open(requirement_files[-1], 'w') as f:
+                f.write('\n'.join(plan['requirements']) + '\n')
+
+        wheels = []
+        for wheel in plan['wheels']:
+            path = os.path.join(self.wheels_path, wheel['filename'])
+            if not os.path.isfile(path) or \
+                    file_sha256(path) != wheel['sha256']:
+                sys.exit('Wheel "{0}" does not match the installation '
+                         'plan.'.format(path))
+            wheels.append(path)
+
+        mode = plan['mode']
+        if mode == 'offline' and plan['complete']:
+            lgr.info('Installing the planned wheels from "{0}"...'.format(
+                self.wheels_path))
+            try:
+                install_wheels(wheels, self.virtualenv)
+                mode = None
+            except (Exception, SystemExit) as ex:
+                lgr.warning('Offline installation failed ({0}).'.format(
+                    str(ex)))
+                mode = 'online'
+        self._install_module(module, mode, requirement_files, wheels)
+        self._log_activate_command()
+
+    def _prepare_environment(self, prerequisites=None,
+                             pythondev_command=None):
+        self.install_prerequisites(prerequisites, pythondev_command)
 
-        if IS_LINUX and (self.force or self.installpythondev):
-            self.install_pythondev(self.distro)
         if (IS_VIRTUALENV or self.virtualenv) and not IS_WIN:
             # drop root permissions so that installation is done using the
             # current user.
             drop_root_privileges()
         if self.virtualenv:
             if not os.path.isfile(os.path.join(
-                    env_bin_path, ('activate.bat' if IS_WIN else 'activate'))):
+                    _get_env_bin_path(self.virtualenv),
+                    ('activate.bat' if IS_WIN else 'activate'))):
                 make_virtualenv(self.virtualenv, self.python_path)
 
         if IS_WIN and (self.force or self.installpycrypto):
             self.install_pycrypto(self.virtualenv)
 
-        # if withrequirements is not provided, this will be False.
-        # if it's provided without a value, it will be a list.
-        if isinstance(self.withrequirements, list):
-            self.withrequirements = self.withrequirements \
-                or self._get_default_requirement_files(self.source)
-
-        if self.force_online or not os.path.isdir(self.wheels_path):
-            install_module(module=module,
-                           version=self.version,
-                           pre=self.pre,
-                           virtualenv_path=self.virtualenv,
-                           requirement_files=self.withrequirements,
-                           upgrade=self.upgrade)
-        elif os.path.isdir(self.wheels_path):
+    def _install_module(self, module, mode, requirement_files, wheels):
+        if mode == 'offline':
             lgr.info('Wheels directory found: "{0}". '
                      'Attemping offline installation...'.format(
                          self.wheels_path))
@@ -384,32 +1346,104 @@ class CloudifyInstaller():
                                pre=True,
                                virtualenv_path=self.virtualenv,
                                wheelspath=self.wheels_path,
-                               requirement_files=self.withrequirements,
+                               requirement_files=requirement_files,
                                upgrade=self.upgrade)
-            except Exception as ex:
+            except (Exception, SystemExit) as ex:
                 lgr.warning('Offline installation failed ({0}).'.format(
                     str(ex)))
-                install_module(module=module,
-                               version=self.version,
-                               pre=self.pre,
-                               virtualenv_path=self.virtualenv,
-                               requirement_files=self.withrequirements,
-                               upgrade=self.upgrade)
+                mode = 'online'
+        if mode == 'hybrid':
+            # the rest is then downloaded by installing the module online.
+            lgr.info('Installing the wheels found in "{0}"...'.format(
+                self.wheels_path))
+            install_wheels(wheels, self.virtualenv)
+        if mode in ('online', 'hybrid'):
+            install_module(module=module,
+                           version=self.version,
+                           pre=self.pre,
+                           virtualenv_path=self.virtualenv,
+                           requirement_files=requirement_files,
+                           upgrade=self.upgrade,
+                           find_links=mode == 'hybrid' and self.wheels_path)
+
+    def _log_activate_command(self):
         if self.virtualenv:
-            activate_path = os.path.join(env_bin_path, 'activate')
+            activate_path = os.path.join(
+                _get_env_bin_path(self.virtualenv), 'activate')
             activate_command = \
                 '{0}.bat'.format(activate_path) if IS_WIN \
                 else 'source {0}'.format(activate_path)
             lgr.info('You can now run: "{0}" to activate '
                      'the Virtualenv.'.format(activate_command))
 
+    def choose_install_mode(self, module):
+        """Picks the installation mode before installing anything
+
+        The module and requirement files are resolved against the
+        wheelhouse's index. If it satisfies all of them, the installation
+        is offline. If it satisfies some of them, it's hybrid: the wheels
+        found are installed and only the missing ones are downloaded. With
+        --savewheels, these are saved to the wheelhouse and the
+        installation is then offline. Otherwise, or with --forceonline,
+        the installation is online. Offline installations which fail
+        anyway fall back to online ones.
+
+        The wheels found and the requirements missing from the wheelhouse
+        are kept in `local_wheels` and `missing_wheels`.
+        """
+        self.local_wheels, self.missing_wheels = [], []
+        if self.force_online or not os.path.isdir(self.wheels_path):
+            return 'online'
+        requirements = read_requirement_files(self.withrequirements)
+        # a --source path or url is left for pip to resolve.
+        if not (os.path.exists(module) or '://' in module):
+            if self.version:
+                module += self.version if self.version[0] in '=<>!~' \
+                    else '==' + self.version
+            requirements.insert(0, module)
+        self.local_wheels, self.missing_wheels = \
+            WheelIndex(self.wheels_path).resolve(requirements, self.pre)
+        if not self.missing_wheels:
+            return 'offline'
+        lgr.warning('Wheels missing from "{0}": {1}.'.format(
+            self.wheels_path, ', '.join(self.missing_wheels)))
+        return 'hybrid' if self.local_wheels else 'online'
+
+    def get_prerequisites(self):
+        """Returns the names of the prerequisites to install"""
+        prerequisites = []
+        if self.force or self.installpip:
+            prerequisites.append('pip')
+        if self.virtualenv and (self.force or self.installvirtualenv):
+            prerequisites.append('virtualenv')
+        if IS_LINUX and (self.force or self.installpythondev):
+            prerequisites.append('python-dev')
+        return prerequisites
+
+    def install_prerequisites(self, prerequisites=None,
+                              pythondev_command=None):
+        """Installs pip, virtualenv and python-dev, as requested
+
+        python-dev is installed by the system's package manager while pip
+        is installed. virtualenv is installed using pip, so it waits for it.
+        """
+        if prerequisites is None:
+            prerequisites = self.get_prerequisites()
+        steps = []
+        if 'pip' in prerequisites:
+            steps.append(Step('Installing pip', self.install_pip))
+        if 'virtualenv' in prerequisites:
+            steps.append(Step('Installing virtualenv',
+                              self.install_virtualenv, depends=steps[:]))
+        if 'python-dev' in prerequisites:
+            steps.append(Step('Installing python-dev',
+                              lambda: self.install_pythondev(
+                                  self.distro, pythondev_command)))
+        run_steps(steps)
+
     @staticmethod
     def find_virtualenv():
-        try:
-            import virtualenv  # NOQA
-            return True
-        except:
-            return False
+        return probe_installed('virtualenv') is not None
 
     def install_virtualenv(self):
         if not self.find_virtualenv():
@@ -418,13 +1452,9 @@ class CloudifyInstaller():
         else:
             lgr.info('virtualenv is already installed in the path.')
 
-    @staticmethod
-    def find_pip():
-        try:
-            import pip  # NOQA
-            return True
-        except:
-            return False
+    def find_pip(self):
+        # pip is installed for the python at `python_path`.
+        return probe_installed('pip', self.python_path) is not None
 
     def install_pip(self):
         lgr.info('Installing pip...')
@@ -446,56 +1476,77 @@ class CloudifyInstaller():
         else:
             lgr.info('pip is already installed in the path.')
 
-    @staticmethod
-    def _get_default_requirement_files(source):
+    def _get_default_requirement_files(self, source):
         if os.path.isdir(source):
             return [os.path.join(source, f) for f in REQUIREMENT_FILE_NAMES
                     if os.path.isfile(os.path.join(source, f))]
+        tempdir = tempfile.mkdtemp()
+        self.tempdirs.append(tempdir)
+        # the requirement files are fetched on their own when possible.
+        if GITHUB_ARCHIVE_URL.match(source):
+            fetch = fetch_github_requirement_files
+        elif source.endswith('.zip'):
+            fetch = fetch_zip_requirement_files
         else:
-            tempdir = tempfile.mkdtemp()
-            archive = os.path.join(tempdir, 'cli_source')
-            # TODO: need to handle deletion of the temp source dir
+            fetch = None
+        if fetch:
             try:
-                download_file(source, archive)
-            except Exception as ex:
-                lgr.error('Could not download {0} ({1})'.format(
-                    source, str(ex)))
-                sys.exit(1)
+                return fetch(source, tempdir)
+            except (IOError, httplib.HTTPException, zipfile.BadZipfile) as ex:
+                lgr.warning('Could not fetch the requirement files of {0} '
+                            '({1}). Reading the whole archive...'.format(
+                                source, ex))
+
+        if not source.endswith('.zip'):
             try:
-                untar_requirement_files(archive, tempdir)
+                return stream_requirement_files(source, tempdir)
             except Exception as ex:
-                lgr.error('Could not extract {0} ({1})'.format(
-                    archive, str(ex)))
+                lgr.error('Could not extract the requirement files of {0} '
+                          '({1})'.format(source, str(ex)))
                 sys.exit(1)
-            finally:
-                os.remove(archive)
-            # GitHub always adds a single parent directory to the tree.
-            # TODO: look in parent dir, then one level underneath.
-            # the GitHub style tar assumption isn't a very good one.
-            req_dir = os.path.join(tempdir, os.listdir(tempdir)[0])
-            return [os.path.join(req_dir, f) for f in REQUIREMENT_FILE_NAMES
-                    if os.path.isfile(os.path.join(req_dir, f))]
+        # a zip archive can only be read once it's downloaded.
+        archive = os.path.join(tempdir, 'cli_source')
+        try:
+            download_file(source, archive)
+        except Exception as ex:
+            lgr.error('Could not download {0} ({1})'.format(
+                source, str(ex)))
+            sys.exit(1)
+        try:
+            return unzip_requirement_files(archive, tempdir)
+        except Exception as ex:
+            lgr.error('Could not extract {0} ({1})'.format(
+                archive, str(ex)))
+            sys.exit(1)
+        finally:
+            os.remove(archive)
 
-    def install_pythondev(self, distro):
-        """Installs python-dev and gcc
+    @staticmethod
+    def get_pythondev_command(distro):
+        """Returns the command installing python-dev and gcc, if needed
 
         This will try to match a command for your platform and distribution.
         """
-        lgr.info('Installing python-dev...')
         if distro in ('ubuntu', 'debian'):
-            cmd = 'apt-get install -y gcc python-dev'
+            return 'apt-get install -y gcc python-dev'
         elif distro in ('centos', 'redhat', 'fedora'):
-            cmd = 'yum -y install gcc python-devel'
+            return 'yum -y install gcc python-devel'
         elif os.path.isfile('/etc/arch-release'):
             # Arch doesn't require a python-dev package.
             # It's already supplied with Python.
-            cmd = 'pacman -S gcc --noconfirm'
+            return 'pacman -S gcc --noconfirm'
         elif IS_DARWIN:
+            return None
+        sys.exit('python-dev package installation not supported '
+                 'in current distribution.')
+
+    def install_pythondev(self, distro, cmd=None):
+        """Installs python-dev and gcc, using `cmd` if provided"""
+        lgr.info('Installing python-dev...')
+        cmd = cmd or self.get_pythondev_command(distro)
+        if not cmd:
             lgr.info('python-dev package not required on Darwin.')
             return
-        else:
-            sys.exit('python-dev package installation not supported '
-                     'in current distribution.')
         run(cmd)
 
     # Windows only
@@ -520,18 +1571,10 @@ class CloudifyInstaller():
 
 
 def check_cloudify_installed(virtualenv_path=None):
-    if virtualenv_path:
-        result = run(
-            os.path.join(_get_env_bin_path(virtualenv_path),
-                         'python -c "import cloudify"'),
-            suppress_errors=True)
-        return result.returncode == 0
-    else:
-        try:
-            import cloudify  # NOQA
-            return True
-        except ImportError:
-            return False
+    version = probe_installed('cloudify', virtualenv_path=virtualenv_path)
+    if version:
+        lgr.debug('Found Cloudify {0}.'.format(version))
+    return version is not None
 
 
 def handle_upgrade(upgrade=False, virtualenv=''):
@@ -557,6 +1600,7 @@ def parse_args(args=None):
     default_group = parser.add_mutually_exclusive_group()
     version_group = parser.add_mutually_exclusive_group()
     online_group = parser.add_mutually_exclusive_group()
+    plan_group = parser.add_mutually_exclusive_group()
     default_group.add_argument('-v', '--verbose', action='store_true',
                                help='Verbose level logging to shell.')
     default_group.add_argument('-q', '--quiet', action='store_true',
@@ -599,6 +1643,18 @@ def parse_args(args=None):
             '--pythonpath', type=str, default='python',
             help='Python path to use (defaults to "python") '
                  'when creating a virtualenv.')
+    parser.add_argument(
+        '--savewheels', action='store_true',
+        help='Save wheels missing from --wheelspath to it, rather than '
+             'only installing them.')
+    plan_group.add_argument(
+        '--plan', type=str, metavar='PATH',
+        help='Resolve the installation into a plan written to PATH, '
+             'without installing anything.')
+    plan_group.add_argument(
+        '--apply-plan', type=str, metavar='PATH',
+        help='Install as planned by --plan, without resolving anything. '
+             'All other installation arguments are taken from the plan.')
     parser.add_argument(
         '--installpip', action='store_true',
         help='Attempt to install pip.')
@@ -627,9 +1683,23 @@ if __name__ == '__main__':
         lgr.setLevel(logging.DEBUG)
     else:
         lgr.setLevel(logging.INFO)
-    handle_upgrade(args.upgrade, args.virtualenv)
-
-    xargs = ['quiet', 'verbose']
-    args = {arg: v for arg, v in vars(args).items() if arg not in xargs}
-    installer = CloudifyInstaller(**args)
-    installer.execute()
+    if args.apply_plan:
+        with open(args.apply_plan) as f:
+            plan = json.load(f)
+        handle_upgrade(plan['settings']['upgrade'],
+                       plan['settings']['virtualenv'])
+        installer = CloudifyInstaller(os_distro=plan['distro'],
+                                      os_release=plan['release'],
+                                      **plan['settings'])
+        installer.apply_plan(plan)
+        sys.exit()
+    if not args.plan:
+        handle_upgrade(args.upgrade, args.virtualenv)
+
+    xargs = ['quiet', 'verbose', 'plan', 'apply_plan']
+    installer = CloudifyInstaller(
+        **{arg: v for arg, v in vars(args).items() if arg not in xargs})
+    if args.plan:
+        installer.write_plan(args.plan)
+    else:
+        installer.execute()
@@ -14,18 +14,92 @@
 # limitations under the License.
 ############
 import testtools
+import functools
 import urllib
+import urllib2
+import BaseHTTPServer
 import tempfile
 from StringIO import StringIO
 import mock
+import json
 import shutil
 import os
+import sys
 import tarfile
+import zipfile
+import threading
+from contextlib import closing
 
 
 get_cloudify = __import__("get-cloudify")
 
 
+class RangeFileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves `server.content` at /file*, supporting Range requests"""
+
+    def do_GET(self):
+        self.server.requests.append(self.headers)
+        if not self.path.startswith('/file'):
+            self.send_error(404)
+            return
+        content = self.server.content
+        start, end = 0, len(content)
+        byte_range = self.headers.get('Range')
+        if byte_range:
+            first, last = byte_range[len('bytes='):].split('-')
+            if not first:
+                start = max(0, len(content) - int(last))
+            else:
+                start = int(first)
+                end = int(last) + 1 if last else end
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, end - 1, len(content)))
+        else:
+            self.send_response(200)
+        body = content[start:end]
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+        self.send_body(body)
+
+    def send_body(self, body):
+        self.server.sent += len(body)
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FlakyFileHandler(RangeFileHandler):
+    """Cuts the first response of every server short after `cut` bytes"""
+    cut = 100000
+
+    def send_body(self, body):
+        if len(self.server.requests) == 1:
+            body = body[:self.cut]
+        RangeFileHandler.send_body(self, body)
+
+
+class UnsatisfiableRangeHandler(FlakyFileHandler):
+    """Answers every Range request with a 416"""
+
+    def do_GET(self):
+        if self.headers.get('Range'):
+            self.server.requests.append(self.headers)
+            self.send_error(416)
+            return
+        FlakyFileHandler.do_GET(self)
+
+
+class NoContentRangeHandler(RangeFileHandler):
+    """Answers Range requests without a Content-Range, as some proxies do"""
+
+    def send_header(self, keyword, value):
+        if keyword != 'Content-Range':
+            RangeFileHandler.send_header(self, keyword, value)
+
+
 class CliBuilderUnitTests(testtools.TestCase):
     """Unit tests for functions in get_cloudify.py"""
 
@@ -78,6 +152,99 @@ class CliBuilderUnitTests(testtools.TestCase):
         self.assertIsNot(proc.returncode, 0, 'command \'{}\' execution was '
                                              'expected to fail'.format(cmd))
 
+    def test_run_drains_output(self):
+        cmd = ('{0} -c "import sys\n'
+               'for i in range(20000): sys.stdout.write(str(i) + chr(10))\n'
+               'sys.stderr.write(\'err\')"'.format(sys.executable))
+        proc = self.get_cloudify.run(cmd, suppress_errors=True)
+        self.assertEqual(proc.returncode, 0)
+        self.assertEqual(
+            ''.join(str(i) + '\n' for i in range(20000)), proc.aggr_stdout)
+        self.assertEqual('err', proc.aggr_stderr)
+
+    def test_run_windows_pipe_threads(self):
+        self.get_cloudify.IS_WIN = True
+        try:
+            proc = self.get_cloudify.run('echo Hi! && echo Bye! 1>&2',
+                                         suppress_errors=True)
+        finally:
+            self.get_cloudify.IS_WIN = False
+        self.assertEqual('Hi!', proc.aggr_stdout.strip())
+        self.assertEqual('Bye!', proc.aggr_stderr.strip())
+
+    def test_output_buffer_in_memory(self):
+        output = self.get_cloudify.OutputBuffer(10)
+        for chunk in ('12345', '678', '90'):
+            output.write(chunk)
+        self.assertFalse(output.spilled)
+        self.assertEqual('1234567890', output.getvalue())
+
+    def test_output_buffer_spills_to_file(self):
+        output = self.get_cloudify.OutputBuffer(10)
+        for chunk in ('12345', '678', '90abc'):
+            output.write(chunk)
+        self.assertTrue(output.spilled)
+        self.assertEqual('1234567890abc', output.getvalue())
+        output.write('def')
+        self.assertEqual('1234567890abcdef', output.getvalue())
+
+    def test_run_spills_large_output(self):
+        self.get_cloudify.OUTPUT_MEMORY_LIMIT = 1000
+        try:
+            proc = self.get_cloudify.run(
+                '{0} -c "print(\'x\' * 5000)"'.format(sys.executable))
+        finally:
+            self.get_cloudify.OUTPUT_MEMORY_LIMIT = 1024 * 1024
+        self.assertTrue(proc.stdout_buffer.spilled)
+        self.assertEqual('x' * 5000 + '\n', proc.aggr_stdout)
+
+    def test_run_steps_concurrently(self):
+        started = threading.Event()
+        order = []
+
+        def first():
+            # only returns if the second step runs alongside it.
+            self.assertTrue(started.wait(5))
+            order.append('first')
+
+        def second():
+            started.set()
+            order.append('second')
+
+        first_step = self.get_cloudify.Step('first', first)
+        steps = [first_step,
+                 self.get_cloudify.Step('second', second),
+                 self.get_cloudify.Step('third', lambda: order.append('third'),
+                                        depends=[first_step])]
+        self.get_cloudify.run_steps(steps)
+        self.assertEqual(['second', 'first', 'third'], order)
+        self.assertTrue(all(step.duration is not None for step in steps))
+
+    def test_run_steps_failure(self):
+        def fail():
+            sys.exit('Boom!')
+
+        failing = self.get_cloudify.Step('failing', fail)
+        dependent = self.get_cloudify.Step('dependent', mock.Mock(),
+                                           depends=[failing])
+        ex = self.assertRaises(
+            SystemExit, self.get_cloudify.run_steps, [failing, dependent])
+        self.assertEqual('Boom!', ex.message)
+        self.assertFalse(dependent.func.called)
+
+    def test_install_prerequisites(self):
+        self.get_cloudify.IS_LINUX = True
+        installer = self.get_cloudify.CloudifyInstaller(
+            force=True, virtualenv='venv', os_distro='ubuntu')
+        calls = []
+        installer.install_pip = lambda: calls.append('pip')
+        installer.install_virtualenv = lambda: calls.append('virtualenv')
+        installer.install_pythondev = \
+            lambda distro, cmd: calls.append(distro)
+        installer.install_prerequisites()
+        self.assertEqual(['pip', 'ubuntu', 'virtualenv'], sorted(calls))
+        self.assertLess(calls.index('pip'), calls.index('virtualenv'))
+
     def test_install_pip_failed_download(self):
         installer = self.get_cloudify.CloudifyInstaller()
 
@@ -126,6 +293,72 @@ class CliBuilderUnitTests(testtools.TestCase):
         self.assertEqual(
             'Could not install module: nonexisting_module.', ex.message)
 
+    def _serve(self, content, handler=RangeFileHandler):
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), handler)
+        server.content = content
+        server.requests = []
+        server.sent = 0
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.shutdown)
+        self.addCleanup(setattr, self.get_cloudify, 'DOWNLOAD_BACKOFF',
+                        self.get_cloudify.DOWNLOAD_BACKOFF)
+        self.get_cloudify.DOWNLOAD_BACKOFF = 0
+        return server, 'http://127.0.0.1:{0}'.format(server.server_port)
+
+    def test_download_file_resumes(self):
+        content = ''.join(chr(i % 256) for i in range(300000))
+        server, url = self._serve(content, FlakyFileHandler)
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        destination = os.path.join(tempdir, 'file')
+        self.get_cloudify.download_file(url + '/file', destination)
+        with open(destination, 'rb') as f:
+            self.assertEqual(content, f.read())
+        self.assertEqual(2, len(server.requests))
+        self.assertEqual('bytes={0}-'.format(FlakyFileHandler.cut),
+                         server.requests[1]['Range'])
+        self.assertEqual('"v1"', server.requests[1]['If-Range'])
+        self.assertEqual([destination.split(os.sep)[-1]],
+                         os.listdir(tempdir))
+
+    def test_download_file_restarts(self):
+        content = ''.join(chr(i % 256) for i in range(300000))
+        server, url = self._serve(content, UnsatisfiableRangeHandler)
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        destination = os.path.join(tempdir, 'file')
+        self.get_cloudify.download_file(url + '/file', destination)
+        with open(destination, 'rb') as f:
+            self.assertEqual(content, f.read())
+        # the partial file is dropped, and downloaded again from scratch.
+        self.assertEqual(3, len(server.requests))
+        self.assertIsNone(server.requests[2].get('Range'))
+
+    def test_download_file_restarts_out_of_retries(self):
+        self.addCleanup(setattr, self.get_cloudify, 'DOWNLOAD_RETRIES',
+                        self.get_cloudify.DOWNLOAD_RETRIES)
+        self.get_cloudify.DOWNLOAD_RETRIES = 1
+        server, url = self._serve('x' * 300000, UnsatisfiableRangeHandler)
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        ex = self.assertRaises(
+            urllib2.HTTPError, self.get_cloudify.download_file,
+            url + '/file', os.path.join(tempdir, 'file'))
+        self.assertEqual(416, ex.code)
+        self.assertEqual(2, len(server.requests))
+
+    def test_download_file_not_found(self):
+        server, url = self._serve('')
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        ex = self.assertRaises(
+            urllib2.HTTPError, self.get_cloudify.download_file,
+            url + '/missing', os.path.join(tempdir, 'file'))
+        self.assertEqual(404, ex.code)
+        self.assertEqual(1, len(server.requests))
+
     def test_get_os_props(self):
         distro = self.get_cloudify.get_os_props()[0]
         distros = ('ubuntu', 'redhat', 'debian', 'fedora', 'centos',
@@ -163,17 +396,359 @@ class CliBuilderUnitTests(testtools.TestCase):
             shutil.rmtree(tmp_venv)
 
     def test_get_requirements_from_source_url(self):
-        def get(url, destination):
-            return self._create_dummy_requirements_tar(url, destination)
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        archive = self._create_dummy_requirements_tar(
+            None, os.path.join(tempdir, 'source.tar.gz'))
+        with open(archive, 'rb') as f:
+            server, url = self._serve(f.read())
 
-        self.get_cloudify.download_file = get
+        installer = self.get_cloudify.CloudifyInstaller()
+        req_list = installer._get_default_requirement_files(
+            url + '/file.tar.gz')
+        self.addCleanup(shutil.rmtree, installer.tempdirs[0])
+        self.assertEquals(len(req_list), 1)
+        self.assertIn('dev-requirements.txt', req_list[0])
+        # the archive is streamed, rather than written to disk.
+        self.assertEqual(['maindir'], os.listdir(installer.tempdirs[0]))
+        self.assertIsNone(server.requests[0].get('Range'))
+
+    def test_untar_requirement_files_stream(self):
+        archive = StringIO()
+        tar = tarfile.open(fileobj=archive, mode='w:gz')
+        for name, content in (('maindir/a/b/requirements.txt', 'deep'),
+                              ('maindir/requirements.txt', 'a==1'),
+                              ('maindir/setup.py', ''),
+                              ('maindir/dev-requirements.txt', 'b==2'),
+                              ('maindir/filler', os.urandom(1024 * 1024))):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, StringIO(content))
+        tar.close()
+        size = archive.tell()
+        archive.seek(0)
+        # a file object which can't seek, like an HTTP response.
+        stream = mock.Mock(read=archive.read)
+
+        tempdir = tempfile.mkdtemp()
         try:
-            installer = self.get_cloudify.CloudifyInstaller()
-            req_list = installer._get_default_requirement_files('null')
-            self.assertEquals(len(req_list), 1)
-            self.assertIn('dev-requirements.txt', req_list[0])
+            self.get_cloudify.untar_requirement_files(stream, tempdir)
+            self.assertEqual(
+                ['dev-requirements.txt', 'requirements.txt'],
+                sorted(os.listdir(os.path.join(tempdir, 'maindir'))))
+            with open(os.path.join(
+                    tempdir, 'maindir', 'requirements.txt')) as f:
+                self.assertEqual('a==1', f.read())
         finally:
-            self.get_cloudify.download_file = get_cloudify.download_file
+            shutil.rmtree(tempdir)
+        self.assertLess(archive.tell(), size)
+
+    def test_remote_file_without_content_range(self):
+        server, url = self._serve('x' * 100, NoContentRangeHandler)
+        self.assertRaises(IOError, self.get_cloudify.RemoteFile, url + '/file')
+
+    def test_get_requirements_from_github(self):
+        def download(url, destination):
+            if url.endswith('/dev-requirements.txt'):
+                raise urllib2.HTTPError(url, 404, 'Not Found', {}, None)
+            with open(destination, 'w') as f:
+                f.write(url)
+
+        installer = self.get_cloudify.CloudifyInstaller()
+        with mock.patch.object(self.get_cloudify, 'download_file', download):
+            req_list = installer._get_default_requirement_files(
+                'https://github.com/cloudify-cosmo/cloudify-cli/archive/'
+                '3.2.tar.gz')
+        self.addCleanup(shutil.rmtree, installer.tempdirs[0])
+        self.assertEqual(1, len(req_list))
+        with open(req_list[0]) as f:
+            self.assertEqual(
+                'https://raw.githubusercontent.com/cloudify-cosmo/'
+                'cloudify-cli/3.2/requirements.txt', f.read())
+
+    def test_get_requirements_from_zip(self):
+        archive = StringIO()
+        with closing(zipfile.ZipFile(archive, 'w')) as zip_file:
+            zip_file.writestr('maindir/requirements.txt', 'a==1')
+            zip_file.writestr('maindir/filler', os.urandom(1024 * 1024))
+            zip_file.writestr('maindir/dev-requirements.txt', 'b==2')
+            zip_file.writestr('maindir/sub/requirements.txt', 'c==3')
+        server, url = self._serve(archive.getvalue())
+
+        installer = self.get_cloudify.CloudifyInstaller()
+        req_list = installer._get_default_requirement_files(url + '/file.zip')
+        tempdir = installer.tempdirs[0]
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.assertEqual(
+            [os.path.join(tempdir, 'maindir', name) for name in
+             ('dev-requirements.txt', 'requirements.txt')], req_list)
+        with open(req_list[1]) as f:
+            self.assertEqual('a==1', f.read())
+        self.assertLess(server.sent, len(archive.getvalue()) / 2)
+
+    def test_get_requirements_fallback(self):
+        archive = StringIO()
+        with closing(zipfile.ZipFile(archive, 'w')) as zip_file:
+            zip_file.writestr('maindir/requirements.txt', '')
+        server, url = self._serve(archive.getvalue(), NoContentRangeHandler)
+
+        installer = self.get_cloudify.CloudifyInstaller()
+        req_list = installer._get_default_requirement_files(url + '/file.zip')
+        tempdir = installer.tempdirs[0]
+        self.assertEqual(
+            [os.path.join(tempdir, 'maindir', 'requirements.txt')], req_list)
+        self.assertEqual(['maindir'], os.listdir(tempdir))
+        with mock.patch.object(installer, '_install'):
+            installer.execute()
+        self.assertFalse(os.path.exists(tempdir))
+
+    @staticmethod
+    def _make_wheel(path, name, version, requires=(), python='py2.py3',
+                    abi='none', platform='any'):
+        filename = '{0}-{1}-{2}-{3}-{4}.whl'.format(
+            name, version, python, abi, platform)
+        with closing(zipfile.ZipFile(os.path.join(path, filename), 'w')) as w:
+            w.writestr('{0}-{1}.dist-info/METADATA'.format(name, version),
+                       'Name: {0}\nVersion: {1}\n{2}'.format(
+                           name, version, ''.join(
+                               'Requires-Dist: {0}\n'.format(r)
+                               for r in requires)))
+        return filename
+
+    def _make_wheelhouse(self):
+        wheelhouse = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, wheelhouse)
+        self._make_wheel(wheelhouse, 'cloudify', '3.2',
+                         ['cloudify_rest_client (>=3.2)',
+                          'pytest; extra == "test"'])
+        self._make_wheel(wheelhouse, 'cloudify_rest_client', '3.1')
+        self._make_wheel(wheelhouse, 'cloudify_rest_client', '3.2',
+                         ['requests>=2.7,<3'])
+        self._make_wheel(wheelhouse, 'py3only', '1.0', python='py3')
+        return wheelhouse
+
+    def test_version_matches(self):
+        matches = self.get_cloudify.version_matches
+        self.assertTrue(matches('2.7.0', '>=2.7,<3'))
+        self.assertFalse(matches('3.0', '>=2.7,<3'))
+        self.assertTrue(matches('3.2.1', '==3.2.*'))
+        self.assertFalse(matches('3.2.1', '!=3.2.*'))
+        self.assertTrue(matches('1.4.2', '~=1.4'))
+        self.assertFalse(matches('2.0', '~=1.4'))
+        self.assertTrue(matches('1.0', ''))
+        self.assertTrue(matches('3', '==3.0.*'))
+        self.assertTrue(matches('1.4rc1', '~=1.3'))
+        # pre releases come before their final release.
+        self.assertFalse(matches('1.0rc1', '>=1.0'))
+        self.assertTrue(matches('1.0', '>1.0rc1'))
+        self.assertTrue(matches('1.10', '>1.9'))
+
+    def test_wheel_index_pre_releases(self):
+        wheelhouse = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, wheelhouse)
+        for version in ('1.0rc1', '1.0', '1.1rc1'):
+            self._make_wheel(wheelhouse, 'cloudify', version)
+        index = self.get_cloudify.WheelIndex(wheelhouse)
+        self.assertEqual('1.0', index.find('cloudify')['version'])
+        self.assertEqual('1.0', index.find('cloudify', '>=1.0')['version'])
+        self.assertEqual('1.1rc1',
+                         index.find('cloudify', pre=True)['version'])
+        self.assertEqual('1.1rc1',
+                         index.find('cloudify', '>=1.1rc1')['version'])
+        self.assertIsNone(index.find('cloudify', '>1.0'))
+
+    def test_wheel_index_platforms(self):
+        wheelhouse = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, wheelhouse)
+        pythons, abis, platforms = self.get_cloudify.wheel_tags()
+        self._make_wheel(wheelhouse, 'native', '1.0', python='cp34',
+                         abi='cp34m', platform=platforms[1])
+        self._make_wheel(wheelhouse, 'native', '0.9', python='cp27',
+                         abi=abis[1], platform='win_amd64')
+        self._make_wheel(wheelhouse, 'native', '0.8', python='cp27',
+                         abi=abis[1], platform=platforms[1])
+        index = self.get_cloudify.WheelIndex(wheelhouse)
+        self.assertEqual(
+            'native-0.8-cp27-{0}-{1}.whl'.format(abis[1], platforms[1]),
+            index.find('native')['filename'])
+
+    def test_wheel_index_resolve(self):
+        index = self.get_cloudify.WheelIndex(self._make_wheelhouse())
+        wheels, missing = index.resolve(['cloudify', 'py3only'])
+        self.assertEqual(
+            ['cloudify_rest_client-3.2-py2.py3-none-any.whl',
+             'cloudify-3.2-py2.py3-none-any.whl'],
+            [wheel['filename'] for wheel in wheels])
+        self.assertEqual(['requests>=2.7,<3', 'py3only'], missing)
+
+    def test_wheel_index_cached(self):
+        wheelhouse = self._make_wheelhouse()
+        self.get_cloudify.WheelIndex(wheelhouse)
+        self.assertTrue(os.path.isfile(os.path.join(
+            wheelhouse, self.get_cloudify.WHEEL_INDEX_FILE_NAME)))
+        self._make_wheel(wheelhouse, 'requests', '2.7.0')
+        with mock.patch.object(
+                self.get_cloudify.WheelIndex, '_read_wheel',
+                side_effect=self.get_cloudify.WheelIndex._read_wheel,
+                autospec=True) as read_wheel:
+            index = self.get_cloudify.WheelIndex(wheelhouse)
+        self.assertEqual(1, read_wheel.call_count)
+        self.assertEqual('2.7.0', index.find('Requests')['version'])
+
+    def test_choose_install_mode(self):
+        wheelhouse = self._make_wheelhouse()
+        installer = self.get_cloudify.CloudifyInstaller(wheelspath=wheelhouse)
+        self.assertEqual('hybrid', installer.choose_install_mode('cloudify'))
+        self.assertEqual('online', installer.choose_install_mode('missing'))
+        self._make_wheel(wheelhouse, 'requests', '2.7.0')
+        self.assertEqual('offline', installer.choose_install_mode('cloudify'))
+        installer.version = '3.3'
+        self.assertEqual('online', installer.choose_install_mode('cloudify'))
+        installer.version = ''
+        installer.force_online = True
+        self.assertEqual('online', installer.choose_install_mode('cloudify'))
+
+    def _execute_with_wheelhouse(self, **kwargs):
+        wheelhouse = self._make_wheelhouse()
+        installer = self.get_cloudify.CloudifyInstaller(
+            wheelspath=wheelhouse, **kwargs)
+        with mock.patch.multiple(
+                self.get_cloudify, install_module=mock.DEFAULT,
+                install_wheels=mock.DEFAULT,
+                download_wheels=mock.DEFAULT) as mocks:
+            installer.execute()
+        return wheelhouse, mocks
+
+    def test_execute_hybrid(self):
+        wheelhouse, mocks = self._execute_with_wheelhouse()
+        mocks['install_wheels'].assert_called_once_with(
+            [os.path.join(wheelhouse, wheel) for wheel in
+             ('cloudify_rest_client-3.2-py2.py3-none-any.whl',
+              'cloudify-3.2-py2.py3-none-any.whl')], '')
+        self.assertFalse(mocks['download_wheels'].called)
+        self.assertEqual(
+            wheelhouse, mocks['install_module'].call_args[1]['find_links'])
+
+    def test_execute_hybrid_saves_wheels(self):
+        wheelhouse, mocks = self._execute_with_wheelhouse(savewheels=True)
+        mocks['download_wheels'].assert_called_once_with(
+            ['requests>=2.7,<3'], wheelhouse, '', False)
+        self.assertFalse(mocks['install_wheels'].called)
+        self.assertEqual(
+            wheelhouse, mocks['install_module'].call_args[1]['wheelspath'])
+
+    def _make_plan(self):
+        wheelhouse = self._make_wheelhouse()
+        self._make_wheel(wheelhouse, 'requests', '2.7.0')
+        plan_file = os.path.join(wheelhouse, 'plan.json')
+        installer = self.get_cloudify.CloudifyInstaller(wheelspath=wheelhouse)
+        with mock.patch.multiple(
+                self.get_cloudify, install_module=mock.DEFAULT,
+                install_wheels=mock.DEFAULT) as mocks:
+            installer.write_plan(plan_file)
+        self.assertFalse(mocks['install_module'].called)
+        self.assertFalse(mocks['install_wheels'].called)
+        with open(plan_file) as f:
+            return wheelhouse, json.load(f)
+
+    def test_make_plan(self):
+        wheelhouse, plan = self._make_plan()
+        self.assertEqual('offline', plan['mode'])
+        self.assertTrue(plan['complete'])
+        self.assertEqual(
+            ['requests-2.7.0-py2.py3-none-any.whl',
+             'cloudify_rest_client-3.2-py2.py3-none-any.whl',
+             'cloudify-3.2-py2.py3-none-any.whl'],
+            [wheel['filename'] for wheel in plan['wheels']])
+        for wheel in plan['wheels']:
+            self.assertEqual(
+                self.get_cloudify.file_sha256(
+                    os.path.join(wheelhouse, wheel['filename'])),
+                wheel['sha256'])
+
+    def test_apply_plan(self):
+        wheelhouse, plan = self._make_plan()
+        installer = self.get_cloudify.CloudifyInstaller(
+            os_distro=plan['distro'], os_release=plan['release'],
+            **plan['settings'])
+        with mock.patch.multiple(
+                self.get_cloudify, install_module=mock.DEFAULT,
+                install_wheels=mock.DEFAULT) as mocks:
+            installer.apply_plan(plan)
+        mocks['install_wheels'].assert_called_once_with(
+            [os.path.join(wheelhouse, wheel['filename'])
+             for wheel in plan['wheels']], '')
+        self.assertFalse(mocks['install_module'].called)
+
+    def test_apply_plan_changed_wheel(self):
+        wheelhouse, plan = self._make_plan()
+        self._make_wheel(wheelhouse, 'requests', '2.7.0', ['six'])
+        installer = self.get_cloudify.CloudifyInstaller(**plan['settings'])
+        with mock.patch.object(self.get_cloudify, 'install_wheels') as \
+                install_wheels:
+            self.assertRaises(SystemExit, installer.apply_plan, plan)
+        self.assertFalse(install_wheels.called)
+
+    def _make_venv(self):
+        venv = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, venv)
+        site_packages = os.path.join(venv, 'lib', 'python2.7', 'site-packages')
+        develop = os.path.join(venv, 'src', 'plugins-common')
+        for path in (
+                os.path.join(site_packages, 'cloudify-3.2.dist-info'),
+                os.path.join(site_packages, 'pip-7.1.0-py2.7.egg-info'),
+                os.path.join(site_packages, 'bare'),
+                os.path.join(develop, 'cloudify_plugins_common.egg-info'),
+                os.path.join(venv, 'src', 'rest', 'rest_client.egg-info')):
+            os.makedirs(path)
+        for path, content in (
+                (os.path.join(site_packages, 'cloudify-3.2.dist-info',
+                              'top_level.txt'), 'cloudify_cli\n'),
+                (os.path.join(site_packages, 'bare', '__init__.py'), ''),
+                (os.path.join(develop, 'cloudify_plugins_common.egg-info',
+                              'PKG-INFO'), 'Name: x\nVersion: 3.3a1\n'),
+                (os.path.join(develop, 'cloudify_plugins_common.egg-info',
+                              'top_level.txt'), 'cloudify\nmock_plugins\n'),
+                (os.path.join(site_packages, 'easy-install.pth'),
+                 'import sys\n{0}\n'.format(develop)),
+                (os.path.join(site_packages, 'rest-client.egg-link'),
+                 os.path.join(venv, 'src', 'rest') + '\n.'),
+                (os.path.join(site_packages, os.pardir,
+                              'no-global-site-packages.txt'), '')):
+            with open(path, 'w') as f:
+                f.write(content)
+        return venv, site_packages
+
+    def test_get_installed_version(self):
+        venv, site_packages = self._make_venv()
+        version = functools.partial(
+            self.get_cloudify.get_installed_version,
+            site_packages=[site_packages])
+        self.assertEqual('3.2', version('cloudify'))
+        self.assertEqual('7.1.0', version('pip'))
+        self.assertEqual('3.2', version('cloudify_cli'))
+        self.assertEqual('3.3a1', version('cloudify-plugins-common'))
+        self.assertEqual('3.3a1', version('mock_plugins'))
+        self.assertEqual('', version('rest_client'))
+        self.assertEqual('', version('bare'))
+        self.assertIsNone(version('virtualenv'))
+
+    def test_check_cloudify_installed_probe(self):
+        venv, _ = self._make_venv()
+        with mock.patch.object(self.get_cloudify, 'run') as run:
+            self.assertTrue(self.get_cloudify.check_cloudify_installed(venv))
+            self.assertIsNone(self.get_cloudify.probe_installed(
+                'nope', virtualenv_path=venv))
+        self.assertFalse(run.called)
+
+    def test_probe_installed_fallback(self):
+        venv = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, venv)
+        with mock.patch.object(self.get_cloudify, 'run') as run:
+            run.return_value.returncode = 0
+            self.assertEqual('', self.get_cloudify.probe_installed(
+                'cloudify', virtualenv_path=venv))
+        self.assertIn('import cloudify', run.call_args[0][0])
 
     def test_get_requirements_from_source_path(self):
         tempdir = tempfile.mkdtemp()
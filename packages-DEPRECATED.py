@@ -499,7 +499,9 @@ PACKAGES = {
             "https://download.elasticsearch.org/elasticsearch/elasticsearch/elasticsearch-1.3.2.tar.gz"
         ],
         "depends": [
-            'openjdk-7-jdk'
+            'openjdk-7-jdk',
+            # for es_schema_creator.py, run by the bootstrap script.
+            'python-pip'
         ],
         "package_path": "{0}/elasticsearch/".format(COMPONENT_PACKAGES_PATH),
         "sources_path": "{0}/elasticsearch".format(PACKAGES_PATH),
@@ -525,7 +527,14 @@ PACKAGES = {
                 "dst_dir": "/etc/init",
             },
             "__params_conf": {
-            }
+            },
+            # rendered rather than copied as a config dir, which would ship
+            # the whole init dir. the script has no template markup.
+            "__template_file_schema": {
+                "template": "{0}/elasticsearch/init/es_schema_creator.py".format(CONFIGS_PATH),
+                "output_file": "es_schema_creator.py",
+                "config_dir": "config/schema",
+            },
         }
     },
     "kibana3": {
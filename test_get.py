@@ -0,0 +1,823 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+import testtools
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import tarfile
+import tempfile
+import shutil
+import os
+import threading
+import subprocess
+from StringIO import StringIO
+from contextlib import closing
+from multiprocessing.pool import ThreadPool
+
+import mock
+import yaml
+
+import get
+
+PACKAGES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'packages.yaml')
+
+
+class FileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the content of `server.files` by path, with an ETag
+
+    Requests whose If-None-Match matches the ETag are answered with a 304.
+    The headers of each request are recorded in `server.requests`.
+    """
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers))
+        content = self.server.files.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return
+        etag = '"{0}"'.format(hashlib.sha256(content).hexdigest()[:8])
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class FileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class GetTest(testtools.TestCase):
+
+    def setUp(self):
+        super(GetTest, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self._patch('PACKAGES_FILE', PACKAGES_FILE)
+        self._patch('BUILD_REPORTS_PATH', os.path.join(self.tmp, 'reports'))
+        self.packages = get._load_packages()
+
+    def _patch(self, name, value):
+        self.addCleanup(setattr, get, name, getattr(get, name))
+        setattr(get, name, value)
+
+
+class BuildAgentsTest(GetTest):
+
+    def setUp(self):
+        super(BuildAgentsTest, self).setUp()
+        # agents are built in threads, so that they see the mocks below.
+        pool = mock.patch('multiprocessing.Pool', ThreadPool)
+        pool.start()
+        self.addCleanup(pool.stop)
+        self.built = []
+        self.failing = None
+        create_agent = mock.patch.object(get, 'create_agent', self._build)
+        create_agent.start()
+        self.addCleanup(create_agent.stop)
+
+    def _build(self, package, download=False, shared_sources=None,
+               **options):
+        if package['name'] == self.failing:
+            # packman exits on most errors.
+            raise SystemExit(1)
+        self.built.append((package['name'], threading.current_thread()))
+
+    def _names(self, *keys):
+        return [self.packages[key]['name'] for key in keys]
+
+    def test_conflicts(self):
+        precise = self.packages['Ubuntu-precise-agent']
+        trusty = self.packages['Ubuntu-trusty-agent']
+        jessie = self.packages['debian-jessie-agent']
+        centos = self.packages['centos-Final-agent']
+        # both are built in the same paths.
+        self.assertTrue(get._conflicts(precise, trusty))
+        # debian installs modules out of the Ubuntu agents' sources.
+        self.assertTrue(get._conflicts(jessie, precise))
+        self.assertTrue(get._conflicts(precise, jessie))
+        self.assertFalse(get._conflicts(centos, precise))
+        self.assertFalse(get._conflicts(centos, jessie))
+
+    def test_conflicts_nested_paths(self):
+        outer = {'sources_path': '/agents/env', 'package_path': '/out/a'}
+        inner = {'sources_path': '/agents/env/inner', 'package_path': '/out/b'}
+        sibling = {'sources_path': '/agents/env2', 'package_path': '/out/c'}
+        self.assertTrue(get._conflicts(outer, inner))
+        self.assertTrue(get._conflicts(inner, outer))
+        self.assertFalse(get._conflicts(outer, sibling))
+
+    def test_build_groups(self):
+        self.assertEqual(
+            [['centos-Final-agent'],
+             ['Ubuntu-precise-agent', 'Ubuntu-trusty-agent',
+              'debian-jessie-agent']],
+            get._build_groups(get.AGENT_PACKAGES, self.packages))
+
+    def test_build_groups_keep_order(self):
+        self.assertEqual(
+            [['centos-Final-agent'],
+             ['debian-jessie-agent', 'Ubuntu-precise-agent']],
+            get._build_groups(['debian-jessie-agent', 'centos-Final-agent',
+                               'Ubuntu-precise-agent'], self.packages))
+
+    def test_build_agents(self):
+        built = get.build_agents()
+        self.assertEqual(sorted(get.AGENT_PACKAGES), sorted(built))
+        names = [name for name, _ in self.built]
+        ubuntu = [n for n in names if n != 'centos-Final-agent']
+        self.assertEqual(self._names('Ubuntu-precise-agent',
+                                     'Ubuntu-trusty-agent',
+                                     'debian-jessie-agent'), ubuntu)
+        # agents of a group are built one after the other, in one worker.
+        threads = dict(self.built)
+        self.assertEqual(1, len(set(threads[n] for n in ubuntu)))
+
+    def test_build_agents_failure(self):
+        self.failing, = self._names('Ubuntu-trusty-agent')
+        ex = self.assertRaises(SystemExit, get.build_agents)
+        self.assertEqual(1, ex.code)
+        # the rest of the failed group is not built, other groups are.
+        self.assertEqual(
+            self._names('Ubuntu-precise-agent', 'centos-Final-agent'),
+            sorted(name for name, _ in self.built))
+        reports = os.listdir(get.BUILD_REPORTS_PATH)
+        self.assertTrue(any(r.startswith('agents-') for r in reports))
+
+    def test_main_only_validates(self):
+        get.main([])
+        get.main(['centos-Final-agent'])
+        self.assertEqual([], self.built)
+
+    def test_main_build(self):
+        get.main(['--build', 'centos-Final-agent'])
+        self.assertEqual(self._names('centos-Final-agent'),
+                         [name for name, _ in self.built])
+
+
+class LoadPackagesTest(GetTest):
+
+    def setUp(self):
+        super(LoadPackagesTest, self).setUp()
+        self.path = os.path.join(self.tmp, 'packages.yaml')
+        self._patch('_packages', {})
+        self.compiled = []
+        compile_packages = get._compile_packages
+        patcher = mock.patch.object(
+            get, '_compile_packages',
+            lambda path: self.compiled.append(path) or compile_packages(path))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _write(self, packages, mtime=1000000000):
+        with open(self.path, 'w') as f:
+            yaml.safe_dump({'packages': packages}, f)
+        os.utime(self.path, (mtime, mtime))
+
+    def _package(self, version):
+        return {'name': 'agent', 'version': version, 'sources_path': '/env'}
+
+    def _version(self):
+        return get._load_packages(self.path)['agent']['version']
+
+    def test_load_packages_cached(self):
+        self._write({'agent': self._package('3.2')})
+        self.assertEqual('3.2', self._version())
+        # the compiled packages are reused from disk by another process.
+        self._patch('_packages', {})
+        self.assertEqual('3.2', self._version())
+        self.assertEqual([self.path], self.compiled)
+
+    def test_load_packages_edited(self):
+        self._write({'agent': self._package('3.2')})
+        get._load_packages(self.path)
+        self._write({'agent': self._package('3.3m1')}, mtime=1000000001)
+        self.assertEqual('3.3m1', self._version())
+        # and from disk, in another process.
+        self._patch('_packages', {})
+        self.assertEqual('3.3m1', self._version())
+        self.assertEqual(2, len(self.compiled))
+
+    def test_load_packages_touched(self):
+        self._write({'agent': self._package('3.2')})
+        get._load_packages(self.path)
+        os.utime(self.path, (1000000001, 1000000001))
+        self._patch('_packages', {})
+        self.assertEqual('3.2', self._version())
+        # the content did not change, so it is not compiled again.
+        self.assertEqual(1, len(self.compiled))
+
+    def test_load_packages_invalid(self):
+        package = self._package('3.2')
+        del package['version']
+        self._write({'agent': package, 'other': self._package(3.2)})
+        with mock.patch.object(get, 'lgr') as lgr:
+            ex = self.assertRaises(
+                SystemExit, get._load_packages, self.path)
+        self.assertEqual(1, ex.code)
+        self.assertEqual(
+            [mock.call('Invalid package config in {0}: {1}'.format(
+                self.path, error)) for error in (
+                    'agent: missing version',
+                    'other: version must be a string')],
+            lgr.error.call_args_list)
+        # nothing is cached for an invalid packages file.
+        self.assertEqual(['packages.yaml'], os.listdir(self.tmp))
+
+
+class DownloadCacheTest(GetTest):
+
+    def setUp(self):
+        super(DownloadCacheTest, self).setUp()
+        self.server = FileServer(('127.0.0.1', 0), FileHandler)
+        self.server.files = {}
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.cache = get.DownloadCache(os.path.join(self.tmp, 'cache'))
+
+    def _serve(self, path, content):
+        self.server.files[path] = content
+        return 'http://127.0.0.1:{0}{1}'.format(self.server.server_port, path)
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_fetch_miss_then_hit(self):
+        url = self._serve('/a.tar.gz', b'a' * 100)
+        blob = self.cache.fetch(url)
+        self.assertEqual(b'a' * 100, self._read(blob))
+        self.assertEqual(hashlib.sha256(b'a' * 100).hexdigest(),
+                         os.path.basename(blob))
+        self.assertIsNone(self.server.requests[0][1].get('If-None-Match'))
+        # the second fetch is revalidated and not downloaded again.
+        self.assertEqual(blob, self.cache.fetch(url))
+        etag = self.cache.lookup(url)['etag']
+        self.assertEqual(etag, self.server.requests[1][1]['If-None-Match'])
+
+    def test_fetch_changed(self):
+        url = self._serve('/a.tar.gz', b'a' * 100)
+        first = self.cache.fetch(url)
+        self.server.files['/a.tar.gz'] = b'b' * 100
+        second = self.cache.fetch(url)
+        self.assertNotEqual(first, second)
+        self.assertEqual(b'b' * 100, self._read(second))
+
+    def test_fetch_to_destination(self):
+        url = self._serve('/a.tar.gz', b'a' * 100)
+        destination = os.path.join(self.tmp, 'a.tar.gz')
+        self.cache.fetch(url, destination)
+        self.assertEqual(b'a' * 100, self._read(destination))
+
+    def test_fetch_pinned_keeps_validators(self):
+        url = self._serve('/a.tar.gz', b'a' * 100)
+        blob = self.cache.fetch(url)
+        etag = self.cache.lookup(url)['etag']
+        self.assertEqual(blob, self.cache.fetch(
+            url, sha256=os.path.basename(blob)))
+        # a pinned digest which is cached needs no request at all.
+        self.assertEqual(1, len(self.server.requests))
+        self.assertEqual(etag, self.cache.lookup(url)['etag'])
+        self.cache.fetch(url)
+        self.assertEqual(etag, self.server.requests[1][1]['If-None-Match'])
+
+    def test_fetch_pinned_other_digest(self):
+        url = self._serve('/a.tar.gz', b'a' * 100)
+        other = self.cache.fetch(self._serve('/b.tar.gz', b'b' * 100))
+        self.cache.fetch(url)
+        self.cache.fetch(url, sha256=os.path.basename(other))
+        # validators of the url's previous content no longer apply.
+        entry = self.cache.lookup(url)
+        self.assertEqual(os.path.basename(other), entry['sha256'])
+        self.assertIsNone(entry['etag'])
+
+    def _archive(self, files):
+        archive = StringIO()
+        with closing(tarfile.open(fileobj=archive, mode='w:gz')) as tar:
+            for name, content in sorted(files.items()):
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar.addfile(info, StringIO(content))
+        return archive.getvalue()
+
+    def test_fetch_extract(self):
+        url = self._serve('/a.tar.gz', self._archive({'a/setup.py': 'a'}))
+        destination = os.path.join(self.tmp, 'sources')
+        os.makedirs(destination)
+        blob = self.cache.fetch(url, extract_to=destination)
+        with open(os.path.join(destination, 'a', 'setup.py')) as f:
+            self.assertEqual('a', f.read())
+        self.assertEqual(['a'], os.listdir(destination))
+        self.assertEqual(self._read(blob), self.server.files['/a.tar.gz'])
+
+    def test_fetch_checksum_mismatch(self):
+        url = self._serve('/a.tar.gz', b'a' * 100)
+        self.assertRaises(get.ChecksumError, self.cache.fetch,
+                          url, sha256='0' * 64)
+        # the rejected download is not kept.
+        self.assertIsNone(self.cache.lookup(url))
+        self.assertEqual([], os.listdir(self.cache.blobs_path))
+        self.assertEqual(['.lock', 'blobs', 'index.json'],
+                         sorted(os.listdir(self.cache.path)))
+
+    def test_fetch_interrupted(self):
+        url = self._serve('/a.tar.gz', b'a' * 100)
+        with mock.patch.object(get, '_verify',
+                               side_effect=KeyboardInterrupt):
+            self.assertRaises(KeyboardInterrupt, self.cache.fetch, url)
+        # the partial download is removed on the way out.
+        self.assertEqual([], os.listdir(self.cache.blobs_path))
+        self.assertEqual(['.lock', 'blobs', 'index.json'],
+                         sorted(os.listdir(self.cache.path)))
+
+    def test_fetch_extract_checksum_mismatch(self):
+        url = self._serve('/a.tar.gz', self._archive({'a/setup.py': 'a'}))
+        destination = os.path.join(self.tmp, 'sources')
+        os.makedirs(destination)
+        self.assertRaises(get.ChecksumError, self.cache.fetch,
+                          url, sha256='0' * 64, extract_to=destination)
+        # nothing is extracted from an archive which wasn't verified.
+        self.assertEqual([], os.listdir(destination))
+
+    def test_fetch_shared_sources(self):
+        archive = self._serve('/a.tar.gz', b'a' * 100)
+        digest = hashlib.sha256(b'a' * 100).hexdigest()
+        other = self._serve('/b.tar.gz', b'b' * 100)
+        packages = [{'source_urls': [{'url': archive, 'sha256': digest}]},
+                    {'source_urls': [archive, other]}]
+        with mock.patch.object(get, 'DownloadCache', lambda: self.cache):
+            sources = get._fetch_shared_sources(packages)
+        self.assertEqual([archive, other], sorted(sources))
+        self.assertEqual(digest, os.path.basename(sources[archive]))
+
+    def test_fetch_shared_sources_checksum_mismatch(self):
+        url = self._serve('/a.tar.gz', b'a' * 100)
+        packages = [{'source_urls': [{'url': url, 'sha256': '0' * 64}]},
+                    {'source_urls': [self._serve('/b.tar.gz', b'b' * 100)]}]
+        with mock.patch.object(get, 'DownloadCache', lambda: self.cache):
+            ex = self.assertRaises(
+                SystemExit, get._fetch_shared_sources, packages)
+        self.assertEqual(1, ex.code)
+
+    def test_evict(self):
+        self.cache.max_size = 250
+        urls = [self._serve('/{0}.tar.gz'.format(name), name * 100)
+                for name in (b'a', b'b', b'c')]
+        blobs = [self.cache.fetch(url) for url in urls]
+        # the least recently used file goes first.
+        self.assertIsNone(self.cache.lookup(urls[0]))
+        self.assertFalse(os.path.isfile(blobs[0]))
+        self.assertTrue(all(os.path.isfile(blob) for blob in blobs[1:]))
+        self.assertIsNotNone(self.cache.lookup(urls[2]))
+        # an evicted url is downloaded again.
+        self.assertEqual(blobs[0], self.cache.fetch(urls[0]))
+        self.assertIsNone(self.server.requests[-1][1].get('If-None-Match'))
+
+
+class BuildVenvTest(GetTest):
+
+    def setUp(self):
+        super(BuildVenvTest, self).setUp()
+        self.package = {
+            'name': 'agent',
+            'sources_path': os.path.join(self.tmp, 'agent', 'env'),
+            'package_path': os.path.join(self.tmp, 'packages'),
+            'modules': ['celery==3.1.17', 'pika'],
+        }
+        for name, stage in (('_prepare', self._prepare),
+                            ('_make_venv', self._make_venv),
+                            ('_install_pending', self._install_pending)):
+            patcher = mock.patch.object(get, name, stage)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _prepare(self, package):
+        shutil.rmtree(package['sources_path'], ignore_errors=True)
+        os.makedirs(package['sources_path'])
+
+    def _make_venv(self, package, modules, manifest, *args):
+        self.rebuilt = True
+
+    def _install_pending(self, venv, pending, *args):
+        self.installed = [module for module, _, _ in pending]
+
+    def _build(self, **options):
+        """builds the package and returns whether its virtualenv was
+        rebuilt, and the modules installed into it
+        """
+        self.rebuilt, self.installed = False, None
+        get._build_venv(self.package, fetch=False, **options)
+        return self.rebuilt, self.installed
+
+    def test_incremental(self):
+        plugin = os.path.join(self.tmp, 'plugin')
+        os.makedirs(plugin)
+
+        def edit_plugin():
+            with open(os.path.join(plugin, 'setup.py'), 'w') as f:
+                f.write('# {0}'.format(os.urandom(8).encode('hex')))
+
+        # each case is a change to make, the modules of the build which
+        # follows, whether it rebuilt the virtualenv and the modules it
+        # installed.
+        cases = [
+            (None, ['celery==3.1.17', 'pika'], True,
+             ['celery==3.1.17', 'pika']),
+            (None, ['celery==3.1.17', 'pika'], False, None),
+            # an added module is installed into the existing virtualenv.
+            (None, ['celery==3.1.17', 'pika', plugin], False, [plugin]),
+            # as is a module whose content changed.
+            (edit_plugin, ['celery==3.1.17', 'pika', plugin], False,
+             [plugin]),
+            # a removed module can't be uninstalled cleanly, so the
+            # virtualenv is rebuilt. that includes a module pinned to
+            # another version.
+            (None, ['celery==3.1.17', plugin], True,
+             ['celery==3.1.17', plugin]),
+            (None, ['celery==3.1.18', plugin], True,
+             ['celery==3.1.18', plugin]),
+        ]
+        for change, modules, rebuilt, installed in cases:
+            if change:
+                change()
+            self.package['modules'] = modules
+            self.assertEqual((rebuilt, installed),
+                             self._build(incremental=True), modules)
+
+    def test_incremental_config_changed(self):
+        self._build(incremental=True)
+        self.package['package_path'] = os.path.join(self.tmp, 'other')
+        self.assertEqual((True, ['celery==3.1.17', 'pika']),
+                         self._build(incremental=True))
+
+    def test_incremental_venv_removed(self):
+        self._build(incremental=True)
+        shutil.rmtree(self.package['sources_path'])
+        self.assertEqual((True, ['celery==3.1.17', 'pika']),
+                         self._build(incremental=True))
+
+    def test_not_incremental(self):
+        self._build()
+        self.assertEqual((True, ['celery==3.1.17', 'pika']), self._build())
+
+    def test_manifest(self):
+        manifest = get.BuildManifest(self.package['sources_path'])
+        self.assertEqual([], manifest.modules())
+        self._build(incremental=True)
+        # it is read back by the next build.
+        manifest = get.BuildManifest(self.package['sources_path'])
+        self.assertEqual(['celery==3.1.17', 'pika'],
+                         sorted(manifest.modules()))
+        self.assertFalse(manifest.changed('pip:pika', 'pika'))
+        self.assertTrue(manifest.changed('pip:pika', 'pika==0.9.14'))
+        manifest.reset()
+        self.assertEqual(
+            {}, get.BuildManifest(self.package['sources_path']).stages)
+
+
+class InstallModulesTest(GetTest):
+
+    def test_failed_requirements(self):
+        requirements = ['celery==3.1.17', 'python_novaclient==2.20.0',
+                        'PyYAML==3.10', '/agent/env/plugins/agent-installer/']
+        # each case is a line of pip's output, and the requirements it
+        # blames.
+        cases = [
+            ('Could not find a version that satisfies the requirement '
+             'celery==3.1.17 (from -r /env/archives/requirements.txt '
+             '(line 1))', ['celery==3.1.17']),
+            ('Invalid requirement: \'PyYAML==3.10\' (from -r '
+             '/env/archives/requirements.txt (line 3))', ['PyYAML==3.10']),
+            # lines beyond the requirements file are not ours.
+            ('Double requirement given: pika (from -r req.txt (line 9))',
+             []),
+            ('Command "python setup.py egg_info" failed with error code 1 '
+             'in /tmp/pip-build-0xcx/PyYAML', ['PyYAML==3.10']),
+            ('Command /env/bin/python -c "import setuptools" failed with '
+             'error code 1 in /tmp/pip-build-root/python-novaclient/',
+             ['python_novaclient==2.20.0']),
+            ('Command "python setup.py install" failed with error code 1 '
+             'in /agent/env/plugins/agent-installer/',
+             ['/agent/env/plugins/agent-installer/']),
+            ('Command "python setup.py install" failed with error code 1 '
+             'in /tmp/pip-build-0xcx/bernhard/', []),
+            ('Cannot fetch index base URL https://pypi.python.org/simple/',
+             []),
+        ]
+        for line, failed in cases:
+            self.assertEqual(failed, get._failed_requirements(
+                ['Collecting celery==3.1.17', line], requirements), line)
+
+    def test_failed_requirements_keep_order(self):
+        self.assertEqual(['celery==3.1.17', 'pika'], get._failed_requirements(
+            ['x (from -r req.txt (line 2))', 'y (from -r req.txt (line 1))'],
+            ['celery==3.1.17', 'pika']))
+
+    def test_install_modules_retries(self):
+        venv = os.path.join(self.tmp, 'env')
+        os.makedirs(os.path.join(venv, 'archives'))
+        runs = []
+
+        def pip(venv, args):
+            if args[:2] == ['install', '-r']:
+                with open(args[2]) as f:
+                    batch = f.read().split()
+                runs.append(batch)
+                if 'bernhard' in batch:
+                    return 1, ['Could not find bernhard (from -r {0} '
+                               '(line {1}))'.format(
+                                   args[2], batch.index('bernhard') + 1)], {}
+                return 0, [], {}
+            runs.append(args[1:2])
+            return 0, [], {}
+
+        with mock.patch.object(get, '_pip', pip):
+            get._install_modules(venv, ['celery', 'bernhard', 'pika'])
+        # the blamed module is taken out of the batch, and installed alone.
+        self.assertEqual([['celery', 'bernhard', 'pika'], ['celery', 'pika'],
+                          ['bernhard']], runs)
+
+
+class WheelhouseTest(GetTest):
+
+    def setUp(self):
+        super(WheelhouseTest, self).setUp()
+        self._patch('WHEELHOUSE_PATH', os.path.join(self.tmp, 'wheelhouse'))
+        os.makedirs(get.WHEELHOUSE_PATH)
+        self.runs = []
+        self.failing = None
+        # files pip leaves next to the module's wheel.
+        self.extra_files = []
+        for name, value in (('_pip', self._pip),
+                            ('_wheel_builder', lambda: '/builder')):
+            patcher = mock.patch.object(get, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _write(self, path, name):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with open(os.path.join(path, name), 'w') as f:
+            f.write(name)
+
+    def _pip(self, venv, args):
+        self.runs.append(args)
+        target = args[args.index('-w') + 1]
+        if args[-1] == self.failing:
+            return 1, ['error: could not build {0}'.format(args[-1])], {}
+        if '--no-deps' in args:
+            self._write(target, '{0}-1.0-py2-none-any.whl'.format(
+                os.path.basename(args[-1])))
+            for name in self.extra_files:
+                self._write(target, name)
+        else:
+            self._write(target, os.path.basename(args[-1]))
+            self._write(target, 'kombu-3.0-py2-none-any.whl')
+        return 0, [], {}
+
+    def test_build_wheels_once(self):
+        modules = [('celery', 'celery', 'fingerprint')]
+        # pax headers left over by unpacking an sdist are not wheels.
+        self.extra_files = ['pax_global_header']
+        wheels, links = get._build_wheels(modules)
+        self.assertEqual(2, len(self.runs))
+        self.assertEqual(
+            [os.path.join(links[0], 'celery-1.0-py2-none-any.whl')], wheels)
+        self.assertEqual(
+            ['celery-1.0-py2-none-any.whl', 'kombu-3.0-py2-none-any.whl',
+             'top', 'wheels.json'], sorted(os.listdir(links[0])))
+        # the wheels are reused by the next build.
+        self.runs = []
+        self.assertEqual((wheels, links), get._build_wheels(modules))
+        self.assertEqual([], self.runs)
+        self.assertEqual([os.path.basename(links[0])],
+                         os.listdir(get.WHEELHOUSE_PATH))
+
+    def test_build_wheels_changed_module(self):
+        wheels, links = get._build_wheels([('plugin', '/plugin', 'v1')])
+        self.assertNotEqual(
+            links, get._build_wheels([('plugin', '/plugin', 'v2')])[1])
+        self.assertEqual(4, len(self.runs))
+
+    def test_build_wheels_failure(self):
+        self.failing = 'bernhard'
+        ex = self.assertRaises(SystemExit, get._build_wheels, [
+            ('bernhard', 'bernhard', 'fingerprint')])
+        self.assertEqual(1, ex.code)
+        # nothing is left for the next build to reuse.
+        self.assertEqual([], os.listdir(get.WHEELHOUSE_PATH))
+
+    def test_build_wheels_unexpected_wheels(self):
+        # e.g. a module whose setup.py builds wheels of several projects.
+        self.extra_files = ['other-1.0-py2-none-any.whl']
+        self.assertRaises(SystemExit, get._build_wheels, [
+            ('celery', 'celery', 'fingerprint')])
+        self.assertEqual(1, len(self.runs))
+        self.assertEqual([], os.listdir(get.WHEELHOUSE_PATH))
+
+
+class GoldenVenvTest(GetTest):
+
+    def setUp(self):
+        super(GoldenVenvTest, self).setUp()
+        self._patch('GOLDEN_VENVS_PATH', os.path.join(self.tmp, 'golden'))
+        self.installed = []
+        install = mock.patch.object(
+            get, '_install_pending',
+            lambda venv, pending, wheelhouse=False:
+                self.installed.append([p[0] for p in pending]))
+        install.start()
+        self.addCleanup(install.stop)
+
+    def _read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_golden_venv_built_once(self):
+        golden, fingerprints = get._golden_venv(['celery'])
+        self.assertEqual({'celery': 'celery'}, fingerprints)
+        self.assertEqual((golden, fingerprints), get._golden_venv(['celery']))
+        self.assertEqual([['celery']], self.installed)
+        self.assertNotEqual(golden, get._golden_venv(['kombu'])[0])
+
+    def test_clone_venv(self):
+        golden, _ = get._golden_venv(['celery'])
+        origin = self._read(os.path.join(golden, '.origin'))
+        destination = os.path.join(self.tmp, 'env')
+        get._clone_venv(golden, destination)
+        self.assertNotIn('archives', os.listdir(destination))
+        self.assertNotIn('.origin', os.listdir(destination))
+        bin_path = os.path.join(destination, 'bin')
+        self.assertEqual(
+            '#!{0}\n'.format(os.path.join(bin_path, 'python')),
+            self._read(os.path.join(bin_path, 'pip')).splitlines(True)[0])
+        self.assertIn('VIRTUAL_ENV={0}\n'.format(destination),
+                      self._read(os.path.join(bin_path, 'activate')))
+        for name in os.listdir(bin_path):
+            path = os.path.join(bin_path, name)
+            if not os.path.islink(path):
+                self.assertNotIn(origin, self._read(path))
+        prefix = subprocess.check_output([
+            os.path.join(bin_path, 'python'), '-c',
+            'import sys; print(sys.prefix)'])
+        self.assertEqual(destination, prefix.strip())
+        # the golden virtualenv is left as it was.
+        self.assertIn('VIRTUAL_ENV={0}\n'.format(origin),
+                      self._read(os.path.join(golden, 'bin', 'activate')))
+
+
+class BuildPackagesTest(GetTest):
+
+    def setUp(self):
+        super(BuildPackagesTest, self).setUp()
+        self._patch('PACKAGES_FILE', os.path.join(self.tmp, 'packages.yaml'))
+        self._patch('BUILD_STATE_FILE', os.path.join(self.tmp, 'state.json'))
+        self._write_packages()
+        pool = mock.patch('multiprocessing.Pool', ThreadPool)
+        pool.start()
+        self.addCleanup(pool.stop)
+        self.built = []
+        self.failing = None
+        self.dying = None
+        self.build_package = get._build_package
+        build_package = mock.patch.object(get, '_build_package', self._build)
+        build_package.start()
+        self.addCleanup(build_package.stop)
+
+    def _write_packages(self, base_version='1.0'):
+        packages = {
+            'base': {'version': base_version},
+            # depends on base by its name rather than by its key.
+            'plugin': {'depends': ['cloudify-base']},
+            # system packages are not built here.
+            'agent': {'depends': ['plugin', 'openjdk-7-jdk']},
+            'ui': {'depends': ['nodejs']},
+        }
+        for key, package in packages.items():
+            package.setdefault('name', key)
+            package.setdefault('version', '1.0')
+            package['sources_path'] = os.path.join(self.tmp, key)
+        packages['base']['name'] = 'cloudify-base'
+        with open(get.PACKAGES_FILE, 'w') as f:
+            yaml.safe_dump({'packages': packages}, f)
+
+    def _build(self, args):
+        name, download, options = args
+        if name == self.failing:
+            return name, 'SystemExit(1,)'
+        if name == self.dying:
+            # ends the pool's worker, as if its process was killed.
+            raise SystemExit(-9)
+        self.built.append(name)
+        return name, None
+
+    def test_package_graph(self):
+        packages = get._load_packages()
+        self.assertEqual(
+            {'agent': set(['plugin']), 'plugin': set(['base']),
+             'base': set()},
+            get._package_graph(['agent'], packages))
+
+    def test_package_graph_missing(self):
+        packages = get._load_packages()
+        ex = self.assertRaises(
+            SystemExit, get._package_graph, ['agent', 'nope'], packages)
+        self.assertEqual(1, ex.code)
+
+    def test_toposort(self):
+        self.assertEqual(['base', 'ui', 'plugin', 'agent'], get._toposort({
+            'agent': set(['plugin']), 'plugin': set(['base']),
+            'base': set(), 'ui': set()}))
+
+    def test_toposort_cycle(self):
+        ex = self.assertRaises(SystemExit, get._toposort, {
+            'base': set(), 'plugin': set(['agent', 'base']),
+            'agent': set(['plugin']), 'ui': set(['agent'])})
+        self.assertEqual(1, ex.code)
+
+    def test_build_packages(self):
+        self.assertEqual(['agent', 'base', 'plugin'],
+                         get.build_packages(['agent']))
+        self.assertEqual(['base', 'plugin', 'agent'], self.built)
+
+    def test_build_packages_resume(self):
+        self.failing = 'plugin'
+        self.assertRaises(SystemExit, get.build_packages, ['agent', 'ui'])
+        # nothing depending on the failed package is started.
+        self.assertEqual(['base', 'ui'], sorted(self.built))
+        state = get._read_build_state()
+        self.assertEqual('plugin', state['failed'])
+        self.assertEqual(['base', 'ui'], sorted(state['built']))
+
+        self.failing, self.built = None, []
+        self.assertEqual(['agent', 'plugin'],
+                         get.build_packages(['agent', 'ui'], resume=True))
+        self.assertEqual(['plugin', 'agent'], self.built)
+
+        self.built = []
+        self.assertEqual([], get.build_packages(['agent', 'ui'], resume=True))
+        self.assertEqual([], self.built)
+
+    def test_build_packages_dead_worker(self):
+        self.dying = 'plugin'
+        self.assertRaises(SystemExit, get.build_packages, ['agent'])
+        self.assertEqual(['base'], self.built)
+        state = get._read_build_state()
+        self.assertEqual('plugin', state['failed'])
+        self.assertEqual(['base'], sorted(state['built']))
+
+    def test_build_package(self):
+        builder = mock.Mock()
+        with mock.patch.object(get.packman, 'get') as packman_get:
+            with mock.patch.dict(get.BUILDERS, {'plugin': builder}):
+                self.assertEqual(('plugin', None), self.build_package(
+                    ('plugin', True, {'incremental': True})))
+                self.assertEqual(('base', None),
+                                 self.build_package(('base', False, {})))
+        builder.assert_called_once_with(True, incremental=True)
+        packman_get.assert_called_once_with(get.get_conf('base'))
+
+    def test_build_package_unknown(self):
+        # not dispatched to get_conf by its name.
+        name, error = self.build_package(('conf', False, {}))
+        self.assertEqual('conf', name)
+        self.assertIn('SystemExit', error)
+
+    def test_build_packages_resume_changed(self):
+        get.build_packages(['agent', 'ui'])
+        # a different size tells the change apart within the same mtime.
+        self._write_packages(base_version='1.0.1')
+        self.built = []
+        # packages depending on a rebuilt package are rebuilt too.
+        self.assertEqual(['agent', 'base', 'plugin'],
+                         get.build_packages(['agent', 'ui'], resume=True))
+        # without --resume, everything is rebuilt.
+        self.built = []
+        get.build_packages(['agent', 'ui'])
+        self.assertEqual(['agent', 'base', 'plugin', 'ui'],
+                         sorted(self.built))